@@ -5,6 +5,7 @@
 
 import os
 import re
+import time
 import datetime
 from enum import Enum,IntEnum # since Python 3.4
 from collections import namedtuple
@@ -45,11 +46,24 @@ class AsFilelock:
 	def abslockpath(self):
 		return os.path.abspath(self.lockpath)
 
-	def lock(self):
-		if is_windows:
-			self._lock_windows()
-		else:
-			self._lock_unix()
+	lock_retry_interval = 0.05
+
+	def lock(self, wait_seconds=0):
+		"""If the lock is held by others, keep trying for wait_seconds before raising Err_asfilelock.
+		0(default) means try only once, None means wait forever.
+		"""
+		uesec_end = None if wait_seconds is None else time.monotonic() + wait_seconds
+		while True:
+			try:
+				if is_windows:
+					self._lock_windows()
+				else:
+					self._lock_unix()
+				return
+			except Err_asfilelock:
+				if uesec_end is not None and time.monotonic() >= uesec_end:
+					raise
+				time.sleep(self.lock_retry_interval)
 
 	def unlock(self):
 		if is_windows:
@@ -85,6 +99,9 @@ class AsFilelock:
 
 		except BlockingIOError:
 			his_pid = AsFilelock.getpid_from_lckfile(self.fhlock)
+			# Not ours, so unlock() must not clear his pid in it.
+			self.fhlock.close()
+			self.fhlock = None
 			raise Err_asfilelock(
 				'Cannot apply lock on file "%s"; it is probably locked by another process with pid=%d'%(
 					self.abslockpath, his_pid
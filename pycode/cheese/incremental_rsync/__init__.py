@@ -1,5 +1,19 @@
 
 #__all__ = ["funct1", "Err_irsync" ] #["share", "client"]
 
-from .share import *
-from .irsync_client import *
+# `from .share import *` and `from .irsync_client import *` are done lazily, on first access to a name,
+# so that importing a light submodule(like irsync_cmd's fast path, see fastpath.py) does not import them.
+
+_lazy_modules = ('.share', '.irsync_client')
+
+def __getattr__(name):
+	import importlib
+	modules = [importlib.import_module(modname, __name__) for modname in _lazy_modules]
+	if name=='__all__': # `from cheese.incremental_rsync import *`
+		return sorted({n for m in modules for n in dir(m) if not n.startswith('_')})
+	for module in reversed(modules): # irsync_client's names were imported last
+		if hasattr(module, name):
+			value = getattr(module, name)
+			globals()[name] = value
+			return value
+	raise AttributeError("module %r has no attribute %r"%(__name__, name))
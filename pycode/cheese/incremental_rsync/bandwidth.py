@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Bandwidth budget shared by concurrent irsync sessions on this machine.
+
+With --bw-budget-kbps=N, an irsync session registers itself in a small JSON state file
+(--bw-budget-file, by default irsync-bandwidth.json in the system temp dir, so that sessions of
+all local_store_dirs share it) and gives its rsync --bwlimit=N/M, M being the count of sessions
+registered. The state file is only touched under its filelock(<state file>.lck).
+
+While rsync runs, the session renews its heartbeat every BW_HEARTBEAT_SECONDS. When the count of
+live sessions changes so that the share differs by more than BW_REBALANCE_RATIO from the --bwlimit
+rsync is running with, rsync is stopped and started again with the new --bwlimit(rsync cannot change
+it on the fly). Such a restart does not count as a retry, and irsync keeps interrupted files in
+a partial-dir, so the restarted rsync continues them. Restarts are at least BW_RESTART_MIN_SECONDS apart.
+
+A session that ends removes itself. One that dies without doing so(kill -9) is dropped by others
+when its heartbeat is older than BW_STALE_SECONDS, or at once if its pid is gone(Unix).
+
+All sessions should be given the same --bw-budget-kbps; each one divides its own budget.
+"""
+
+import os, time, json
+import tempfile
+import threading
+
+from cheese.filelock.assistive_filelock import AsFilelock, Err_asfilelock
+
+FILENAM_bw_state = 'irsync-bandwidth.json'
+
+BW_HEARTBEAT_SECONDS = 10
+BW_STALE_SECONDS = 90
+BW_RESTART_MIN_SECONDS = 60
+BW_REBALANCE_RATIO = 0.25
+BW_MIN_KBPS = 8 # never give rsync less, whatever the count of sessions
+BW_LOCK_WAIT_SECONDS = 2
+
+def default_bw_state_filepath():
+	return os.path.join(tempfile.gettempdir(), FILENAM_bw_state)
+
+def _is_pid_alive(pid):
+	if os.name!='posix':
+		return True # os.kill(pid, 0) is not a probe on Windows
+	try:
+		os.kill(pid, 0)
+	except ProcessLookupError:
+		return False
+	except OSError:
+		pass # e.g. EPERM, it exists
+	return True
+
+
+class BandwidthShare:
+	"""One irsync session's registration in the bandwidth state file.
+	on_tick() is called from the rsync output pump(see run_exe_pump_output), possibly from
+	several threads or event loops for --shards, so state changes go under a mutex.
+	"""
+
+	def __init__(self, budget_kbps, state_filepath, session_name):
+		self.budget_kbps = budget_kbps
+		self.state_filepath = state_filepath
+		self.session_id = "%d.%d.%s"%(os.getpid(), threading.get_ident(), session_name)
+		self.session_name = session_name
+		self._mutex = threading.Lock()
+		self.bwlimit_kbps = budget_kbps # what rsync runs with, set by register() and take_restart()
+		self.share_kbps = budget_kbps # what we should run with now
+		self.sessions = 1
+		self.uesec_heartbeat = 0
+		self.uesec_restart = 0
+		self.restart_pending = False
+		self.restarts = 0
+
+	def _update_state(self, fn_update):
+		"""Read state file, call fn_update(sessions dict) to change it, write it back, all under filelock.
+		Return the count of live sessions after the update.
+		"""
+		filelock = AsFilelock(self.state_filepath + ".lck")
+		filelock.lock(BW_LOCK_WAIT_SECONDS) # raise Err_asfilelock
+		try:
+			try:
+				with open(self.state_filepath, "r", encoding="utf8") as fh:
+					sessions = json.load(fh).get('sessions', {})
+			except (OSError, ValueError, AttributeError):
+				sessions = {} # none yet, or garbage from a crash, start over
+
+			now = time.time()
+			for sid, entry in list(sessions.items()):
+				if now - entry.get('uesec_heartbeat', 0) > BW_STALE_SECONDS or not _is_pid_alive(entry.get('pid', 0)):
+					del sessions[sid]
+			fn_update(sessions)
+
+			tmp_filepath = "%s.%d.tmp"%(self.state_filepath, os.getpid())
+			with open(tmp_filepath, "w", encoding="utf8") as fh:
+				json.dump({'sessions': sessions}, fh, indent=1)
+			os.replace(tmp_filepath, self.state_filepath)
+			return len(sessions)
+		finally:
+			filelock.unlock()
+
+	def _entry(self):
+		return {'pid': os.getpid(), 'name': self.session_name, 'uesec_heartbeat': time.time(),
+			'bwlimit_kbps': self.bwlimit_kbps}
+
+	def _share_of(self, sessions):
+		return max(BW_MIN_KBPS, self.budget_kbps // max(1, sessions))
+
+	def register(self):
+		"""Join the budget, before the first rsync runs. Return the --bwlimit to use."""
+		def add(sessions):
+			sessions[self.session_id] = self._entry()
+		with self._mutex:
+			try:
+				self.sessions = self._update_state(add)
+			except (OSError, Err_asfilelock):
+				self.sessions = max(1, self.sessions) # cannot coordinate, but still keep our own budget
+			self.share_kbps = self.bwlimit_kbps = self._share_of(self.sessions)
+			self.uesec_heartbeat = self.uesec_restart = time.time()
+			return self.bwlimit_kbps
+
+	def unregister(self):
+		def remove(sessions):
+			sessions.pop(self.session_id, None)
+		try:
+			self._update_state(remove)
+		except (OSError, Err_asfilelock):
+			pass # others drop us after BW_STALE_SECONDS
+
+	def on_tick(self):
+		"""Renew heartbeat now and then. Return True if rsync should be stopped to apply a new share."""
+		with self._mutex:
+			if self.restart_pending:
+				return True
+			now = time.time()
+			if now - self.uesec_heartbeat < BW_HEARTBEAT_SECONDS:
+				return False
+			self.uesec_heartbeat = now
+
+			def renew(sessions):
+				sessions[self.session_id] = self._entry()
+			try:
+				self.sessions = self._update_state(renew)
+			except (OSError, Err_asfilelock):
+				return False # try again next heartbeat
+			self.share_kbps = self._share_of(self.sessions)
+
+			if abs(self.share_kbps - self.bwlimit_kbps) > self.bwlimit_kbps*BW_REBALANCE_RATIO \
+					and now - self.uesec_restart >= BW_RESTART_MIN_SECONDS:
+				self.restart_pending = True
+			return self.restart_pending
+
+	def take_restart(self):
+		"""If rsync has been stopped for a new share, adopt the share and return True, so that
+		the caller runs rsync again(not counting it as a retry).
+		"""
+		with self._mutex:
+			if not self.restart_pending:
+				return False
+			self.restart_pending = False
+			self.bwlimit_kbps = self.share_kbps
+			self.uesec_restart = time.time()
+			self.restarts += 1
+			return True
+
+def add_bandwidth_arguments(ap):
+	ap.add_argument('--bw-budget-kbps', type=int, dest='bw_budget_kbps', default=0,
+		help='Total rsync bandwidth in KBytes/s for all irsync sessions sharing --bw-budget-file. Each session '
+			'runs rsync with --bwlimit of an equal share, rebalanced as sessions come and go. '
+			'Default 0 means no budget.'
+	)
+	ap.add_argument('--bw-budget-file', type=str, dest='bw_budget_file',
+		help='State file where sessions sharing a bandwidth budget register. Default is %s in the '
+			'system temp dir, shared by all irsync on this machine.'%(FILENAM_bw_state)
+	)
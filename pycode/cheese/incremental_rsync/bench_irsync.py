@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+End-to-end benchmark of irsync: back up a synthetic source tree for several generations,
+changing part of the tree between generations, and measure each irsync session.
+
+    python3 -m cheese.incremental_rsync.bench_irsync [--small-files=20000] [--huge-files=2 --huge-mb=256]
+        [--generations=3] [--churn=0.05 | --churn-profile="overwrite=0.05,..."] [--seed=1] [--rsync-daemon] [--output=result.json]
+        [--irsync-args="--shards=4 --manifest"]
+
+The source tree is generated from --seed, so the same options give the same tree and the same
+changes(see churn.py), and runs of different irsync versions or options can be compared. The source is given to
+irsync as a local path, or with --rsync-daemon, through a `rsync --daemon` started on 127.0.0.1,
+which is closer to a real backup server.
+
+For each generation we report wall time of each phase(see metrics.py),
+bytes transferred(rsync --stats), how many files are hardlinks shared with an older generation,
+peak RSS, and how the CPU time splits between Python(irsync itself) and child processes(rsync).
+Results are printed and, with --output, saved as JSON.
+"""
+
+import os, sys, time
+import json
+import shlex
+import random
+import socket
+import argparse
+import tempfile
+import contextlib
+import subprocess
+from collections import namedtuple
+
+from .share import *
+from .irsync_client import irsync_st, irsync_store_st
+from .irsync_cmd import init_irsync_argparser, split_rsync_extra_params
+from .churn import apply_churn, parse_profile, scaled_profile, write_random
+
+try:
+	import resource # not on Windows
+except ImportError:
+	resource = None
+
+# small_size/huge_size in bytes. Small files are spread over fanout**depth leaf directories.
+TreeSpec = namedtuple('TreeSpec', "small_files small_size huge_files huge_size depth fanout")
+
+MTIME_BASE = 1600000000 # files written for generation g get mtime MTIME_BASE + g*86400
+
+def _write_random(filepath, size, rng, mtime):
+	with open(filepath, "wb") as fh:
+		write_random(fh, size, rng)
+	os.utime(filepath, (mtime, mtime))
+
+def _leaf_dirs(spec):
+	dirs = ['']
+	for _ in range(spec.depth):
+		dirs = [os.path.join(d, "d%02d"%(i)) for d in dirs for i in range(spec.fanout)]
+	return dirs
+
+def small_filepath(spec, index):
+	leafs = _leaf_dirs(spec)
+	return os.path.join(leafs[index % len(leafs)], "f%07d.dat"%(index))
+
+def make_source_tree(srcdir, spec, seed):
+	"""Create the generation-0 source tree. Small file sizes vary between half and 1.5x small_size."""
+	rng = random.Random("%s/tree"%(seed))
+	for leaf in _leaf_dirs(spec):
+		os.makedirs(os.path.join(srcdir, leaf), exist_ok=True)
+	for index in range(spec.small_files):
+		size = rng.randint(spec.small_size//2, spec.small_size*3//2)
+		_write_random(os.path.join(srcdir, small_filepath(spec, index)), size, rng, MTIME_BASE)
+	if spec.huge_files:
+		os.makedirs(os.path.join(srcdir, "huge"), exist_ok=True)
+	for index in range(spec.huge_files):
+		_write_random(os.path.join(srcdir, "huge", "h%02d.bin"%(index)), spec.huge_size, rng, MTIME_BASE)
+
+def churn_generation(srcdir, profile, seed, generation):
+	"""Change the tree for a new generation(2, 3, ...). Return count of files changed."""
+	st = apply_churn(srcdir, profile, "%s/churn/%d"%(seed, generation), MTIME_BASE + generation*86400)
+	return sum(st.changes.values())
+
+def hardlink_ratio(dirpath):
+	"""Return (files, files hardlinked elsewhere, bytes, bytes of those) of regular files under dirpath."""
+	files = linked = nbytes = linked_bytes = 0
+	for root, dirs, filenames in os.walk(dirpath):
+		for filename in filenames:
+			st = os.lstat(os.path.join(root, filename))
+			files += 1
+			nbytes += st.st_size
+			if st.st_nlink>1:
+				linked += 1
+				linked_bytes += st.st_size
+	return files, linked, nbytes, linked_bytes
+
+def peak_rss_bytes():
+	"""Return (peak RSS of this process, of the biggest child process), None if unknown."""
+	if not resource:
+		return None, None
+	unit = 1 if sys.platform=='darwin' else 1024 # ru_maxrss is in KB on Linux
+	return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*unit,
+		resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss*unit)
+
+
+class RsyncDaemon:
+	"""`rsync --daemon` serving srcdir as module "bench" on 127.0.0.1, for the lifetime of a with-block."""
+
+	def __init__(self, srcdir, workdir):
+		self.srcdir = srcdir
+		self.workdir = workdir
+		self.proc = None
+		with socket.socket() as sock:
+			sock.bind(('127.0.0.1', 0))
+			self.port = sock.getsockname()[1]
+
+	@property
+	def url(self):
+		return "rsync://127.0.0.1:%d/bench/"%(self.port)
+
+	def __enter__(self):
+		conf_filepath = os.path.join(self.workdir, "rsyncd.conf")
+		with open(conf_filepath, "w") as fh:
+			fh.write("use chroot = false\n[bench]\n    path = %s\n    read only = true\n"%(self.srcdir))
+		try:
+			self.proc = subprocess.Popen(["rsync", "--daemon", "--no-detach", "--address=127.0.0.1",
+				"--port=%d"%(self.port), "--config=%s"%(conf_filepath),
+				"--log-file=%s"%(os.path.join(self.workdir, "rsyncd.log"))])
+		except OSError as e:
+			raise Err_irsync("Error: Cannot start rsync --daemon. %s"%(str(e)))
+
+		uesec_end = time.monotonic() + 10
+		while time.monotonic() < uesec_end:
+			if self.proc.poll() is not None:
+				raise Err_irsync("Error: rsync --daemon exited with code %d."%(self.proc.returncode))
+			try:
+				socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+				return self
+			except OSError:
+				time.sleep(0.1)
+		self.__exit__(None, None, None)
+		raise Err_irsync("Error: rsync --daemon does not listen on port %d."%(self.port))
+
+	def __exit__(self, exc_type, exc_value, tb):
+		if self.proc:
+			self.proc.terminate()
+			self.proc.wait()
+
+
+def bench_one_generation(store, rsync_url, store_dir, generation, irsync_argv):
+	argv, rsync_extra_params = split_rsync_extra_params(irsync_argv)
+	apargs = init_irsync_argparser().parse_args([rsync_url, store_dir, "bench",
+		"--datetime-pattern=bench-gen%03d"%(generation), "--console-echo=summary"] + argv)
+
+	times_start = os.times()
+	uesec_start = time.monotonic()
+	irs = None
+	errmsg = None
+	try:
+		with open(os.devnull, "w") as fh_null, contextlib.redirect_stdout(fh_null):
+			irs = irsync_st(apargs, rsync_extra_params, store)
+			irs.run_irsync_session_once()
+	except Err_irsync as e:
+		errmsg = e.errmsg
+	wall = time.monotonic() - uesec_start
+	times_end = os.times()
+
+	python_cpu = (times_end.user - times_start.user) + (times_end.system - times_start.system)
+	child_cpu = (times_end.children_user - times_start.children_user) + \
+		(times_end.children_system - times_start.children_system)
+	phases = irs.phase_timer.totals() if irs else {} # see metrics.py
+	phases['other'] = wall - sum(phases.values())
+
+	result = {
+		'generation': generation,
+		'success': errmsg is None,
+		'error': errmsg,
+		'wall_seconds': round(wall, 3),
+		'phase_seconds': {k:round(v, 3) for k, v in phases.items()},
+		'python_cpu_seconds': round(python_cpu, 3),
+		'child_cpu_seconds': round(child_cpu, 3),
+		'python_cpu_share': round(python_cpu/(python_cpu+child_cpu), 3) if python_cpu+child_cpu>0 else None,
+	}
+
+	attempts = getattr(irs, '_rsync_attempts', None) or []
+	if attempts:
+		last = attempts[-1]
+		result['bytes_transferred'] = last.get('literal_data', -1)
+		result['bytes_received'] = last.get('total_bytes_received', -1)
+		result['rsync_attempts'] = len(attempts)
+
+	if irs and os.path.isdir(irs.finish_dirpath):
+		files, linked, nbytes, linked_bytes = hardlink_ratio(irs.finish_dirpath)
+		result.update(files=files, hardlinked_files=linked,
+			hardlink_ratio=round(linked/files, 4) if files else 0,
+			hardlink_bytes_ratio=round(linked_bytes/nbytes, 4) if nbytes else 0)
+
+	result['peak_rss_self'], result['peak_rss_children'] = peak_rss_bytes()
+	return result
+
+def run_bench(spec, generations, profile, seed, workdir, irsync_argv=(), is_rsync_daemon=False):
+	"""Return a dict of benchmark results."""
+	srcdir = os.path.join(workdir, "src")
+	store_dir = os.path.join(workdir, "store")
+
+	uesec_start = time.monotonic()
+	make_source_tree(srcdir, spec, seed)
+	tree_seconds = time.monotonic() - uesec_start
+
+	results = []
+	with contextlib.ExitStack() as stack:
+		rsync_url = srcdir
+		if is_rsync_daemon:
+			rsync_url = stack.enter_context(RsyncDaemon(srcdir, workdir)).url
+
+		store = irsync_store_st(store_dir)
+		stack.callback(store.close)
+		for generation in range(1, generations+1):
+			churned = churn_generation(srcdir, profile, seed, generation) if generation>1 else 0
+			result = bench_one_generation(store, rsync_url, store_dir, generation, list(irsync_argv))
+			result['churned_files'] = churned
+			results.append(result)
+			print(getmsg_generation_result(result))
+			if not result['success']:
+				break
+
+	return {
+		'uesec': int(time.time()),
+		'python': sys.version.split()[0],
+		'tree': spec._asdict(),
+		'generations': generations,
+		'churn_profile': profile._asdict(),
+		'seed': seed,
+		'rsync_daemon': is_rsync_daemon,
+		'irsync_args': list(irsync_argv),
+		'tree_seconds': round(tree_seconds, 3),
+		'results': results,
+	}
+
+def getmsg_generation_result(r):
+	if not r['success']:
+		return "gen %d FAILED: %s"%(r['generation'], r['error'])
+	phases = ", ".join("%s %.2fs"%(k, v) for k, v in r['phase_seconds'].items())
+	return "gen %d: %.2f seconds (%s), %d bytes transferred, %.1f%% files hardlinked, Python CPU share %s"%(
+		r['generation'], r['wall_seconds'], phases, r.get('bytes_transferred', -1),
+		r.get('hardlink_ratio', 0)*100, r['python_cpu_share'])
+
+def bench_irsync_cmd(argv):
+	ap = argparse.ArgumentParser(prog="bench_irsync", description="End-to-end irsync benchmark on a synthetic tree.")
+	ap.add_argument('--small-files', type=int, dest='small_files', default=20000)
+	ap.add_argument('--small-size', type=int, dest='small_size', default=8192, help='Average small file bytes.')
+	ap.add_argument('--huge-files', type=int, dest='huge_files', default=2)
+	ap.add_argument('--huge-mb', type=int, dest='huge_mb', default=256)
+	ap.add_argument('--depth', type=int, dest='depth', default=3)
+	ap.add_argument('--fanout', type=int, dest='fanout', default=8)
+	ap.add_argument('--generations', type=int, dest='generations', default=3)
+	ap.add_argument('--churn', type=float, dest='churn', default=0.05,
+		help='Fraction of files changed between generations, with a typical mix of changes. Default is %(default)s.')
+	ap.add_argument('--churn-profile', type=str, dest='churn_profile',
+		help='Instead of --churn, exactly which changes to make, like "overwrite=0.05,append=0.02". See churn.py.')
+	ap.add_argument('--seed', type=str, dest='seed', default='1')
+	ap.add_argument('--rsync-daemon', action="store_true", dest='rsync_daemon',
+		help='Back up through a local `rsync --daemon` instead of a local path.')
+	ap.add_argument('--irsync-args', type=str, dest='irsync_args', default='',
+		help='Extra irsync options for every generation, as one string.')
+	ap.add_argument('--workdir', type=str, dest='workdir',
+		help='Where to create source tree and local_store_dir. Default is a temp dir, deleted afterwards.')
+	ap.add_argument('--output', type=str, dest='output', help='Save results as JSON to this file.')
+	apargs = ap.parse_args(argv)
+
+	try:
+		profile = parse_profile(apargs.churn_profile) if apargs.churn_profile else scaled_profile(apargs.churn)
+	except ValueError as e:
+		print("Error: %s"%(str(e)))
+		return False
+
+	spec = TreeSpec(apargs.small_files, apargs.small_size, apargs.huge_files, apargs.huge_mb*1024*1024,
+		apargs.depth, apargs.fanout)
+
+	with contextlib.ExitStack() as stack:
+		workdir = apargs.workdir
+		if workdir:
+			os.makedirs(workdir, exist_ok=True)
+		else:
+			workdir = stack.enter_context(tempfile.TemporaryDirectory(prefix="bench_irsync."))
+		workdir = os.path.abspath(workdir)
+		stack.callback(os.chdir, os.getcwd()) # irsync_st chdir-s into local_store_dir
+
+		try:
+			report = run_bench(spec, apargs.generations, profile, apargs.seed, workdir,
+				shlex.split(apargs.irsync_args), apargs.rsync_daemon)
+		except Err_irsync as e:
+			print(e.errmsg)
+			return False
+
+	if apargs.output:
+		with open(apargs.output, "w", encoding="utf8") as fh:
+			json.dump(report, fh, indent=1)
+		print("Results saved to %s"%(apargs.output))
+	return all(r['success'] for r in report['results'])
+
+if __name__=='__main__':
+	succ = bench_irsync_cmd(sys.argv[1:])
+	exit(0 if succ else 4)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Benchmark: how fast irsync drains a child process that outputs lots of lines, like `rsync -av`
+over millions of files.
+
+    python3 -m cheese.incremental_rsync.bench_output_pump [line_count]
+
+The child is a Python process printing fake rsync -av lines as fast as it can. We compare:
+* line : run_exe_log_output_and_print(), the per-line decode/write/print pump.
+* chunk-<echo mode> : run_exe_pump_output() with each ConsoleEcho mode.
+
+Console output is sent to os.devnull, so that terminal speed does not spoil the result.
+"""
+
+import os, sys, time
+import tempfile
+import contextlib
+
+from .share import *
+
+child_code = r"""
+import sys
+out = sys.stdout.buffer
+n = int(sys.argv[1])
+for i in range(n):
+	out.write(b"project/src/module%04d/subdir/file%08d.dat\n" % (i % 1000, i))
+out.write(b"\nNumber of files: %d (reg: %d, dir: 1)\n" % (n+1, n))
+out.write(b"Total file size: 12,345 bytes\n")
+out.write(b"total size is 12,345  speedup is 1.00\n")
+"""
+
+def bench_one(name, line_count, fn_pump):
+	cmd_args = [sys.executable, "-c", child_code, str(line_count)]
+
+	with tempfile.TemporaryFile() as fh_log, open(os.devnull, "w") as fh_null:
+		with contextlib.redirect_stdout(fh_null):
+			cpu_start = time.process_time()
+			uesec_start = time.monotonic()
+			exitcode, _ = fn_pump(cmd_args, fh_log)
+			seconds = time.monotonic() - uesec_start
+			cpu_seconds = time.process_time() - cpu_start
+
+	assert exitcode==0
+	print("%-14s %8.2f seconds, %10.0f lines/s, Python CPU %6.2f seconds"%(
+		name, seconds, line_count/seconds, cpu_seconds))
+
+def pump_line(cmd_args, fh_log):
+	# The text-mode logfile, as irsync used before chunked pump.
+	fh_text = open(fh_log.fileno(), "w", encoding="utf8", closefd=False)
+	watcher = RsyncOutputWatcher()
+	ret = run_exe_log_output_and_print(cmd_args, 0, {}, fh_text, watcher.feed_line)
+	fh_text.flush()
+	return ret
+
+def make_pump_chunk(echo_mode):
+	def pump_chunk(cmd_args, fh_log):
+		watcher = RsyncOutputWatcher()
+		return run_exe_pump_output(cmd_args, 0, {}, fh_log, watcher, ConsoleEcho(echo_mode))
+	return pump_chunk
+
+if __name__=='__main__':
+	line_count = int(sys.argv[1]) if len(sys.argv)>1 else 1000000
+	print("Child process outputs %d lines."%(line_count))
+
+	bench_one("line", line_count, pump_line)
+	for echo_mode in ConsoleEcho.modes:
+		bench_one("chunk-"+echo_mode, line_count, make_pump_chunk(echo_mode))
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+The backup catalog: an SQLite file in local_store_dir that records every finished ushelf
+directory, so that irsync does not have to os.walk() the whole local_store_dir and parse
+a _irsync_backup_done.ini per ushelf on each run.
+
+The _irsync_backup_done.ini files are still the ground truth. If the catalog drifts from them
+(someone deletes backups manually, or irsync is killed at the wrong moment), rebuild it with:
+
+    python3 -m cheese.incremental_rsync.irsync_cmd catalog-rebuild <local_store_dir>
+"""
+
+import os, sys, time
+import sqlite3
+from collections import namedtuple
+from contextlib import closing
+
+FILENAM_catalog = 'irsync-catalog.db'
+
+# dirpath_rela: ushelf dirpath relative to local_store_dir, i.e. "<datetime_vault>/<ushelf>".
+# size: total bytes of files in this ushelf; -1 means unknown.
+CatalogItem = namedtuple('CatalogItem', "dirpath_rela vault ushelf uesec size")
+
+class UshelfCatalog:
+
+	def __init__(self, local_store_dir):
+		self.local_store_dir = local_store_dir
+
+	@property
+	def filepath(self):
+		return os.path.join(self.local_store_dir, FILENAM_catalog)
+
+	def exists(self):
+		return os.path.isfile(self.filepath)
+
+	def _connect(self):
+		# A new connection for each operation, so that the catalog can be used from any thread
+		# (job-list mode). Opening an SQLite file is cheap compared to what we do with it.
+		conn = sqlite3.connect(self.filepath, timeout=60)
+		conn.execute("""CREATE TABLE IF NOT EXISTS ushelf (
+			dirpath_rela TEXT PRIMARY KEY,
+			vault TEXT NOT NULL,
+			ushelf TEXT NOT NULL,
+			uesec INTEGER NOT NULL,
+			size INTEGER NOT NULL DEFAULT -1
+			)""")
+		conn.execute("CREATE INDEX IF NOT EXISTS idx_ushelf ON ushelf (ushelf, uesec)")
+		return conn
+
+	def add_ushelf(self, dirpath_rela, uesec, size=-1):
+		# Never create the catalog here: a new one holding only this ushelf would hide all older
+		# generations from later runs. Caller should rebuild() it first if it does not exist.
+		if not self.exists():
+			raise sqlite3.OperationalError("catalog file does not exist, it should be rebuilt first")
+		vault, ushelf = _split_dirpath_rela(dirpath_rela)
+		with closing(self._connect()) as conn:
+			with conn: # a transaction
+				conn.execute("INSERT OR REPLACE INTO ushelf VALUES (?,?,?,?,?)",
+					(dirpath_rela, vault, ushelf, uesec, size))
+
+	def remove_ushelf(self, dirpath_rela):
+		with closing(self._connect()) as conn:
+			with conn:
+				conn.execute("DELETE FROM ushelf WHERE dirpath_rela=?", (dirpath_rela,))
+
+	def list_ushelfs(self, ushelf=None):
+		"""Return a list of CatalogItem, oldest first.
+		If ushelf is given, only that ushelf's generations are returned.
+		"""
+		with closing(self._connect()) as conn:
+			if ushelf is None:
+				rows = conn.execute("SELECT * FROM ushelf ORDER BY uesec").fetchall()
+			else:
+				rows = conn.execute("SELECT * FROM ushelf WHERE ushelf=? ORDER BY uesec", (ushelf,)).fetchall()
+		return [CatalogItem(*row) for row in rows]
+
+	def rebuild(self, items):
+		"""Replace whole catalog content with items, which is an iterable of CatalogItem.
+		Return the count of items.
+		"""
+		count = 0
+		with closing(self._connect()) as conn:
+			with conn:
+				conn.execute("DELETE FROM ushelf")
+				for item in items:
+					conn.execute("INSERT OR REPLACE INTO ushelf VALUES (?,?,?,?,?)", item)
+					count += 1
+		return count
+
+def _split_dirpath_rela(dirpath_rela):
+	vault, ushelf = os.path.split(dirpath_rela)
+	return vault, ushelf
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Apply a churn profile to a directory tree: change part of its files the way a day of real use does,
+so that the next irsync backup has something to transfer. Used by bench_irsync, and by hand:
+
+    python3 -m cheese.incremental_rsync.churn <topdir> --profile="overwrite=0.05,append=0.02,delete=0.01" --seed=7
+
+A profile gives, for each kind of change, the fraction of existing files to receive it
+(each file receives at most one kind):
+
+    overwrite   overwrite overwrite_bytes at a random offset, size unchanged
+    append      append up to append_bytes
+    truncate    cut the file to a random shorter length
+    rename      rename it within its directory
+    delete      delete it
+    sparse      extend it with a hole of sparse_bytes, then a few bytes of data
+    create      (fraction of file count) new files of up to create_bytes, in random existing directories
+
+With --seed, the same tree and profile give the same changes and the same bytes; random bytes then
+come from random.Random.randbytes(), which makes a whole block in one call. Without a seed,
+os.urandom() is used.
+"""
+
+import os, sys, time
+import random
+import argparse
+import collections
+from collections import namedtuple
+
+BLOCK_SIZE = 1024*1024
+
+ChurnProfile = namedtuple('ChurnProfile',
+	"overwrite append truncate rename delete sparse create "
+	"overwrite_bytes append_bytes create_bytes sparse_bytes")
+ChurnProfile.__new__.__defaults__ = (0, 0, 0, 0, 0, 0, 0, 4096, 65536, 8192, 1024*1024)
+
+# The mix of changes used when only an overall churn fraction is given, see scaled_profile().
+CHURN_MIX = dict(overwrite=0.5, append=0.15, truncate=0.05, rename=0.05, delete=0.1, sparse=0.05, create=0.1)
+
+# files: count of files in tree before churn. changes: Counter of change kind -> file count.
+ChurnStats = namedtuple('ChurnStats', "files changes bytes_written")
+
+_ACTIONS = ('delete', 'rename', 'truncate', 'overwrite', 'append', 'sparse') # allocation order
+
+def parse_profile(text):
+	"""Parse "overwrite=0.05,append=0.02,append_bytes=4096" into ChurnProfile."""
+	fields = {}
+	for item in text.split(','):
+		if not item.strip():
+			continue
+		name, _, value = item.partition('=')
+		name = name.strip()
+		if name not in ChurnProfile._fields:
+			raise ValueError('Unknown churn profile item "%s", valid ones are: %s'%(name, ', '.join(ChurnProfile._fields)))
+		fields[name] = int(value) if name.endswith('_bytes') else float(value)
+	return ChurnProfile(**fields)
+
+def scaled_profile(churn):
+	"""A profile changing about `churn` fraction of files in total, mixed as CHURN_MIX."""
+	return ChurnProfile(**{name:churn*share for name, share in CHURN_MIX.items()})
+
+def random_bytes(n, rng=None):
+	return rng.randbytes(n) if rng else os.urandom(n)
+
+def write_random(fh, size, rng=None):
+	"""Write size random bytes to fh at its current position, a block at a time. Return size."""
+	left = size
+	while left>0:
+		n = min(left, BLOCK_SIZE)
+		fh.write(random_bytes(n, rng))
+		left -= n
+	return size
+
+def y_tree_files(topdir):
+	"""Yield filepaths of regular files under topdir, in a stable(sorted) order."""
+	for root, dirs, files in os.walk(topdir):
+		dirs.sort()
+		for filename in sorted(files):
+			filepath = os.path.join(root, filename)
+			if os.path.isfile(filepath) and not os.path.islink(filepath):
+				yield filepath
+
+def _change_one(action, filepath, profile, rng):
+	"""Apply one change to an existing file. Return bytes written."""
+	size = os.path.getsize(filepath)
+	if action=='delete':
+		os.remove(filepath)
+		return 0
+	if action=='rename':
+		dirpath, filename = os.path.split(filepath)
+		os.rename(filepath, os.path.join(dirpath, "r%04x-%s"%(rng.getrandbits(16), filename)))
+		return 0
+
+	with open(filepath, "rb+") as fh:
+		if action=='truncate':
+			fh.truncate(rng.randrange(size) if size>0 else 0)
+			return 0
+		if action=='overwrite':
+			n = min(size, profile.overwrite_bytes)
+			fh.seek(rng.randrange(size-n+1))
+			return write_random(fh, n, rng)
+		if action=='append':
+			fh.seek(0, os.SEEK_END)
+			return write_random(fh, rng.randint(1, max(1, profile.append_bytes)), rng)
+		if action=='sparse':
+			fh.seek(size + profile.sparse_bytes) # the hole
+			return write_random(fh, 16, rng)
+	raise ValueError(action)
+
+def apply_churn(topdir, profile, seed=None, mtime=None):
+	"""Apply profile to files under topdir. Return ChurnStats.
+	mtime: if given, changed and created files get this mtime, so that rsync's quick check(size+mtime)
+	notices an overwrite done in the same second as the last backup.
+	"""
+	rng = random.Random(seed) if seed is not None else random.Random()
+	byte_rng = rng if seed is not None else None
+	filepaths = list(y_tree_files(topdir))
+	dirpaths = sorted({os.path.dirname(fp) for fp in filepaths}) or [topdir]
+
+	order = list(range(len(filepaths)))
+	rng.shuffle(order)
+	changes = collections.Counter()
+	bytes_written = 0
+	touched = []
+	pos = 0
+	for action in _ACTIONS:
+		count = round(len(filepaths) * getattr(profile, action))
+		for index in order[pos:pos+count]:
+			bytes_written += _change_one(action, filepaths[index], profile, byte_rng or rng)
+			if action not in ('delete', 'rename'):
+				touched.append(filepaths[index])
+			changes[action] += 1
+		pos += count
+
+	for _ in range(round(len(filepaths) * profile.create)):
+		filepath = os.path.join(rng.choice(dirpaths), "c%08x.dat"%(rng.getrandbits(32)))
+		with open(filepath, "wb") as fh:
+			bytes_written += write_random(fh, rng.randint(0, profile.create_bytes), byte_rng)
+		touched.append(filepath)
+		changes['create'] += 1
+
+	if mtime is not None:
+		for filepath in touched:
+			os.utime(filepath, (mtime, mtime))
+
+	return ChurnStats(len(filepaths), changes, bytes_written)
+
+def churn_cmd(argv):
+	ap = argparse.ArgumentParser(prog="churn", description="Change part of the files in a directory tree.")
+	ap.add_argument('topdir', type=str)
+	ap.add_argument('--profile', type=str, dest='profile', default='',
+		help='Like "overwrite=0.05,append=0.02". Items: %s.'%(', '.join(ChurnProfile._fields)))
+	ap.add_argument('--churn', type=float, dest='churn', default=0,
+		help='Instead of --profile, change about this fraction of files with a typical mix of changes.')
+	ap.add_argument('--seed', type=str, dest='seed', help='Make the changes reproducible.')
+	apargs = ap.parse_args(argv)
+
+	try:
+		profile = parse_profile(apargs.profile) if apargs.profile else scaled_profile(apargs.churn)
+	except ValueError as e:
+		print("Error: %s"%(str(e)))
+		return False
+
+	uesec_start = time.monotonic()
+	st = apply_churn(apargs.topdir, profile, apargs.seed)
+	print("%d files, changes: %s. %d bytes written in %.2f seconds."%(st.files,
+		", ".join("%s %d"%(k, v) for k, v in sorted(st.changes.items())) or "none",
+		st.bytes_written, time.monotonic()-uesec_start))
+	return True
+
+if __name__=='__main__':
+	succ = churn_cmd(sys.argv[1:])
+	exit(0 if succ else 4)
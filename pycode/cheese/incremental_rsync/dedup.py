@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Cross-shelf deduplication: replace byte-identical files with hardlinks, across all ushelfs and
+all generations in one local_store_dir.
+
+rsync --link-dest only hardlinks a file to the same path in the same ushelf's older backups.
+When several shelves back up overlapping data(mirrored build outputs, shared vendor trees),
+identical files are still stored once per shelf. With `irsync --dedup`, after a ushelf is finished,
+its files are looked up in a content index(irsync-dedup.db in local_store_dir) and hardlinked
+to an identical file found there.
+
+The index is keyed by inode, so a file that --link-dest has already hardlinked to an older backup
+costs only an index lookup; only inodes new since the last pass are considered. Candidates are matched
+by size first, then a fast hash(head and tail of the file), then a full hash. An inode gets
+hashed only when another inode has the same size(and metadata), and each hash is computed once.
+
+Only files with the same size, mtime, mode, uid and gid are merged: hardlinks share all these,
+and rsync compares them with --link-dest candidates on next run.
+
+To dedup the backups that exist before --dedup is used:
+
+    python3 -m cheese.incremental_rsync.irsync_cmd dedup <local_store_dir>
+"""
+
+import os, sys, time
+import stat
+import errno
+import hashlib
+import sqlite3
+from collections import namedtuple
+from contextlib import closing
+
+FILENAM_dedup_index = 'irsync-dedup.db'
+
+DEDUP_MIN_SIZE = 1024 # smaller files are not worth the hashing
+FAST_HASH_BYTES = 64*1024 # fast hash covers this many bytes at file head and at file tail
+HASH_READ_SIZE = 1024*1024
+COMMIT_EVERY_FILES = 1000
+
+# files: regular files seen. new_inodes: inodes not in index before this pass.
+# hashed_bytes: bytes read for hashing. linked: files replaced with a hardlink.
+# reclaimed_bytes: bytes really freed, i.e. the replaced inode has no other link left.
+DedupStats = namedtuple('DedupStats', "files new_inodes hashed_bytes linked reclaimed_bytes seconds")
+
+def getmsg_dedup_stats(st):
+	return "Dedup scanned %d files(%d new inodes), hashed %.1f MB, hardlinked %d files, " \
+		"reclaimed %d bytes (%.1f MB) in %.1f seconds."%(
+		st.files, st.new_inodes, st.hashed_bytes/1000000, st.linked,
+		st.reclaimed_bytes, st.reclaimed_bytes/1000000, st.seconds)
+
+def _hash_file(filepath, is_fast):
+	h = hashlib.blake2b(digest_size=20)
+	nread = 0
+	with open(filepath, "rb") as fh:
+		if is_fast:
+			head = fh.read(FAST_HASH_BYTES)
+			h.update(head)
+			nread += len(head)
+			size = os.fstat(fh.fileno()).st_size
+			if size > FAST_HASH_BYTES*2:
+				fh.seek(-FAST_HASH_BYTES, os.SEEK_END)
+				tail = fh.read(FAST_HASH_BYTES)
+				h.update(tail)
+				nread += len(tail)
+		else:
+			while True:
+				buf = fh.read(HASH_READ_SIZE)
+				if not buf:
+					break
+				h.update(buf)
+				nread += len(buf)
+	return h.hexdigest(), nread
+
+
+class DedupIndex:
+	"""The persistent content index of a local_store_dir.
+	One row per inode: its metadata, a representative path(relative to local_store_dir)
+	and the hashes computed so far(NULL until needed).
+	"""
+
+	def __init__(self, local_store_dir):
+		self.local_store_dir = local_store_dir
+
+	@property
+	def filepath(self):
+		return os.path.join(self.local_store_dir, FILENAM_dedup_index)
+
+	def _connect(self):
+		conn = sqlite3.connect(self.filepath, timeout=60)
+		conn.execute("""CREATE TABLE IF NOT EXISTS inode (
+			dev INTEGER NOT NULL,
+			ino INTEGER NOT NULL,
+			size INTEGER NOT NULL,
+			mtime_ns INTEGER NOT NULL,
+			mode INTEGER NOT NULL,
+			uid INTEGER NOT NULL,
+			gid INTEGER NOT NULL,
+			path TEXT NOT NULL,
+			fast_hash TEXT,
+			full_hash TEXT,
+			PRIMARY KEY (dev, ino)
+			)""")
+		conn.execute("CREATE INDEX IF NOT EXISTS idx_meta ON inode (size, dev, mtime_ns, mode, uid, gid)")
+		conn.execute("CREATE INDEX IF NOT EXISTS idx_path ON inode (path)")
+		return conn
+
+	def forget_tree(self, dirpath_rela):
+		"""Remove index rows whose path is under dirpath_rela(relative to local_store_dir), when that
+		ushelf is removed, so that a reused inode number is not mistaken for one in the index.
+		An inode still linked from other ushelfs is added again by the next pass that sees it.
+		Return the count of rows removed.
+		"""
+		if not os.path.isfile(self.filepath):
+			return 0 # --dedup never used, do not create the index
+		prefix = dirpath_rela.rstrip(os.sep) + os.sep
+		with closing(self._connect()) as conn:
+			with conn:
+				# A range on path instead of LIKE, so that idx_path is used; os.sep+1 is the next character.
+				cur = conn.execute("DELETE FROM inode WHERE path>=? AND path<?",
+					(prefix, prefix[:-1] + chr(ord(os.sep)+1)))
+				return cur.rowcount
+
+	def dedup_tree(self, dirpath, skip_names=()):
+		"""Dedup all regular files under dirpath against the index, and add them to the index.
+		skip_names: entry names to skip at top level of dirpath(e.g. the log dir).
+		Return DedupStats.
+		"""
+		with closing(self._connect()) as conn:
+			dpass = _DedupPass(self, conn)
+			try:
+				dpass.run(dirpath, skip_names)
+			finally:
+				conn.commit()
+			return dpass.stats()
+
+
+class _DedupPass:
+
+	def __init__(self, index, conn):
+		self.index = index
+		self.conn = conn
+		self.uesec_start = time.time()
+		self.files = self.new_inodes = self.hashed_bytes = self.linked = self.reclaimed_bytes = 0
+		self.pending = 0
+		# old (dev,ino) -> (target path, links left), for a new inode with several links in this tree,
+		# so that all of its links are redirected to the same target.
+		self.redirects = {}
+
+	def stats(self):
+		return DedupStats(self.files, self.new_inodes, self.hashed_bytes, self.linked, self.reclaimed_bytes,
+			time.time()-self.uesec_start)
+
+	def abspath(self, rela):
+		return os.path.join(self.index.local_store_dir, rela)
+
+	def run(self, dirpath, skip_names):
+		dirs_todo = [dirpath]
+		while dirs_todo:
+			curdir = dirs_todo.pop()
+			with os.scandir(curdir) as it:
+				entries = list(it)
+			for entry in entries:
+				if curdir==dirpath and entry.name in skip_names:
+					continue
+				if entry.is_dir(follow_symlinks=False):
+					dirs_todo.append(entry.path)
+				elif entry.is_file(follow_symlinks=False):
+					self.one_file(entry.path, entry.stat(follow_symlinks=False))
+
+	def _hash(self, filepath, is_fast):
+		digest, nread = _hash_file(filepath, is_fast)
+		self.hashed_bytes += nread
+		return digest
+
+	def row_hash(self, row, is_fast):
+		"""Get fast/full hash of an index row, computing and saving it if not yet.
+		Return None if the row's file has gone or changed(the row is removed then).
+		"""
+		dev, ino, path, fast_hash, full_hash = row
+		known = fast_hash if is_fast else full_hash
+		if known:
+			return known
+
+		filepath = self.abspath(path)
+		try:
+			st = os.lstat(filepath)
+			if (st.st_dev, st.st_ino)!=(dev, ino):
+				raise FileNotFoundError
+			digest = self._hash(filepath, is_fast)
+		except FileNotFoundError: # its backup has been deleted, or it is not the same inode any more
+			self.conn.execute("DELETE FROM inode WHERE dev=? AND ino=?", (dev, ino))
+			return None
+
+		self.conn.execute("UPDATE inode SET %s=? WHERE dev=? AND ino=?"%('fast_hash' if is_fast else 'full_hash'),
+			(digest, dev, ino))
+		return digest
+
+	def one_file(self, filepath, st):
+		self.files += 1
+		key = (st.st_dev, st.st_ino)
+
+		if key in self.redirects: # another link of an inode we have just deduped
+			target, links_left = self.redirects[key]
+			if self.relink(filepath, target):
+				links_left -= 1
+				self.redirects[key] = (target, links_left)
+				if links_left==0:
+					self.reclaimed_bytes += st.st_size
+			return
+
+		row = self.conn.execute("SELECT size, mtime_ns, mode FROM inode WHERE dev=? AND ino=?", key).fetchone()
+		if row:
+			if row==(st.st_size, st.st_mtime_ns, stat.S_IMODE(st.st_mode)):
+				return # seen by an earlier pass, typically hardlinked by --link-dest
+			# Links of one inode share these, so it is another file that has reused the inode number
+			# of a removed one. Forget the old one.
+			self.conn.execute("DELETE FROM inode WHERE dev=? AND ino=?", key)
+
+		self.new_inodes += 1
+		meta = (st.st_size, st.st_dev, st.st_mtime_ns, stat.S_IMODE(st.st_mode), st.st_uid, st.st_gid)
+		rows = []
+		if st.st_size >= DEDUP_MIN_SIZE:
+			rows = self.conn.execute("SELECT dev, ino, path, fast_hash, full_hash FROM inode "
+				"WHERE size=? AND dev=? AND mtime_ns=? AND mode=? AND uid=? AND gid=?", meta).fetchall()
+
+		fast_hash = full_hash = None
+		for row in rows:
+			if fast_hash is None:
+				fast_hash = self._hash(filepath, True)
+			if self.row_hash(row, True)!=fast_hash:
+				continue
+			if full_hash is None:
+				full_hash = self._hash(filepath, False)
+			if self.row_hash(row, False)!=full_hash:
+				continue
+
+			# Identical content, and the same metadata.
+			target = self.abspath(row[2])
+			if self.relink(filepath, target):
+				if st.st_nlink==1:
+					self.reclaimed_bytes += st.st_size
+				else:
+					self.redirects[key] = (target, st.st_nlink-1)
+				self.commit_sometimes()
+				return
+
+		relapath = os.path.relpath(filepath, self.index.local_store_dir)
+		self.conn.execute("INSERT OR REPLACE INTO inode VALUES (?,?,?,?,?,?,?,?,?,?)",
+			(st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, stat.S_IMODE(st.st_mode), st.st_uid, st.st_gid,
+			relapath, fast_hash, full_hash))
+		self.commit_sometimes()
+
+	def relink(self, filepath, target):
+		"""Replace filepath with a hardlink to target, atomically. Return False if it cannot be done."""
+		tmppath = filepath + ".irsync-dedup"
+		try:
+			os.link(target, tmppath)
+		except FileExistsError:
+			os.unlink(tmppath) # left by an interrupted pass
+			os.link(target, tmppath)
+		except PermissionError: # a read-only directory, as rsync mirrors it from the source
+			return False
+		except OSError as e:
+			if e.errno==errno.EMLINK: # target has too many links, the filesystem limit
+				return False
+			raise
+		os.replace(tmppath, filepath)
+		self.linked += 1
+		return True
+
+	def commit_sometimes(self):
+		self.pending += 1
+		if self.pending>=COMMIT_EVERY_FILES:
+			self.conn.commit()
+			self.pending = 0
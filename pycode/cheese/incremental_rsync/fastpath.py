@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+The already-done fast path of irsync command line.
+
+Run from cron every minute/hour, most irsync invocations find that the backup for this datetime_vault
+has been done already. Finding that out the normal way imports the whole irsync(subprocess, asyncio,
+sqlite3, logger...), locks local_store_dir and appends to irsync.log. Here we do it with a couple of
+stat() calls instead, before any of that. So this module must stay light: besides os and sys, which
+Python has loaded at startup anyway, it imports only datetime, a small C module.
+
+The command line is parsed by hand here. Anything not fully understood(an unknown or abbreviated
+option, -h, a bad rsync_url...) makes the fast path step aside, and argparse in the normal path
+deals with it.
+"""
+
+import os, sys
+import datetime
+
+# irsync options taking a value, and those not. They must match init_irsync_argparser().
+VALUE_OPTIONS = {
+	'--datetime-pattern', '--msg-level', '--old-days', '--old-hours', '--old-minutes',
+	'--keep-hourly', '--keep-daily', '--keep-weekly', '--keep-monthly', '--min-free-percent',
+	'--link-dest-count', '--prune-workers', '--shards', '--console-echo',
+	'--max-rsync-hours', '--max-rsync-minutes', '--max-rsync-seconds', '--max-retry',
+	'--max-irsync-hours', '--max-irsync-minutes', '--max-irsync-seconds', '--finish-dir-write-to',
+	'--metrics-dir', '--log-rotate-mb', '--log-rotate-days', '--log-compress',
+	'--rsync-log-compress', '--bw-budget-kbps', '--bw-budget-file',
+}
+FLAG_OPTIONS = {
+	'--retention-dry-run', '--dedup', '--manifest', '--retry-resume', '--finish-dir-relative',
+}
+
+DATETIME_PATTERN_DEFAULT = "YYYYMMDD"
+
+def datetime_by_pattern(pattern, now=None):
+	# Example: pattern="YYYYMMDD.hhmmss"
+	# Return: "20200411.153300"
+
+	if now is None:
+		now = datetime.datetime.now()
+
+	dt = pattern
+	dt = dt.replace("YYYY", "%04d"%(now.year))
+	dt = dt.replace("MM", "%02d"%(now.month))
+	dt = dt.replace("DD", "%02d"%(now.day))
+	dt = dt.replace("hh", "%02d"%(now.hour))
+	dt = dt.replace("mm", "%02d"%(now.minute)) # use lower-case mm so not to conflict with Month
+	dt = dt.replace("ss", "%02d"%(now.second))
+	return dt
+
+def next_datetime_boundary(pattern, now=None):
+	"""Return the datetime when datetime_by_pattern(pattern) next changes its result,
+	i.e. the start of the next second/minute/hour/day/month/year, whichever is the finest unit in pattern.
+	Return None if pattern has no datetime unit at all.
+	"""
+	if now is None:
+		now = datetime.datetime.now()
+
+	if "ss" in pattern:
+		return now.replace(microsecond=0) + datetime.timedelta(seconds=1)
+	if "mm" in pattern:
+		return now.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+	if "hh" in pattern:
+		return now.replace(minute=0, second=0, microsecond=0) + datetime.timedelta(hours=1)
+	if "DD" in pattern:
+		return now.replace(hour=0, minute=0, second=0, microsecond=0) + datetime.timedelta(days=1)
+	if "MM" in pattern:
+		year, month = (now.year+1, 1) if now.month==12 else (now.year, now.month+1)
+		return datetime.datetime(year, month, 1)
+	if "YYYY" in pattern:
+		return datetime.datetime(now.year+1, 1, 1)
+	return None
+
+def split_rsync_url(rsync_src):
+	"""Return (server-name, server-path) of an rsync url, or None if it is in wrong format.
+	See _check_rsync_url() for valid forms.
+	"""
+	if rsync_src.startswith("rsync://"):
+		server, _, spath = rsync_src[len("rsync://"):].partition('/')
+		if server and spath:
+			return server, '/'+spath
+	elif os.path.isabs(rsync_src):
+		return 'LOCALHOST', rsync_src
+	return None
+
+def compose_ushelf_name(server, spath, local_shelf):
+	server_goodchars = server.replace(':', '~') # ":" is not valid Windows filename, so change it to ~
+
+	if not local_shelf:
+		local_shelf = spath.rstrip("/").split("/")[-1] # final word of spath
+
+	# TODO: ensure no "/" in shelf name
+
+	return "%s.%s"%(server_goodchars, local_shelf)
+
+def parse_argv_quick(argv):
+	"""Parse irsync command line(without argv[0]) just enough for the fast path.
+	Return (positionals, options dict), or None if argv has anything not understood.
+	"""
+	positionals = []
+	opts = {}
+	i = 0
+	while i < len(argv):
+		arg = argv[i]
+		if arg=='--rsync':
+			break # the rest goes to rsync
+		if arg.startswith('-'):
+			name, eq, val = arg.partition('=')
+			if name in VALUE_OPTIONS:
+				if not eq:
+					i += 1
+					if i>=len(argv):
+						return None
+					val = argv[i]
+				opts[name] = val
+			elif name in FLAG_OPTIONS and not eq:
+				opts[name] = True
+			else:
+				return None
+		else:
+			positionals.append(arg)
+		i += 1
+
+	if not 2 <= len(positionals) <= 3:
+		return None
+	return positionals, opts
+
+def find_done_backup(argv):
+	"""If argv asks for a backup that has been done already, return (finish_dirpath, local_store_dir, options dict),
+	else None.
+	"""
+	parsed = parse_argv_quick(argv)
+	if not parsed:
+		return None
+	positionals, opts = parsed
+
+	rsync_url = positionals[0]
+	local_shelf = positionals[2] if len(positionals)>2 else ''
+	if rsync_url.strip('/')=='':
+		return None
+	if not rsync_url.endswith("/"):
+		rsync_url = rsync_url + "/"
+	server_spath = split_rsync_url(rsync_url)
+	if not server_spath:
+		return None
+
+	datetime_pattern = opts.get('--datetime-pattern') or DATETIME_PATTERN_DEFAULT
+	if ' ' in datetime_pattern:
+		return None
+
+	local_store_dir = os.path.abspath(positionals[1])
+	finish_dirpath = os.path.join(local_store_dir, datetime_by_pattern(datetime_pattern),
+		compose_ushelf_name(*server_spath, local_shelf))
+	if not os.path.isdir(finish_dirpath):
+		return None
+	return finish_dirpath, local_store_dir, opts
+
+def irsync_quick_done(argv):
+	"""The fast path. Return True if the backup has been done already and we have said so,
+	False if the normal path has to run.
+	"""
+	done = find_done_backup(argv)
+	if not done:
+		return False
+	finish_dirpath, local_store_dir, opts = done
+
+	finish_dir_write_to = opts.get('--finish-dir-write-to')
+	if finish_dir_write_to:
+		hint_text = finish_dirpath
+		if opts.get('--finish-dir-relative'):
+			hint_text = os.path.relpath(finish_dirpath, local_store_dir) # same as irsync_st.finish_dirpath_rela
+		try:
+			# A relative path is relative to local_store_dir, as in irsync_st.record_finish_dir_by_user(),
+			# which runs after chdir to local_store_dir.
+			with open(os.path.join(local_store_dir, finish_dir_write_to), "w") as fh:
+				fh.write(hint_text)
+		except OSError:
+			return False # let the normal path report it
+
+	print("The backup has been done already at:\n    %s"%(finish_dirpath))
+	return True
@@ -2,10 +2,12 @@
 # coding: utf-8
 
 import os, sys
-import random
+
+BLOCK_SIZE = 1024*1024
 
 def fwrite_random(filepath, offset, len):
-	"""Write random content to filepath, at offset, len bytes."""
+	"""Write random content to filepath, at offset, len bytes.
+	To change many files in one go, see churn.py."""
 
 	fh = None
 	if os.path.isfile(filepath):
@@ -13,12 +15,11 @@ def fwrite_random(filepath, offset, len):
 	else:
 		fh = open(filepath, "wb")
 
-	buf = bytearray(len)
-	for i in range(len):
-		buf[i] = random.randint(0, 255)
-
 	fh.seek(offset, os.SEEK_SET)
-	fh.write(buf)
+	while len>0:
+		n = min(len, BLOCK_SIZE)
+		fh.write(os.urandom(n)) # a whole block in one call, not byte by byte
+		len -= n
 	fh.close()
 
 if __name__=='__main__':
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Tell what has changed between two backup generations, from metadata only.
+
+    python3 -m cheese.incremental_rsync.irsync_cmd diff <genA_dir> <genB_dir> [--all]
+
+With --link-dest, a file unchanged between two generations is the same inode in both,
+so no file content has to be read(unlike `diff -r`, or a second rsync). Output lines are:
+
+    + path    added in genB
+    - path    removed in genB
+    M path    modified(a different inode)
+    = path    unchanged(same inode), only shown with --all
+
+A directory path ends with '/'. An added or removed directory is reported as one line,
+its content is not listed. Results are printed as soon as they are found, so the order is not sorted.
+"""
+
+import os, sys, time
+import stat
+import argparse
+import collections
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from .share import *
+from .manifest import FILENAM_manifest
+
+# code: one of '+', '-', 'M', '='
+DiffEntry = namedtuple('DiffEntry', "code path")
+
+diff_workers_default = 8
+
+# irsync's own files in a ushelf dir, they always differ.
+SKIP_NAMES = (LOG_NOD, ININAM_sess_done, FILENAM_manifest)
+
+def _scandir_dict(dirpath):
+	try:
+		with os.scandir(dirpath) as it:
+			return {entry.name:entry for entry in it}
+	except FileNotFoundError:
+		return {}
+
+def _is_same(entry_a, entry_b):
+	st_a = entry_a.stat(follow_symlinks=False)
+	st_b = entry_b.stat(follow_symlinks=False)
+	if (st_a.st_dev, st_a.st_ino)==(st_b.st_dev, st_b.st_ino):
+		return True
+	if stat.S_IFMT(st_a.st_mode)!=stat.S_IFMT(st_b.st_mode):
+		return False
+	if stat.S_ISLNK(st_a.st_mode):
+		return os.readlink(entry_a.path)==os.readlink(entry_b.path)
+	return False
+
+def _diff_one_dir(dir_a, dir_b, relpath, is_all):
+	"""Compare one directory pair. Return (list of DiffEntry, list of sub-directory pairs to compare)."""
+	entries_a = _scandir_dict(dir_a)
+	entries_b = _scandir_dict(dir_b)
+	if not relpath:
+		for name in SKIP_NAMES:
+			entries_a.pop(name, None)
+			entries_b.pop(name, None)
+
+	results = []
+	subdirs = []
+	for name in sorted(entries_a.keys() | entries_b.keys()):
+		path = relpath + name
+		ea = entries_a.get(name)
+		eb = entries_b.get(name)
+		is_dir_a = ea is not None and ea.is_dir(follow_symlinks=False)
+		is_dir_b = eb is not None and eb.is_dir(follow_symlinks=False)
+
+		if eb is None:
+			results.append(DiffEntry('-', path+'/' if is_dir_a else path))
+		elif ea is None:
+			results.append(DiffEntry('+', path+'/' if is_dir_b else path))
+		elif is_dir_a and is_dir_b:
+			subdirs.append((ea.path, eb.path, path+'/'))
+		elif is_dir_a or is_dir_b: # a file became a directory, or vice versa
+			results.append(DiffEntry('-', path+'/' if is_dir_a else path))
+			results.append(DiffEntry('+', path+'/' if is_dir_b else path))
+		elif _is_same(ea, eb):
+			if is_all:
+				results.append(DiffEntry('=', path))
+		else:
+			results.append(DiffEntry('M', path))
+
+	return results, subdirs
+
+def y_diff_generations(dir_a, dir_b, workers=diff_workers_default, is_all=False):
+	"""Yield DiffEntry for differences from dir_a to dir_b, as they are found.
+	Directory pairs are scanned by a pool of threads.
+	"""
+	with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='irsync_diff') as executor:
+		pending = {executor.submit(_diff_one_dir, dir_a, dir_b, '', is_all)}
+		while pending:
+			done, pending = wait(pending, return_when=FIRST_COMPLETED)
+			for future in done:
+				results, subdirs = future.result()
+				for sub_a, sub_b, relpath in subdirs:
+					pending.add(executor.submit(_diff_one_dir, sub_a, sub_b, relpath, is_all))
+				yield from results
+
+def irsync_diff_cmd(argv):
+	ap = argparse.ArgumentParser(prog="irsync diff",
+		description="Show what has changed from backup generation A to B, from metadata only.")
+	ap.add_argument('gen_a', type=str, help='A backup dir, like <local_store_dir>/20200411/server.shelf')
+	ap.add_argument('gen_b', type=str, help='Another backup dir, usually a later one of the same shelf.')
+	ap.add_argument('--all', action="store_true", dest='all', help='Also list unchanged files.')
+	ap.add_argument('--workers', type=int, dest='workers', default=diff_workers_default,
+		help='Count of directory scanning threads. Default is %(default)s.'
+	)
+	apargs = ap.parse_args(argv)
+
+	for dirpath in (apargs.gen_a, apargs.gen_b):
+		if not os.path.isdir(dirpath):
+			print('Error: "%s" is not a directory.'%(dirpath))
+			return False
+
+	uesec_start = time.time()
+	counts = collections.Counter()
+	try:
+		for entry in y_diff_generations(apargs.gen_a, apargs.gen_b, max(1, apargs.workers), apargs.all):
+			counts[entry.code] += 1
+			print("%s %s"%(entry.code, entry.path))
+	except BrokenPipeError: # piped to `head`
+		return True
+	except OSError as e:
+		print("Error: %s"%(str(e)))
+		return False
+
+	print("# %d added, %d removed, %d modified%s. %.1f seconds."%(
+		counts['+'], counts['-'], counts['M'], ", %d unchanged"%(counts['=']) if apargs.all else "",
+		time.time()-uesec_start), file=sys.stderr)
+	return True
+
+if __name__ == '__main__':
+	succ = irsync_diff_cmd(sys.argv[1:])
+	exit(0 if succ else 4)
@@ -3,45 +3,142 @@
 
 import os, sys, time
 import shutil
+import threading
 import configparser # ini operation
+from cheese.filelock.assistive_filelock import AsFilelock, Err_asfilelock
 # from .share import
 
-def ReadIniItem(ini_filepath, section, itemname):
-	iniobj = configparser.ConfigParser()
-	iniobj.read(ini_filepath) # no matter if file not exist
+# Serialize INI read/write from multiple threads of one process(job-list mode), otherwise
+# a WriteIniItem() from one thread may lose the update done by another thread, or
+# a ReadIniItem() may see a half-written file.
+_ini_mutex = threading.RLock()
+
+INI_LOCK_WAIT_SECONDS = 30
+INISTORE_REGISTRY_MAX = 64
+
+class IniStore:
+	"""An INI file with its parsed content cached in memory.
+
+	Reading only costs an os.stat(), the file is parsed again only when its mtime/size/inode
+	has changed(by another process, or another IniStore). Updates are queued by set() and written
+	by commit() all at once:
+
+	* under filelock <ini_filepath>.lck, so that irsync processes sharing irsync.ini do not lose
+	  each other's updates(the file is read again inside the lock, then pending updates applied);
+	* into a temp file, fsync-ed, then renamed over the INI file, so that a crash leaves either the
+	  old or the new file, and a reader never sees a half-written one.
+
+	Use IniStore.of(ini_filepath) to share one object per file in this process.
+	"""
+
+	_registry = {} # abspath -> IniStore
+
+	@classmethod
+	def of(cls, ini_filepath):
+		abspath = os.path.abspath(ini_filepath)
+		with _ini_mutex:
+			store = cls._registry.get(abspath)
+			if not store:
+				if len(cls._registry) >= INISTORE_REGISTRY_MAX: # e.g. catalog-rebuild reads many small INIs
+					cls._registry.pop(next(iter(cls._registry)))
+				store = cls._registry[abspath] = cls(abspath)
+			return store
+
+	def __init__(self, ini_filepath, is_shared=True):
+		"""is_shared=False: only this IniStore writes the file, so commit() needs no filelock,
+		and no .lck file is left beside it.
+		"""
+		self.ini_filepath = ini_filepath
+		self.is_shared = is_shared
+		self._mutex = threading.RLock()
+		self._iniobj = configparser.ConfigParser()
+		self._signature = None # (st_mtime_ns, st_size, st_ino) of what _iniobj was parsed from
+		self._pending = [] # (section, itemname, itemval)
+
+	def _stat_signature(self):
+		try:
+			st = os.stat(self.ini_filepath)
+		except FileNotFoundError:
+			return None
+		return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+	def _refresh(self):
+		signature = self._stat_signature()
+		if signature==self._signature:
+			return
+		iniobj = configparser.ConfigParser()
+		iniobj.read(self.ini_filepath) # no matter if file not exist
+		self._iniobj = iniobj
+		self._signature = signature
+
+	def get(self, section, itemname, default=""):
+		with self._mutex:
+			self._refresh()
+			try:
+				return self._iniobj[section][itemname]
+			except KeyError:
+				return default
+
+	def section_values(self, section):
+		with self._mutex:
+			self._refresh()
+			try:
+				section = self._iniobj[section]
+				return [section[it] for it in section]
+			except KeyError:
+				return []
+
+	def set(self, section, itemname, itemval):
+		"""Queue an update, it is written by commit()."""
+		with self._mutex:
+			self._pending.append((section, itemname, itemval))
+
+	def commit(self):
+		"""Write queued updates. Raise OSError on failure(TimeoutError if the filelock is held too long)."""
+		with self._mutex:
+			if not self._pending:
+				return
+			filelock = AsFilelock(self.ini_filepath + ".lck") if self.is_shared else None
+			try:
+				if filelock:
+					filelock.lock(INI_LOCK_WAIT_SECONDS)
+			except Err_asfilelock as e:
+				raise TimeoutError(str(e))
+			try:
+				self._refresh() # pick up others' updates
+				for section, itemname, itemval in self._pending:
+					if not self._iniobj.has_section(section):
+						self._iniobj.add_section(section)
+					self._iniobj[section][itemname] = itemval
+				self._write_atomic()
+				self._pending.clear()
+			finally:
+				if filelock:
+					filelock.unlock()
+
+	def _write_atomic(self):
+		tmp_filepath = self.ini_filepath + ".tmp"
+		try:
+			with open(tmp_filepath, 'w') as inifile:
+				self._iniobj.write(inifile)
+				inifile.flush()
+				os.fsync(inifile.fileno())
+			os.replace(tmp_filepath, self.ini_filepath)
+		except OSError:
+			self._signature = None # _iniobj has our unwritten updates, re-read next time
+			raise
+		self._signature = self._stat_signature()
 
-	retpath = ""
-	try:
-		retpath = iniobj[section][itemname]
-	except KeyError:
-		retpath = ""
-	return retpath
+def ReadIniItem(ini_filepath, section, itemname):
+	return IniStore.of(ini_filepath).get(section, itemname)
 
 def WriteIniItem(ini_filepath, section, itemname, itemval):
-	iniobj = configparser.ConfigParser()
-	iniobj.read(ini_filepath) # no matter if file not exist
-
-	try:
-		_ = iniobj[section]
-	except KeyError:
-		iniobj[section] = {} # create an empty section
-
-	iniobj[section][itemname] = itemval
-
-	with open(ini_filepath, 'w') as inifile:
-		iniobj.write(inifile)
+	store = IniStore.of(ini_filepath)
+	store.set(section, itemname, itemval)
+	store.commit()
 
 def IniEnumSectionItems(ini_filepath, section_name):
-	iniobj = configparser.ConfigParser()
-	iniobj.read(ini_filepath) # no matter if file not exist
-
-	try:
-		section = iniobj[section_name]
-		itemnames = list(section)
-		itemvals = [section[it] for it in itemnames]
-		return itemvals
-	except KeyError:
-		return []
+	return IniStore.of(ini_filepath).section_values(section_name)
 
 def DHMS_to_Seconds(days, hours, minutes, seconds=0):
 	total_seconds = ((days * 24 + hours) * 60 + minutes) * 60 + seconds
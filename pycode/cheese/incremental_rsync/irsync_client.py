@@ -7,6 +7,12 @@ import os, sys, re
 import time, datetime
 import shutil, shlex
 import traceback
+import threading
+import sqlite3
+import argparse
+import json
+import asyncio
+import random
 from pathlib import Path
 from enum import Enum,IntEnum # since Python 3.4
 from collections import namedtuple
@@ -18,17 +24,38 @@ from cheese.logger.LoggerFence import LoggerFence,LiveFence
 
 from .share import *
 from .helper import *
+from .catalog import *
+from .pruner import TrashPruner, move_to_trash, TRASH_NOD
+from .fastpath import split_rsync_url, compose_ushelf_name, DATETIME_PATTERN_DEFAULT
+from .retention import make_retention_policy, is_retention_wanted, is_gfs_policy, plan_retention, getmsg_retention_candidate
+from .metrics import PhaseTimer, getmsg_phase_seconds, write_prometheus_textfile
+from .logrotate import LogRotator, LOG_ROTATE_DEFAULT, make_log_rotate_policy
+from .logrotate import resolve_compress_method, open_compressed, COMPRESS_SUFFIX, STREAM_GZIP_LEVEL
+from .bandwidth import BandwidthShare, default_bw_state_filepath
+# dedup, manifest, space, shards are imported where used, most sessions do not need them.
 
 
-LOG_NOD = '__logs__' # as directory node name for storing log files.
-
 ININAM_irsync_master = 'irsync.ini'
 INISEC_last_success_dirpath = 'last_success_dirpath'
 #
-ININAM_sess_done = '_irsync_backup_done.ini'
+# ININAM_sess_done and LOG_NOD are in share.py, bcz other modules(gendiff...) need them without this one.
 INISEC_sess_done = 'backup_done'
 INIKEY_utc = 'utc'
 INIKEY_localtime = 'localtime'
+INIKEY_size = 'size'
+
+FILENAM_stats_history = 'irsync-stats.jsonl' # one JSON record per line, per irsync session
+
+RSYNC_MAX_LINK_DEST = 20 # rsync accepts at most this many --link-dest(compile-time MAX_BASIS_DIRS)
+
+# For --retry-resume.
+# A relative --partial-dir is created by rsync in the destination directory of each interrupted file,
+# i.e. inside .working dir, and removed by rsync once the file completes.
+RSYNC_PARTIAL_DIR = '.irsync-partial'
+# rsync params that decide by themselves how interrupted files are kept, we do not add --partial-dir then.
+RSYNC_PARTIAL_OPTS = ('--partial-dir', '--inplace', '--append', '--append-verify')
+RETRY_BACKOFF_BASE_SECONDS = 2
+RETRY_BACKOFF_MAX_SECONDS = 300
 
 def check_rsync_params_conflict(rsync_raw_params):
 	# yes, irsync_args not used
@@ -50,6 +77,121 @@ def value_not_negative(irsync_args, argname, argval):
 	if argval<0:
 		raise Err_irsync("Error: The parameter(%s) must not be a negative value(%d)."%(argname, argval))
 
+def make_ushelf_name(rsync_url, local_shelf):
+	# combine server-name and shelf-name into `ushelf` name (货架标识符).
+	# 'u' implies unique, I name it so bcz I expect/hope it is unique within 
+	# a specific local_store_dir .
+	server, spath = _check_rsync_url(rsync_url)
+	return compose_ushelf_name(server, spath, local_shelf)
+
+
+class irsync_store_st:
+	"""Represents the process-wide resources of one local_store_dir: the filelock on irsync.log.lck
+	and the master logfile(irsync.log).
+
+	Normally each irsync_st creates its own irsync_store_st. In job-list mode, one irsync_store_st
+	is created by the job runner and shared by all irsync_st sessions running concurrently in this
+	process, so that they do not fight each other for the filelock, and their master log records
+	do not get garbled.
+	"""
+
+	def __init__(self, local_store_dir, log_rotate=LOG_ROTATE_DEFAULT):
+		# log_rotate: LogRotatePolicy for irsync.log, see logrotate.py .
+		self.local_store_dir = os.path.abspath(local_store_dir)
+		self._mutex = threading.RLock()
+
+		try:
+			os.makedirs(self.local_store_dir, exist_ok=True)
+		except OSError:
+			raise Err_irsync('Error: Cannot create local_store_dir "%s"'%(self.local_store_dir))
+
+		#
+		# Acquire master-logfile's filelock first, so to ensure we're the only process
+		# that is storing into this local_store_dir. If acquire-filelock fails, just quit.
+		#
+		self.master_filelock = AsFilelock(self.master_logfile_lck)
+
+		try:
+			self.master_filelock.lock()
+		except Err_asfilelock as e:
+			# We have no logfile to write here, so just print to stderr.
+			# Translate to Err_irsync exception
+			raise Err_irsync("""Error:  Cannot acquire lock on local_store_dir "%s", so I cannot continue.      
+    Detail: %s
+"""%(self.local_store_dir, e.errmsg))
+
+		# We hold the filelock now, so we are the only one to rotate irsync.log .
+		self.log_rotator = LogRotator(self.master_logfile, log_rotate, self.masterlogW)
+		self.master_logfh = open(self.master_logfile, "a", encoding="utf8")
+		self.masterlog_sink("\n"+ "~"*78 +"\n") # We don't want timestamp on this linesep char
+
+		# For messages that belong to no specific irsync session, e.g. job-list summary.
+		self.mtl = MTLogger(need_millisec=True, need_levelname=True, level2name=irsync_st.loglevel2name)
+		self.mtl.add_target(irsync_st.logtarget_cui, MsgLevel.info.value, print_nolf)
+		self.mtl.add_target(irsync_st.logtarget_file, MsgLevel.info.dbg, self.masterlog_sink)
+
+		self.pruner = None # created on first use
+		self.log_rotator.compress_leftovers()
+
+		# Sessions sharing this store must not pick and remove old backups at the same time.
+		self.retention_lock = threading.Lock()
+
+	@property
+	def master_logfile(self):
+		return os.path.join(self.local_store_dir, "irsync.log")
+
+	@property
+	def master_logfile_lck(self):
+		return self.master_logfile + ".lck"
+
+	def masterlog_sink(self, text):
+		with self._mutex:
+			if self.log_rotator.is_due():
+				try:
+					self.master_logfh = self.log_rotator.rotate(self.master_logfh)
+				except OSError:
+					# Keep logging to the old file(reopen it if rotate() has closed it).
+					if self.master_logfh.closed:
+						self.master_logfh = open(self.master_logfile, "a", encoding="utf8")
+					self.log_rotator.size = 0 # do not retry on every line
+			self.master_logfh.write(text)
+			self.master_logfh.flush()
+			self.log_rotator.count(text)
+
+	def masterlog(self, sourcelevel, msg):
+		self.mtl.log(sourcelevel, msg)
+
+	masterlogE = partialmethod(masterlog, MsgLevel.err.value)
+	masterlogW = partialmethod(masterlog, MsgLevel.warn.value)
+	masterlogI = partialmethod(masterlog, MsgLevel.info.value)
+
+	@property
+	def stats_history_filepath(self):
+		return os.path.join(self.local_store_dir, FILENAM_stats_history)
+
+	def append_stats_history(self, record):
+		with self._mutex:
+			with open(self.stats_history_filepath, "a", encoding="utf8") as fh:
+				fh.write(json.dumps(record, sort_keys=True) + "\n")
+
+	def start_pruning(self, workers):
+		"""Delete old backups in trash, in background."""
+		with self._mutex:
+			if not self.pruner:
+				self.pruner = TrashPruner(self.local_store_dir, workers)
+		self.pruner.start_background(self.masterlogI)
+
+	def close(self):
+		if self.pruner:
+			self.pruner.join() # it still logs to master logfile
+		self.log_rotator.join() # so does it, if compression fails
+		with self._mutex:
+			if self.master_logfh:
+				self.master_logfh.close()
+				self.master_logfh = None
+		self.master_filelock.unlock()
+
+
 class irsync_st(LoggerFence):
 
 	logtarget_cui = "CUI"
@@ -63,7 +205,7 @@ class irsync_st(LoggerFence):
 	pfxMsgLevel[MsgLevel.info.value] = "[INFO]"
 	pfxMsgLevel[MsgLevel.dbg.value] = "[DBG]"
 	
-	datetime_pattern_default = "YYYYMMDD"
+	datetime_pattern_default = DATETIME_PATTERN_DEFAULT
 	
 	def __xxx_nouse_save_extra_args(self, args, argname, selfattr_desiredtype, selfattr_name, fn_check_valid=None, *fn_args):
 		""" Search args[] for a param named argname. If found, validate it and save it as self's attribute.
@@ -101,11 +243,7 @@ class irsync_st(LoggerFence):
 
 	@property
 	def master_logfile(self):
-		return os.path.join(self.local_store_dir, "irsync.log")
-
-	@property
-	def master_logfile_lck(self):
-		return self.master_logfile + ".lck"
+		return self.store.master_logfile
 
 	def to_success_path(self, inpath):
 		return inpath.replace(self.working_dirpath, self.finish_dirpath)
@@ -126,14 +264,16 @@ class irsync_st(LoggerFence):
 		"""Prefix local_store_dir to rela_path so to make an absolute dir."""
 		return os.path.join(self.local_store_dir, rela_path)
 
-	def __init__(self, apargs, rsync_extra_params):
+	def __init__(self, apargs, rsync_extra_params, store=None):
 
 		# apargs is the argparse.ArgumentParser object that accommodates all user parameters.
+		# store is an optional irsync_store_st object shared by multiple irsync_st(job-list mode).
 		#
 		# [local_store_dir]/[datetime_vault]/[server.local_shelf] becomes final target dir for rsync.
 		# [server.local_shelf] is called [ushelf] for brevity.
 
 		self.uesec_start = uesec_now()
+		self.phase_timer = PhaseTimer() # see metrics.py
 
 		#
 		# Set some default working parameters.
@@ -158,8 +298,22 @@ class irsync_st(LoggerFence):
 		# Process extra optional arguments
 		#
 		self._loglevel = MsgLevel[apargs.msg_level]
-		self._old_seconds = DHMS_to_Seconds(apargs.old_days, apargs.old_hours, apargs.old_minutes)
+		self._retention = make_retention_policy(apargs)
+		self._is_retention_dry_run = apargs.retention_dry_run
+		if not 0 <= self._retention.min_free_percent < 100:
+			raise Err_irsync("Error: --min-free-percent must be 0 to less than 100.")
 		self._max_retry = apargs.max_retry
+		self._link_dest_count = apargs.link_dest_count
+		if not 1 <= self._link_dest_count <= RSYNC_MAX_LINK_DEST:
+			raise Err_irsync("Error: --link-dest-count must be 1 to %d, rsync accepts no more."%(RSYNC_MAX_LINK_DEST))
+		self._prune_workers = apargs.prune_workers
+		self._console_echo = apargs.console_echo
+		self._is_retry_resume = apargs.retry_resume
+		self._shards = apargs.shards
+		self._is_dedup = apargs.dedup
+		self._is_manifest = apargs.manifest
+		if self._shards<1:
+			raise Err_irsync("Error: --shards must be at least 1.")
 		self._max_rsync_seconds = DHMS_to_Seconds(0, apargs.max_rsync_hours, apargs.max_rsync_minutes, apargs.max_rsync_seconds)
 		self._max_irsync_seconds = DHMS_to_Seconds(0, apargs.max_irsync_hours, apargs.max_irsync_minutes, apargs.max_irsync_seconds)
 		if self._max_irsync_seconds>0:
@@ -171,26 +325,35 @@ class irsync_st(LoggerFence):
 		#
 		self._finish_dir_write_to = apargs.finish_dir_write_to
 		self._finish_dir_relative = apargs.finish_dir_relative
+		self._metrics_dir = os.path.abspath(apargs.metrics_dir) if apargs.metrics_dir else None
+		self._log_rotate = make_log_rotate_policy(apargs)
+		self._rsync_log_compress = resolve_compress_method(apargs.rsync_log_compress) # None for no compress
 		#
 		self._rsync_extra_params = rsync_extra_params
 		check_rsync_params_conflict(rsync_extra_params)
+		if apargs.bw_budget_kbps<0:
+			raise Err_irsync("Error: --bw-budget-kbps must not be negative.")
+		if apargs.bw_budget_kbps>0 and any(param.split('=')[0]=='--bwlimit' for param in rsync_extra_params):
+			raise Err_irsync("Error: rsync parameter --bwlimit cannot be used with --bw-budget-kbps, "
+				"bcz irsync gives rsync its share of the budget as --bwlimit.")
+		# A bandwidth rebalance restarts rsync, so keep interrupted files for it as well.
+		self._is_partial_dir_managed = (self._is_retry_resume or apargs.bw_budget_kbps>0) and not any(
+			param.split('=')[0] in RSYNC_PARTIAL_OPTS for param in rsync_extra_params)
+		if self._shards>1 and any(param.split('=')[0] in ('--files-from', '--from0') for param in rsync_extra_params):
+			raise Err_irsync("Error: rsync parameter --files-from cannot be used with --shards, "
+				"bcz irsync gives each shard its own --files-from.")
 
 		#
 		# prepare some static working data
 		#
 		
-		# combine server-name and shelf-name into `ushelf` name (货架标识符).
-		# 'u' implies unique, I name it so bcz I expect/hope it is unique within 
-		# a specific local_store_dir .
-		server, spath = _check_rsync_url(self.rsync_url)
-		server_goodchars = server.replace(':', '~') # ":" is not valid Windows filename, so change it to ~
-
-		if not local_shelf:
-			local_shelf = spath.rstrip("/").split("/")[-1] # final word of spath
+		self.ushelf_name = make_ushelf_name(self.rsync_url, local_shelf)
 
-		# TODO: ensure no "/" in shelf name
-
-		self.ushelf_name = "%s.%s"%(server_goodchars, local_shelf)
+		self._bandwidth = None # BandwidthShare, see bandwidth.py
+		if apargs.bw_budget_kbps>0:
+			self._bandwidth = BandwidthShare(apargs.bw_budget_kbps,
+				os.path.abspath(apargs.bw_budget_file) if apargs.bw_budget_file else default_bw_state_filepath(),
+				self.ushelf_name)
 		
 		# datetime_vault: this backup session's datetime-identified vault
 		# Examples: 
@@ -222,39 +385,30 @@ class irsync_st(LoggerFence):
 		except OSError:
 			raise Err_irsync('Error: Cannot create/enter local_store_dir "%s"'%(self.local_store_dir))
 
-		self.master_logfile_start()
+		self.master_logfile_start(store)
 		return
 
-	def master_logfile_start(self):
+	def master_logfile_start(self, store=None):
 
 		self._sess_logfile = None
 
-		#
-		# Acquire master-logfile's filelock first, so to ensure we're the only process
-		# that is storing into this local_store_dir. If acquire-filelock fails, just quit.
-		#
-		self.master_filelock = AsFilelock(self.master_logfile_lck)
-
-		try:
-			self.master_filelock.lock()
-		except Err_asfilelock as e:
-			# We have no logfile to write here, so just print to stderr.
-			# Translate to Err_irsync exception
-			raise Err_irsync("""Error:  Cannot acquire lock on local_store_dir "%s", so I cannot continue.      
-    Detail: %s
-"""%(self.local_store_dir, e.errmsg))
-
-		self.master_logfh = open(self.master_logfile, "a", encoding="utf8")
-		self.master_logfh.write("\n"+ "~"*78 +"\n") # We don't want timestamp on this linesep char
+		if store:
+			if store.local_store_dir != self.local_store_dir:
+				raise Err_irsync("BUG: irsync_store_st is for \"%s\", but this session stores into \"%s\"."%(
+					store.local_store_dir, self.local_store_dir))
+			self.store = store
+			self._is_store_shared = True
+		else:
+			self.store = irsync_store_st(self.local_store_dir, self._log_rotate) # raise Err_irsync if lock fails
+			self._is_store_shared = False
 
-		def masterlog_sink(text):
-			self.master_logfh.write(text)
-			self.master_logfh.flush()
+		masterlog_sink = self.store.masterlog_sink
 
 		def masterlog_excpt_sanction(excpt_text):
 			masterlog_sink(excpt_text)
 			self.irsync_report_new_failure()
 			self.masterlogE(self.getmsg_report_time_cost(False))
+			self.save_session_stats(False) # if not yet, e.g. failing in retention or preflight
 
 		self.mtl = MTLogger(need_millisec=True, need_levelname=True, level2name=__class__.loglevel2name)
 		self.mtl.add_target(__class__.logtarget_cui, MsgLevel.info.value, print_nolf)
@@ -299,6 +453,9 @@ class irsync_st(LoggerFence):
 		return fp, fh
 
 	def masterlog(self, sourcelevel, msg):
+		if self._is_store_shared:
+			# Several sessions write to the same irsync.log, so tell them apart.
+			msg = "<%s> %s"%(self.ushelf_name, msg)
 		self.mtl.log(sourcelevel, msg)
 
 	masterlogE = partialmethod(masterlog, MsgLevel.err.value)
@@ -308,9 +465,10 @@ class irsync_st(LoggerFence):
 	def __xxx_prn_start_info(self):
 		pass
 
-	def ushelf_record_finish_timestamp(self):
+	def ushelf_record_finish_timestamp(self, size=-1):
 		# This on-disk timestamp is used to determine whether a ushelf is out-dated
 		# on next irsync run.
+		# size is total bytes of this ushelf, as reported by rsync --stats; -1 means unknown.
 		uesec = int(time.time())
 		tmlocal = time.localtime(uesec)
 		localtime_str = time.strftime("%Y-%m-%d %H:%M:%S", tmlocal)
@@ -319,8 +477,13 @@ class irsync_st(LoggerFence):
 			(INIKEY_utc, str(uesec)),
 			(INIKEY_localtime, localtime_str)
 		]
+		if size>=0:
+			ini_content.append( (INIKEY_size, str(size)) )
+		# Only this session writes it, and a .lck file should not be left in the backup dir.
+		ini = IniStore(self.sess_done_ini_filepath, is_shared=False)
 		for t in ini_content:
-			WriteIniItem(self.sess_done_ini_filepath, INISEC_sess_done, t[0], t[1])
+			ini.set(INISEC_sess_done, t[0], t[1])
+		ini.commit() # one write for all items
 
 	def ushelf_rename_to_finish_dir(self):
 		try:
@@ -332,6 +495,78 @@ class irsync_st(LoggerFence):
 				"    SRC: %s\n"
 				"    DST: %s\n" % (self.working_dirpath, self.finish_dirpath))
 
+	def ushelf_record_catalog(self):
+		# Add this finish-dir to the backup catalog, so that later runs know it without walking
+		# the whole local_store_dir. On a store that has no catalog yet, build it from INI files first,
+		# so that older generations are in it too.
+		self.ensure_catalog()
+		finish_ini = os.path.join(self.finish_dirpath, ININAM_sess_done)
+		item = read_sess_done_ini(finish_ini, self.finish_dirpath_rela)
+		if not item:
+			raise Err_irsync('Error: Unexpected! Invalid content in "%s".'%(finish_ini))
+
+		try:
+			self.catalog.add_ushelf(item.dirpath_rela, item.uesec, item.size)
+		except sqlite3.Error as e:
+			raise Err_irsync('Error: Cannot record "%s" into catalog file "%s". %s'%(
+				item.dirpath_rela, self.catalog.filepath, str(e)))
+
+	def ushelf_dedup(self):
+		# Post-finish stage for --dedup: hardlink files of this finish-dir to identical files in other
+		# ushelfs/generations. The backup has been claimed successful, so a failure here is only a warning.
+		if not self._is_dedup:
+			return
+
+		from .dedup import DedupIndex, getmsg_dedup_stats
+		index = DedupIndex(self.local_store_dir)
+		self.masterlogI('Dedup against content index "%s" ...'%(index.filepath))
+		try:
+			st = index.dedup_tree(self.finish_dirpath, skip_names=(LOG_NOD, ININAM_sess_done))
+		except (OSError, sqlite3.Error) as e:
+			self.masterlogW("Dedup fails, this does not affect the backup itself. %s"%(str(e)))
+			return
+
+		self.masterlogI(getmsg_dedup_stats(st))
+		self._dedup_stats = st._asdict()
+		if st.linked>0:
+			from .space import drop_cache
+			drop_cache(self.local_store_dir, self.finish_dirpath_rela) # in case `irsync space` has seen it already
+
+	def forget_dedup_rows(self, dirpath_rela):
+		# Files of a removed ushelf leave the dedup index, their inode numbers will be reused.
+		from .dedup import DedupIndex
+		try:
+			DedupIndex(self.local_store_dir).forget_tree(dirpath_rela)
+		except sqlite3.Error as e:
+			self.masterlogW("Fail to remove %s from dedup index. %s"%(dirpath_rela, str(e)))
+
+	def ushelf_write_manifest(self, prev_dirpath_rela):
+		# For --manifest: record path, size, mtime, inode, content hash of every file in this finish-dir.
+		if not self._is_manifest:
+			return
+
+		from .manifest import write_manifest, getmsg_manifest_stats, FILENAM_manifest, MANIFEST_READ_ERRORS
+
+		prev_manifest = None
+		if prev_dirpath_rela and prev_dirpath_rela!=self.finish_dirpath_rela:
+			prev_manifest = os.path.join(self.abspath(prev_dirpath_rela), FILENAM_manifest)
+
+		skip_names = (LOG_NOD, ININAM_sess_done)
+		try:
+			try:
+				st = write_manifest(self.finish_dirpath, prev_manifest, skip_names=skip_names,
+					by_inode=self._is_dedup) # dedup links files across paths
+			except MANIFEST_READ_ERRORS as e: # must go before OSError, gzip.BadGzipFile is one
+				self.masterlogW('Previous manifest is unreadable, writing manifest without hash reuse. %s: %s\n    %s'%(
+					type(e).__name__, str(e), prev_manifest))
+				st = write_manifest(self.finish_dirpath, None, skip_names=skip_names)
+		except OSError as e:
+			self.masterlogW("Fail to write manifest, this does not affect the backup itself. %s"%(str(e)))
+			return
+
+		self.masterlogI(getmsg_manifest_stats(st))
+		self._manifest_stats = st._asdict()
+
 	def ushelf_record_last_finish_dir(self):
 		# Record this on-disk info, so that next rsync run can --link-dest= to it.
 		try:
@@ -344,7 +579,7 @@ class irsync_st(LoggerFence):
 
 	def record_finish_dir_by_user(self):
 		if self._finish_dir_write_to:
-			hint_fp = os.path.abspath(self._finish_dir_write_to)
+			hint_fp = os.path.abspath(self._finish_dir_write_to) # relative to local_store_dir, we have chdir there
 			hint_text = self.finish_dirpath
 			if self._finish_dir_relative:
 				hint_text = self.finish_dirpath_rela
@@ -390,67 +625,193 @@ Check session log file for details:
 		else:
 			return 'Irsync session FAIL! %s' % (runtime)
 
+	def save_session_stats(self, is_succ):
+		"""Save rsync transfer statistics of this session as JSON: one file beside the session logfile,
+		and one line appended to irsync-stats.jsonl in local_store_dir. With --metrics-dir, also write
+		the Prometheus textfile, even if the session fails before rsync runs, so that the failure shows.
+		Called once per session; later calls(a failure seen by both session and master log fences) do nothing.
+		"""
+		if getattr(self, '_is_session_stats_saved', False):
+			return
+		self._is_session_stats_saved = True
+
+		attempts = getattr(self, '_rsync_attempts', None) or []
+		uesec_end = time.time()
+		record = {
+			'ushelf': self.ushelf_name,
+			'rsync_url': self.rsync_url,
+			'datetime_vault': self.datetime_vault,
+			'success': is_succ,
+			'uesec_start': self.uesec_start,
+			'uesec_end': int(uesec_end),
+			'elapsed_seconds': round(uesec_end - self.uesec_start, 3),
+			'sess_logfile': os.path.relpath(self._sess_logfile, self.local_store_dir) if self._sess_logfile else None,
+			'rsync_attempts': attempts,
+			'phase_seconds': {name:round(seconds, 3) for name, seconds in self.phase_timer.totals().items()},
+		}
+		if getattr(self, '_dedup_stats', None):
+			record['dedup'] = self._dedup_stats
+		if getattr(self, '_manifest_stats', None):
+			record['manifest'] = self._manifest_stats
+
+		if attempts and self._sess_logfile: # else no rsync has run in this session, no transfer statistics
+			stats_filepath = os.path.splitext(self._sess_logfile)[0] + ".stats.json"
+			try:
+				with open(stats_filepath, "w", encoding="utf8") as fh:
+					json.dump(record, fh, indent=1, sort_keys=True)
+				self.store.append_stats_history(record)
+			except OSError as e:
+				# Losing statistics should not fail a backup.
+				self.masterlogW("Fail to save rsync statistics. %s"%(str(e)))
+
+		if self._metrics_dir:
+			try:
+				write_prometheus_textfile(self._metrics_dir, record, self.phase_timer)
+			except OSError as e:
+				self.masterlogW("Fail to write metrics to %s. %s"%(self._metrics_dir, str(e)))
+
+
+	@property
+	def catalog(self):
+		if not hasattr(self, '_catalog'):
+			self._catalog = UshelfCatalog(self.local_store_dir)
+		return self._catalog
+
+	def ensure_catalog(self):
+		# The first time we see a local_store_dir without catalog, build it from INI files.
+		if not self.catalog.exists():
+			self.masterlogI("Backup catalog not found, building it from %s files..."%(ININAM_sess_done))
+			count = self.catalog.rebuild(y_walk_finished_ushelfs(self.local_store_dir))
+			self.masterlogI("Backup catalog built with %d finished ushelfs:\n    %s"%(count, self.catalog.filepath))
 
 	def y_find_existing_ushelf(self):
-		# Existence of a _irsync_backup_done.ini file identifies a historical finished ushelf directory.
-		# And, I will check that ini only in second-depth subdirs from local_store_dir.
-		root_start = self.local_store_dir
-		for root, dirs, files in os.walk(root_start):
-			dirnods = root.replace(root_start, '$', 1) # strip root_start prefix, use '$' to denote root
-#			print('dirnods='+dirnods) # debug
-			if(dirnods.count(os.sep)==2):
-				# now we are at the a second-depth subdir
-				if ININAM_sess_done in files:
-					uesec_str = ReadIniItem(os.path.join(root, ININAM_sess_done),
-					                        INISEC_sess_done, INIKEY_utc)
-					try:
-						uesec = int(uesec_str)
-#						print("%d @ %s" % (uesec, root)) # debug
-						yield uesec, root
-					except ValueError:
-						pass # ignore it
+		# Historical finished ushelf directories are looked up from the catalog.
+		self.ensure_catalog()
+		for item in self.catalog.list_ushelfs():
+			yield item.uesec, self.abspath(item.dirpath_rela)
+
+	def get_space_usage(self, is_rescan=False):
+		"""Space accounting of all finished ushelfs in local_store_dir, see space.py .
+		Return (list of SpaceUsage oldest first, physical bytes).
+		"""
+		from .space import compute_space_usage
+		dirpaths_rela = [os.path.relpath(dirpath, self.local_store_dir)
+			for uesec, dirpath in self.y_find_existing_ushelf() if os.path.isdir(dirpath)]
+		return compute_space_usage(self.local_store_dir, dirpaths_rela, is_rescan)
+
+	def select_link_dest_dirpaths(self, last_succ_dirpath):
+		"""Return a list of dirpaths(relative to local_store_dir) to be used as rsync --link-dest,
+		most recent first, at most self._link_dest_count of them.
 
-				dirs.clear()    # so will not descend any further
+		A file that is missing in last-success backup but present in an older one can still be
+		hardlinked from the older one, instead of being transferred and stored again.
+		"""
+		dirpaths = [last_succ_dirpath] if last_succ_dirpath else []
+		if self._link_dest_count <= len(dirpaths):
+			return dirpaths
+
+		self.ensure_catalog()
+		for item in reversed(self.catalog.list_ushelfs(self.ushelf_name)): # newest first
+			if len(dirpaths) >= self._link_dest_count:
+				break
+			if item.dirpath_rela in dirpaths:
+				continue
+			if os.path.isdir(self.abspath(item.dirpath_rela)):
+				dirpaths.append(item.dirpath_rela)
+
+		return dirpaths
 
 	def remove_old_ushelfs(self):
-		sec_keep = self._old_seconds
-		if sec_keep<=0:
+		policy = self._retention
+		if not is_retention_wanted(policy):
 			return
 
-		self.masterlogI("User requests removing backups older than %d days, %d hours, %d minutes."%(
-			Seconds_to_DHMS(sec_keep)[0:3]
-		))
+		with self.store.retention_lock:
+			self._remove_old_ushelfs(policy)
+
+		# Even if nothing is removed, there may be leftovers in trash from previous runs.
+		if os.path.isdir(os.path.join(self.local_store_dir, TRASH_NOD)):
+			if self._prune_workers>0:
+				self.store.start_pruning(self._prune_workers)
+			else:
+				self.masterlogI("Old backups are left in %s, run `irsync prune-trash` to delete them."%(TRASH_NOD))
+
+	def _remove_old_ushelfs(self, policy):
+		if policy.old_seconds>0:
+			self.masterlogI("User requests removing backups older than %d days, %d hours, %d minutes."%(
+				Seconds_to_DHMS(policy.old_seconds)[0:3]
+			))
+		if is_gfs_policy(policy):
+			self.masterlogI("User requests keeping %d hourly, %d daily, %d weekly, %d monthly backups per shelf."%(
+				policy.keep_hourly, policy.keep_daily, policy.keep_weekly, policy.keep_monthly))
+		if policy.min_free_percent>0:
+			self.masterlogI("User requests keeping %g%% of the filesystem free."%(policy.min_free_percent))
 
 		# Special: For dirpaths recorded in [last_success_dirpath], I will not remove them even if "outdated",
 		# bcz they are precious for later incremental backups.
 		#
-		last_success_dirpaths = IniEnumSectionItems(self.ini_filepath, INISEC_last_success_dirpath)
-		last_success_abspaths = [os.path.abspath(p) for p in last_success_dirpaths]
-
-		delete_count = 0
-		uesec_new = int(time.time())
-		for uesec_history, dirpath_history in self.y_find_existing_ushelf():
-			seconds_old = uesec_new - uesec_history
-			if seconds_old > sec_keep:
-				str_DHM = "{} days, {} hours, {} minutes".format(*Seconds_to_DHMS(seconds_old)[0:3])
-
-				if os.path.abspath(dirpath_history) in last_success_abspaths:
-					self.masterlogI("""Seeing old backup at: (created %s ago (%d seconds stale))
+		protected = get_last_success_dirpaths(self.local_store_dir)
+
+		self.ensure_catalog()
+		items = []
+		for item in self.catalog.list_ushelfs():
+			if os.path.isdir(self.abspath(item.dirpath_rela)):
+				items.append(item)
+			elif not self._is_retention_dry_run:
+				self.masterlogW("""Old backup recorded in catalog has disappeared, forget it:
+    %s"""%(self.abspath(item.dirpath_rela)))
+				self.catalog.remove_ushelf(item.dirpath_rela)
+
+		uesec_now = int(time.time())
+		try:
+			plan = plan_retention(self.local_store_dir, items, protected, policy, uesec_now,
+				need_gains=self._is_retention_dry_run)
+		except OSError as e:
+			self.masterlogW("Cannot work out which old backups to remove, leaving them alone this time. %s"%(str(e)))
+			return
+
+		for item in plan.spared:
+			seconds_old = uesec_now - item.uesec
+			str_DHM = "{} days, {} hours, {} minutes".format(*Seconds_to_DHMS(seconds_old)[0:3])
+			self.masterlogI("""Seeing old backup at: (created %s ago (%d seconds stale))
     %s
 --but do not remove it because it is recorded in %s as last-success (precious for later incremental backup)."""%(
-						str_DHM, seconds_old,
-						dirpath_history,
-						ININAM_irsync_master
-					))
-				else:
-					self.masterlogI("""Removing old backup at: (created %s ago (%d seconds stale))
-    %s"""%(str_DHM, seconds_old, dirpath_history))
+				str_DHM, seconds_old,
+				self.abspath(item.dirpath_rela),
+				ININAM_irsync_master
+			))
+
+		if plan.trash_bytes>0:
+			self.masterlogI("Trash has %d bytes that pruning will free, counted as free space already."%(plan.trash_bytes))
+		if plan.need_bytes>0:
+			freed = sum(cand.reclaim_bytes for cand in plan.candidates)
+			self.masterlogI("Filesystem has %.1f GB free of %.1f GB, %d more bytes wanted, removing %d backups frees %d bytes."%(
+				plan.free_bytes/1e9, plan.total_bytes/1e9, plan.need_bytes, len(plan.candidates), freed))
+			if freed < plan.need_bytes:
+				self.masterlogW("Free space target cannot be reached by removing old backups.")
+
+		if self._is_retention_dry_run:
+			for cand in plan.candidates:
+				self.masterlogI("[dry-run] Would remove old backup: %s"%(getmsg_retention_candidate(cand, uesec_now)))
+			if not plan.candidates:
+				self.masterlogI("[dry-run] No existing backups would be removed.")
+			return
 
-					shutil.rmtree(dirpath_history)
-					delete_count +=1
-					RemoveDir_IfEmpty(dirpath_history)
+		for cand in plan.candidates:
+			dirpath_history = self.abspath(cand.dirpath_rela)
+			self.masterlogI("""Removing old backup: %s
+    %s"""%(getmsg_retention_candidate(cand, uesec_now), dirpath_history))
 
-		if delete_count==0:
+			# Forget it in catalog first. If we fail halfway, a partially deleted ushelf
+			# should not be considered a valid backup any more.
+			self.catalog.remove_ushelf(cand.dirpath_rela)
+			self.forget_dedup_rows(cand.dirpath_rela)
+
+			# Just move it into trash now, real deleting is done in background, see remove_old_ushelfs().
+			move_to_trash(self.local_store_dir, dirpath_history)
+			RemoveDir_IfEmpty(dirpath_history)
+
+		if not plan.candidates:
 			self.masterlogI("No existing backups are stale, leaving them alone this time.")
 
 
@@ -482,7 +843,8 @@ Check session log file for details:
 
 		# Remove outdated ushelf dirs (remove old backups).
 		#
-		self.remove_old_ushelfs()
+		with self.phase_timer.span('retention'):
+			self.remove_old_ushelfs()
 
 		# Create session logging filename and save its handle. If error, raise exception.
 		#
@@ -526,7 +888,9 @@ Check session log file for details:
 		            targets=cls.logtarget_file  # so that this excpt_text does not print to console
 			        )
 			l2f(excpt_text)
+			l2f(getmsg_phase_seconds(self.phase_timer.totals()))
 			l2f(self.getmsg_report_time_cost(False))
+			self.save_session_stats(False)
 
 		sesslogI("run_irsync_session_once() start.")
 
@@ -537,38 +901,69 @@ Check session log file for details:
 		with LiveFence( sess_excpt_section ):
 			# Check whether last-success dir exists
 			#
-			last_succ_dirpath = ReadIniItem(self.ini_filepath, INISEC_last_success_dirpath, self.ushelf_name)
-			if last_succ_dirpath:
-				if os.path.isdir(last_succ_dirpath):
-					sesslogI('Accelerate with last-success dirpath: "%s"'%(last_succ_dirpath))
-				else:
-					sesslogW('INI recorded last-success dirpath NOT exists: "%s"'%(last_succ_dirpath))
-					last_succ_dirpath = ""
-
-			os.makedirs(self.working_dirpath, exist_ok=True)
-
-			now_retry = 0
-			while True:
-				try:
-					self.call_rsync_subprocess_once(sess_logfile, sess_logger, last_succ_dirpath)
-					break # bcz we succeeded
-				except Err_rsync_exec:
-					now_retry += 1
-
-					if now_retry > self._max_retry:
-						if self._max_retry > 0:
-							sesslogE("The rsync retrying count %d all exhausted."%(self._max_retry))
-						raise # failure
-
-					sesslogW("Retrying rsync subprocess %d/%d ..."%(now_retry, self._max_retry))
-					time.sleep(1.0)
+			with self.phase_timer.span('preflight'):
+				last_succ_dirpath = ReadIniItem(self.ini_filepath, INISEC_last_success_dirpath, self.ushelf_name)
+				if last_succ_dirpath:
+					if os.path.isdir(last_succ_dirpath):
+						sesslogI('Accelerate with last-success dirpath: "%s"'%(last_succ_dirpath))
+					else:
+						sesslogW('INI recorded last-success dirpath NOT exists: "%s"'%(last_succ_dirpath))
+						last_succ_dirpath = ""
+
+				link_dest_dirpaths = self.select_link_dest_dirpaths(last_succ_dirpath)
+				if len(link_dest_dirpaths)>1:
+					sesslogI("Also accelerate with %d older backups:\n%s"%(len(link_dest_dirpaths)-1,
+						'\n'.join(['    "%s"'%(p) for p in link_dest_dirpaths[1:]])))
+
+				os.makedirs(self.working_dirpath, exist_ok=True)
+
+			self._rsync_attempts = [] # statistics of each rsync run, see save_session_stats()
+			self._shard_plan = None # for --shards, made on first rsync run
+			if self._bandwidth:
+				bwlimit_kbps = self._bandwidth.register()
+				sesslogI("Bandwidth budget %d KB/s is shared by %d sessions, rsync gets --bwlimit=%d ."%(
+					self._bandwidth.budget_kbps, self._bandwidth.sessions, bwlimit_kbps))
+			try:
+				now_retry = 0
+				while True:
+					self._now_retry = now_retry
+					try:
+						watcher = self.call_rsync_subprocess_once(sess_logfile, sess_logger, link_dest_dirpaths)
+						break # bcz we succeeded
+					except Err_rsync_exec:
+						if self._bandwidth and self._bandwidth.take_restart():
+							# Not a failure, rsync was stopped to take a new share of the budget.
+							sesslogI("Bandwidth budget is now shared by %d sessions, restarting rsync with --bwlimit=%d ."%(
+								self._bandwidth.sessions, self._bandwidth.bwlimit_kbps))
+							continue
+
+						now_retry += 1
+
+						if now_retry > self._max_retry:
+							if self._max_retry > 0:
+								sesslogE("The rsync retrying count %d all exhausted."%(self._max_retry))
+							raise # failure
+
+						wait_seconds = self.get_retry_wait_seconds(now_retry)
+						if self._rsync_attempts: # none if sharding fails before running rsync
+							self._rsync_attempts[-1]['retry_wait_seconds'] = round(wait_seconds, 3)
+						sesslogW("Retrying rsync subprocess %d/%d after %.1f seconds ..."%(
+							now_retry, self._max_retry, wait_seconds))
+						with self.phase_timer.span('retry_wait'):
+							time.sleep(wait_seconds)
+			finally:
+				if self._bandwidth:
+					self._bandwidth.unregister()
+
+			sesslogI(getmsg_phase_seconds(self.phase_timer.totals()))
 
 		sess_logfh.close()
 
 		# In the actual ushelf dir, create backup_done.ini to record this ushelf's finish time,
 		# for later stale checking(gets deleted when it becomes too old).
 		#
-		self.ushelf_record_finish_timestamp()
+		with self.phase_timer.span('finish_record'):
+			self.ushelf_record_finish_timestamp(watcher.total_file_size)
 
 		self._sess_logfile = sess_logfile_success # it changed due to the finish-dir rename
 
@@ -577,95 +972,126 @@ Check session log file for details:
 
 
 	def ushelf_finishing(self):
+		# The previous generation, before we record this one as last-success.
+		prev_dirpath_rela = ReadIniItem(self.ini_filepath, INISEC_last_success_dirpath, self.ushelf_name)
+
 		# Move/Rename this ushelf's .working dir to its finish-dir. So to claim backup success.
 		#
-		self.ushelf_rename_to_finish_dir()
+		with self.phase_timer.span('finish_rename'):
+			self.ushelf_rename_to_finish_dir()
 
-		# Associate this ushelf name to this finish-dir in irsync.ini, so that on next run, we can do
-		# incremental backup over this existing ushelf content.
-		#
-		self.ushelf_record_last_finish_dir()
+		with self.phase_timer.span('finish_index'):
+			self.ushelf_record_catalog()
 
-		# Record this finish-dir to foo.txt in favor of cmdline parameter --finish-dir-write-to=foo.txt .
-		#
-		self.record_finish_dir_by_user()
+			# Associate this ushelf name to this finish-dir in irsync.ini, so that on next run, we can do
+			# incremental backup over this existing ushelf content.
+			#
+			self.ushelf_record_last_finish_dir()
+
+			# Record this finish-dir to foo.txt in favor of cmdline parameter --finish-dir-write-to=foo.txt .
+			#
+			self.record_finish_dir_by_user()
+
+		with self.phase_timer.span('dedup'):
+			self.ushelf_dedup()
+
+		# After dedup, bcz dedup changes inodes.
+		with self.phase_timer.span('manifest'):
+			self.ushelf_write_manifest(prev_dirpath_rela)
 
 		self.irsync_report_new_success(self._sess_logfile)
 
+		self.save_session_stats(True)
+
+		self.masterlogI(getmsg_phase_seconds(self.phase_timer.totals()))
 		self.masterlogI(self.getmsg_report_time_cost(True))
 
 
-	def call_rsync_subprocess_once(self, sess_logfile, sess_logger, last_succ_dirpath):
+	def get_retry_wait_seconds(self, now_retry):
+		"""How long to wait before the now_retry-th retry(1 is the first).
+		Without --retry-resume, it is always 1 second, as before.
+		With --retry-resume, it is exponential backoff with jitter, so that a flapping server is not
+		hammered, but never beyond irsync session time limit.
+		"""
+		if not self._is_retry_resume:
+			return 1.0
+
+		backoff = min(RETRY_BACKOFF_MAX_SECONDS, RETRY_BACKOFF_BASE_SECONDS * 2**(now_retry-1))
+		wait_seconds = random.uniform(backoff/2, backoff) # so that concurrent jobs do not retry in lockstep
 
+		if self.uesec_limit>0:
+			# Leave some time for the retry itself. If no time is left at all,
+			# call_rsync_subprocess_once() will tell it.
+			wait_seconds = max(0, min(wait_seconds, (self.uesec_limit-uesec_now())/2))
+		return wait_seconds
+
+	def get_rsync_run_seconds(self):
+		"""Return the run-time limit for the next rsync subprocess, 0 means no limit.
+		Raise Err_irsync if irsync session time limit has been reached.
+		"""
 		now = uesec_now()
 		if self.uesec_limit>0 and now>=self.uesec_limit:
 			raise Err_irsync("""The rsync subprocess will not run, due to irsync session time limit({} hours, {} minutes, {} seconds).""".format(
 				*Seconds_to_DHMS(self._max_irsync_seconds)[1:4]
 			))
-			raise Err_irsync("Irsync session fail, due to session time limit.")
 
 		rsync_run_secs = self._max_rsync_seconds
 		if self.uesec_limit>0:
 			rsync_run_secs = min(self._max_rsync_seconds, self.uesec_limit-now)
+		return rsync_run_secs
 
-		# [2024-07-14] Ensure that server-side file list is NOT empty.
-		#
-		rsync_argv = ["rsync", "--list-only", self.rsync_url]
-		exclude_opt = self.extract_exclude_opt()
-		if exclude_opt:
-			rsync_argv.append(exclude_opt)
-		rsync_cmd_list = glueup_shell_cmd(rsync_argv)
-		(exitcode, output, _) = run_exe_grab_output_with_timeout(rsync_argv, 5, {"shell": False})
-		if exitcode != 0 :
-			sess_logger.log(MsgLevel.err.value, """The rsync command:
-    %s
-fails with following output:
-%s"""
-							%(rsync_cmd_list, output))
-			raise Err_rsync_exec(exitcode, self.ushelf_name)  # The caller may retry rsync.exe later
-		else:
-			direntries = output.splitlines()
-			if len(direntries) <= 1:
-				# The only entry is destined to be ".", meaning "this directory".
-				# This can happen when:
-				# * server-side is a WSL1 instance, and source path is /mnt/k,
-				# * server-side K: drive is a portable USB-SDD,
-				# * that USB-SDD is unplugged then replugged in,
-				# Now, WSL1 instance `ls /mnt/k` will get empty result, so the WSL1
-				# loses access to all files in K: drive.
-				# In this case, irsync should not pretend that the rsync transfer is successful.
-				#
-				# To recover, (server-side) Windows user has to shutdown and restart the WSL1 instance.
-				raise Err_rsync_exec(44, self.ushelf_name, "Server side has no files, that is abnormal.")
-
-
-
-		line_sep78 = '=' * 78
-		#
-		# Prepare rsync subprocess parameters...
-		# and we'll use argv[] to spawn subprocess, not bothering sh/bash command line.
+	def make_rsync_argv(self, link_dest_dirpaths, bw_divisor=1):
+		"""Prepare rsync subprocess parameters, except rsync-source and rsync-destination.
+		We'll use argv[] to spawn subprocess, not bothering sh/bash command line.
+		bw_divisor: for --bw-budget-kbps, how many rsync processes run with this argv at once(--shards).
+		"""
+		# --stats: its "Number of files:" tells us whether server-side file list is empty,
+		# see RsyncOutputWatcher.
 		#
-		rsync_argv = ["rsync", "-av"]
+		rsync_argv = ["rsync", "-av", "--stats"]
 
-		if last_succ_dirpath:
+		for link_dest_dirpath in link_dest_dirpaths:
 			# No need to surround the path with quotes, even if it contains spaces, bcz we will use shell=False.
 			# And we must pass abspath to --link-dest= bcz relative path means differently to rsync.
-			rsync_argv.append('--link-dest=%s' % (self.abspath(last_succ_dirpath)))
+			# rsync searches them in the order given, so the most recent goes first.
+			rsync_argv.append('--link-dest=%s' % (self.abspath(link_dest_dirpath)))
+
+		if self._is_partial_dir_managed:
+			# Keep an interrupted file in .irsync-partial, so that the retry resumes it(rsync uses it as
+			# the basis file, only the rest is transferred), instead of starting it all over again.
+			rsync_argv.append('--partial-dir=%s'%(RSYNC_PARTIAL_DIR))
+
+		if self._bandwidth:
+			rsync_argv.append('--bwlimit=%d'%(max(1, self._bandwidth.bwlimit_kbps//bw_divisor)))
 
 		if self._rsync_extra_params:
 			rsync_argv.extend(self._rsync_extra_params)
 
-		# Finally, append rsync-source and rsync-destination
-		rsync_argv.extend([self.rsync_url, self.working_dirpath])
+		return rsync_argv
 
-		# Create logfile for rsync-subprocess's console output message.
-		#
-		# If irsync session logfile(sess_logfile) is 20200414.run0.log,
-		# We will create rsync logfile with pattern 20200414.run0.rsync*.log ,
-		# so that we know the "...rsync0.log", "...rsync1.log" belongs to run0.
-		#
-		rsync_logfile_pattern = '.rsync*'.join(os.path.splitext(sess_logfile))
+	def open_rsync_logfile(self, sess_logfile, sess_logger, rsync_argv, rsync_run_secs, name_infix=''):
+		"""Create logfile for rsync-subprocess's console output message, and log the launching.
+		Return (fp_rsync, fh_rsync). Write rsync output to fh_rsync.buffer from now on.
+
+		If irsync session logfile(sess_logfile) is 20200414.run0.log,
+		We will create rsync logfile with pattern 20200414.run0.rsync*.log ,
+		so that we know the "...rsync0.log", "...rsync1.log" belongs to run0.
+		For a sharded transfer, name_infix is like ".shard1", so that we get 20200414.run0.shard1.rsync0.log .
+		With --rsync-log-compress, it is 20200414.run0.rsync0.log.gz(or .zst), compressed as it is written.
+		"""
+		line_sep78 = '=' * 78
+
+		rsync_logfile_pattern = (name_infix+'.rsync*').join(os.path.splitext(sess_logfile))
+		method = self._rsync_log_compress
+		if method:
+			rsync_logfile_pattern += COMPRESS_SUFFIX[method]
 		fp_rsync, fh_rsync = create_logfile_with_seq(os.path.join(self.working_dirpath, rsync_logfile_pattern))
+		if method:
+			# create_logfile_with_seq() has reserved the filename for us, now write it compressed.
+			# fh_rsync.buffer is then the compressing stream, so the output pump compresses rsync output
+			# chunk by chunk, never holding more than a chunk in memory.
+			fh_rsync.close()
+			fh_rsync = open_compressed(fp_rsync, "wt", method, STREAM_GZIP_LEVEL)
 
 		# Construct subprocess startup log text:
 		argv_hint_lines = ["{0}argv[{1}] = {2}".format(' ' * 8, i, s) for i, s in enumerate(rsync_argv)]
@@ -694,34 +1120,262 @@ fails with following output:
 		#
 #		raise ValueError('Hehe, DELIBERATE RAISE ERROR HERE.') # debugging purpose
 
-		(exitcode, kill_at_uesec) = run_exe_log_output_and_print(
-			rsync_argv, rsync_run_secs, {"shell": False}, fh_rsync)
+		# rsync output goes to fh_rsync as raw bytes from now on.
+		fh_rsync.flush()
+		return fp_rsync, fh_rsync
+
+	def get_pump_on_tick(self):
+		"""The on_tick for run_exe_pump_output(): keep our share of --bw-budget-kbps up to date."""
+		return self._bandwidth.on_tick if self._bandwidth else None
+
+	def is_bw_restart_pending(self):
+		return bool(self._bandwidth) and self._bandwidth.restart_pending
+
+	def record_rsync_attempt(self, fp_rsync, exitcode, uesec_rsync_start, rsync_seconds, kill_at_uesec, watcher,
+			**extra):
+		attempt = dict(
+			rsync_logfile = os.path.basename(fp_rsync),
+			exitcode = exitcode,
+			uesec_start = int(uesec_rsync_start),
+			elapsed_seconds = round(rsync_seconds, 3),
+			is_killed = kill_at_uesec>0,
+			**watcher.to_dict()
+		)
+		attempt.update(extra)
+		if watcher.unparsed_lines:
+			self.masterlogW("Cannot parse numbers in rsync output, they are left unknown(-1). From %s:\n    %s"%(
+				os.path.basename(fp_rsync), "\n    ".join(watcher.unparsed_lines)))
+		if self._bandwidth:
+			attempt['bwlimit_kbps'] = self._bandwidth.bwlimit_kbps
+			attempt['bw_restart'] = self._bandwidth.restart_pending
+		if self._now_retry>0 and watcher.matched_data>=0:
+			attempt['retry_done_bytes'], attempt['retry_saved_bytes'] = self.get_retry_saving(watcher, extra.get('shard'))
+		self._rsync_attempts.append(attempt)
+
+	def get_retry_saving(self, watcher, shard=None):
+		"""Return (done_bytes, saved_bytes) of a retry, see log_retry_saving(). done_bytes is -1 if unknown.
+		Must be called before this attempt is added to self._rsync_attempts .
+		"""
+		prevs = [attempt for attempt in self._rsync_attempts if attempt.get('shard')==shard]
+		prev_size = prevs[-1]['total_transferred_size'] if prevs else -1
+		if prev_size<0 or watcher.total_transferred_size<0:
+			return -1, watcher.matched_data
+		done_bytes = max(0, prev_size - watcher.total_transferred_size)
+		return done_bytes, done_bytes + watcher.matched_data
+
+	def call_rsync_subprocess_once(self, sess_logfile, sess_logger, link_dest_dirpaths):
+		with self.phase_timer.span('rsync_retry' if self._now_retry>0 else 'rsync'):
+			return self._call_rsync_subprocess_once(sess_logfile, sess_logger, link_dest_dirpaths)
 
-		if exitcode == 0:
-			sess_logger.log(MsgLevel.info.value, "rsync run success.")
-		else:
-			if kill_at_uesec > 0:
-				kill_msg = "rsync max run-time limit exceeded. Kill signal has been issued at %s ." % (
-					datetime_str_by_uesec(kill_at_uesec)
-				)
-				sess_logger.log(MsgLevel.err.value, kill_msg)
+	def _call_rsync_subprocess_once(self, sess_logfile, sess_logger, link_dest_dirpaths):
 
-			# Use .err(instead of .err_raise) here, bcz I do not consider it FINAL error.
-			#
-			sess_logger.log(MsgLevel.err.value, """rsync run fail, exitcode=%d
-    To know detailed reason. Check rsync console message at:
-        %s""" % (exitcode, fp_rsync))
+		rsync_run_secs = self.get_rsync_run_seconds()
 
-			raise Err_rsync_exec(exitcode, self.ushelf_name)  # The caller may retry rsync.exe later
+		if self._shards>1:
+			return self.call_rsync_shards_once(sess_logfile, sess_logger, link_dest_dirpaths, rsync_run_secs)
 
+		# Finally, append rsync-source and rsync-destination
+		rsync_argv = self.make_rsync_argv(link_dest_dirpaths) + [self.rsync_url, self.working_dirpath]
+
+		fp_rsync, fh_rsync = self.open_rsync_logfile(sess_logfile, sess_logger, rsync_argv, rsync_run_secs)
+
+		watcher = RsyncOutputWatcher()
+		uesec_rsync_start = time.time()
+		(exitcode, kill_at_uesec) = run_exe_pump_output(
+			rsync_argv, rsync_run_secs, {"shell": False, "env": rsync_child_env()}, fh_rsync.buffer, watcher,
+			ConsoleEcho(self._console_echo), self.get_pump_on_tick())
+		rsync_seconds = time.time() - uesec_rsync_start
 		fh_rsync.close()
 
+		self.record_rsync_attempt(fp_rsync, exitcode, uesec_rsync_start, rsync_seconds, kill_at_uesec, watcher)
+
+		if self._now_retry>0:
+			self.log_retry_saving(sess_logger, self._rsync_attempts[-1:])
+
+		if exitcode != 0:
+			if self.is_bw_restart_pending():
+				sess_logger.log(MsgLevel.info.value, "rsync stopped for a new bandwidth share.")
+			else:
+				self.log_rsync_fail(sess_logger, exitcode, kill_at_uesec, fp_rsync)
+			raise Err_rsync_exec(exitcode, self.ushelf_name)  # The caller may retry rsync.exe later
+
+		# [2024-07-14] Ensure that server-side file list is NOT empty.
+		# We used to check it with a separate `rsync --list-only` run before the transfer,
+		# now we get it from the --stats of this very run, saving a connection to the server.
+		#
+		if watcher.is_source_empty:
+			self.log_rsync_source_empty(sess_logger)
+
+		self.log_rsync_success(sess_logger, watcher, link_dest_dirpaths, rsync_seconds)
+		return watcher
+
+	def call_rsync_shards_once(self, sess_logfile, sess_logger, link_dest_dirpaths, rsync_run_secs):
+		"""Like call_rsync_subprocess_once(), but for --shards: run one rsync per shard concurrently,
+		all into self.working_dirpath . Return the merged RsyncOutputWatcher of all shards.
+		On a retry, only the shards that have not succeeded run again.
+		"""
+		if self._shard_plan is None:
+			with self.phase_timer.span('preflight'):
+				self._shard_plan = self.make_shard_plan(sess_logfile, sess_logger, link_dest_dirpaths)
+			self._shard_watchers = {} # shard index -> RsyncOutputWatcher of its successful run
+
+		shards_todo = [shard for shard in self._shard_plan if shard.index not in self._shard_watchers]
+
+		base_argv = self.make_rsync_argv(link_dest_dirpaths, len(shards_todo))
+		runs = []
+		for shard in shards_todo:
+			# -a does not imply -r when --files-from is given.
+			rsync_argv = base_argv + ['-r', '--from0', '--files-from=%s'%(self.shard_listfile(sess_logfile, shard.index)),
+				self.rsync_url, self.working_dirpath]
+			fp_rsync, fh_rsync = self.open_rsync_logfile(sess_logfile, sess_logger, rsync_argv, rsync_run_secs,
+				'.shard%d'%(shard.index))
+			runs.append((shard, rsync_argv, fp_rsync, fh_rsync, RsyncOutputWatcher()))
+
+		# Full output of several rsync interleaved on console is of no use, so show a summary at least.
+		echo_mode = 'summary' if self._console_echo=='full' else self._console_echo
+
+		async def run_one(shard, rsync_argv, fh_rsync, watcher):
+			uesec_start = time.time()
+			(exitcode, kill_at_uesec) = await run_exe_pump_output_async(
+				rsync_argv, rsync_run_secs, {"shell": False, "env": rsync_child_env()}, fh_rsync.buffer, watcher,
+				ConsoleEcho(echo_mode, name='rsync-shard%d'%(shard.index)), self.get_pump_on_tick())
+			return (exitcode, kill_at_uesec, uesec_start, time.time()-uesec_start)
+
+		async def run_all():
+			return await asyncio.gather(*[run_one(shard, rsync_argv, fh_rsync, watcher)
+				for shard, rsync_argv, fp_rsync, fh_rsync, watcher in runs])
+
+		uesec_rsync_start = time.time()
+		results = asyncio.run(run_all()) # one event loop supervises all rsync subprocesses, no thread per rsync
+		rsync_seconds = time.time() - uesec_rsync_start
+
+		lines = ["%d rsync shards ended in %.1f seconds:"%(len(runs), rsync_seconds)]
+		failures = []
+		for (shard, rsync_argv, fp_rsync, fh_rsync, watcher), (exitcode, kill_at_uesec, uesec_start, seconds) in zip(runs, results):
+			fh_rsync.close()
+			self.record_rsync_attempt(fp_rsync, exitcode, uesec_start, seconds, kill_at_uesec, watcher, shard=shard.index)
+			lines.append("    shard%d: exitcode=%d, %d files considered, %d literal bytes, %.1f seconds, log: %s"%(
+				shard.index, exitcode, watcher.num_files, watcher.literal_data, seconds, os.path.basename(fp_rsync)))
+			if exitcode==0:
+				self._shard_watchers[shard.index] = watcher
+			else:
+				failures.append((exitcode, kill_at_uesec, fp_rsync))
+		sess_logger.log(MsgLevel.info.value, '\n'.join(lines))
+
+		if self._now_retry>0:
+			self.log_retry_saving(sess_logger, self._rsync_attempts[-len(runs):])
+
+		for exitcode, kill_at_uesec, fp_rsync in failures:
+			if self.is_bw_restart_pending():
+				break # all shards stopped for a new bandwidth share, not failed
+			self.log_rsync_fail(sess_logger, exitcode, kill_at_uesec, fp_rsync)
+		if failures:
+			raise Err_rsync_exec(failures[0][0], self.ushelf_name, "%d of %d shards fail."%(
+				len(failures), len(self._shard_plan)))
+
+		watcher = RsyncOutputWatcher.merged(self._shard_watchers.values())
+		self.log_rsync_success(sess_logger, watcher, link_dest_dirpaths, rsync_seconds)
+		return watcher
+
+	def make_shard_plan(self, sess_logfile, sess_logger, link_dest_dirpaths):
+		"""Split top-level entries of rsync_url into shards, and write their --files-from lists.
+		Return a list of Shard.
+		"""
+		from .shards import list_toplevel_entries, estimate_entry_sizes, balance_shards, write_files_from
+		try:
+			entries = list_toplevel_entries(self.rsync_url, self._rsync_extra_params)
+		except Err_irsync as e:
+			sess_logger.log(MsgLevel.err.value, e.errmsg)
+			raise Err_rsync_exec(e.errcode, self.ushelf_name, "Cannot list top-level entries for sharding.")
+
+		if not entries:
+			self.log_rsync_source_empty(sess_logger)
+
+		# The most recent backup(--link-dest) is the best guess of directory sizes.
+		prev_dirpath = self.abspath(link_dest_dirpaths[0]) if link_dest_dirpaths else None
+		entries = estimate_entry_sizes(entries, prev_dirpath, self._shards)
+		shards = balance_shards(entries, self._shards)
+
+		for shard in shards:
+			write_files_from(self.shard_listfile(sess_logfile, shard.index), shard.names)
+
+		sess_logger.log(MsgLevel.info.value, "Sharded transfer, %d top-level entries in %d shards(sizes from %s):\n%s"%(
+			len(entries), len(shards), '"%s"'%(prev_dirpath) if prev_dirpath else "rsync --list-only",
+			'\n'.join(["    shard%d: %d entries, about %d bytes"%(shard.index, len(shard.names), shard.size)
+				for shard in shards])))
+		return shards
+
+	def shard_listfile(self, sess_logfile, shard_index):
+		# 20200414.run0.log -> 20200414.run0.shard1.files
+		return "%s.shard%d.files"%(os.path.splitext(sess_logfile)[0], shard_index)
+
+	def log_rsync_source_empty(self, sess_logger):
+		# The only entry is destined to be ".", meaning "this directory".
+		# This can happen when:
+		# * server-side is a WSL1 instance, and source path is /mnt/k,
+		# * server-side K: drive is a portable USB-SDD,
+		# * that USB-SDD is unplugged then replugged in,
+		# Now, WSL1 instance `ls /mnt/k` will get empty result, so the WSL1
+		# loses access to all files in K: drive.
+		# In this case, irsync should not pretend that the rsync transfer is successful.
+		#
+		# To recover, (server-side) Windows user has to shutdown and restart the WSL1 instance.
+		sess_logger.log(MsgLevel.err.value, "rsync reports that server side has no files.")
+		raise Err_rsync_exec(44, self.ushelf_name, "Server side has no files, that is abnormal.")
+
+	def log_rsync_success(self, sess_logger, watcher, link_dest_dirpaths, rsync_seconds):
+		sess_logger.log(MsgLevel.info.value, """rsync run success. Statistics:
+    Files considered: %d, regular files transferred: %d
+    Literal data: %d bytes, matched data: %d bytes, speedup: %s
+    Elapsed: %.1f seconds"""%(
+			watcher.num_files, watcher.num_reg_transferred,
+			watcher.literal_data, watcher.matched_data, watcher.speedup,
+			rsync_seconds))
+		if link_dest_dirpaths and watcher.num_reg_files>=0 and watcher.num_reg_transferred>=0:
+			sess_logger.log(MsgLevel.info.value, """Hardlink saving by --link-dest:
+    %d of %d regular files not transferred (hardlinked or already there).
+    %d of %d bytes not transferred."""%(
+				watcher.num_reg_files-watcher.num_reg_transferred, watcher.num_reg_files,
+				watcher.total_file_size-watcher.total_transferred_size, watcher.total_file_size))
+
+	def log_rsync_fail(self, sess_logger, exitcode, kill_at_uesec, fp_rsync):
+		if kill_at_uesec > 0:
+			kill_msg = "rsync max run-time limit exceeded. Kill signal has been issued at %s ." % (
+				datetime_str_by_uesec(kill_at_uesec)
+			)
+			sess_logger.log(MsgLevel.err.value, kill_msg)
+
+		# Use .err(instead of .err_raise) here, bcz I do not consider it FINAL error.
+		#
+		sess_logger.log(MsgLevel.err.value, """rsync run fail, exitcode=%d
+    To know detailed reason. Check rsync console message at:
+        %s""" % (exitcode, fp_rsync))
+
+	def log_retry_saving(self, sess_logger, attempts):
+		"""For a retry, tell how many bytes did not have to be transferred again, thanks to what the
+		previous attempt has left in .working dir:
+		* files it completed: its "Total transferred file size" minus this attempt's.
+		* partial files(--retry-resume) used as basis: this attempt's "Matched data", which also has
+		  delta against old backups, if any.
+		Files hardlinked by --link-dest are not counted, the first attempt did not transfer them either.
+		The numbers are only available if rsync lives to print its --stats; if the previous attempt
+		did not, only matched data is counted.
+
+		attempts: records of this retry's rsync runs(one per shard with --shards), see record_rsync_attempt().
+		"""
+		attempts = [attempt for attempt in attempts if 'retry_saved_bytes' in attempt]
+		if not attempts:
+			return
+		lines = ["Retry #%d saving: %d bytes not transferred again."%(
+			self._now_retry, sum(attempt['retry_saved_bytes'] for attempt in attempts))]
+		for attempt in attempts:
+			done_text = "%d bytes"%(attempt['retry_done_bytes']) if attempt['retry_done_bytes']>=0 else "unknown"
+			lines.append("    %s%s of files completed by previous attempt, %d bytes matched data(resumed partial files, "
+				"or delta against old backups), %d bytes literal data transferred."%(
+				"shard%d: "%(attempt['shard']) if 'shard' in attempt else "",
+				done_text, attempt['matched_data'], attempt['literal_data']))
+		sess_logger.log(MsgLevel.info.value, '\n'.join(lines))
 
-	def extract_exclude_opt(self):
-		for param in self._rsync_extra_params:
-			if param.startswith("--exclude-from"):
-				return param
-		return ""
 
 def _check_rsync_url(rsync_src):
 	"""Check rsync url format validity.
@@ -743,22 +1397,132 @@ def _check_rsync_url(rsync_src):
 	if rsync_src.strip('/')=='':
 		raise Err_irsync("Error: rsync url cannot be a single / .")
 
-	m1 = re.match("rsync://([^/]+)/(.+)", rsync_src)
-	m2 = os.path.isabs(rsync_src)
-	if m1:
-		# return (server-name, server-path)
-		return m1.group(1), '/'+m1.group(2)
-	elif m2:
-		return 'LOCALHOST', rsync_src
-	else:
+	server_spath = split_rsync_url(rsync_src) # (server-name, server-path)
+	if not server_spath:
 		raise Err_irsync("Error: Wrong rsync url format: %s" % (rsync_src))
+	return server_spath
 	
 
 
-def irsync_fetch_once(apargs, rsync_extra_params):
+def get_last_success_dirpaths(local_store_dir):
+	"""Return set of dirpath_rela recorded in irsync.ini [last_success_dirpath], of all shelves."""
+	ini_filepath = os.path.join(local_store_dir, ININAM_irsync_master)
+	dirpaths = IniEnumSectionItems(ini_filepath, INISEC_last_success_dirpath)
+	# Recorded relative to local_store_dir(an absolute one is also accepted).
+	return {os.path.relpath(os.path.join(local_store_dir, p), local_store_dir) for p in dirpaths}
+
+def read_sess_done_ini(ini_filepath, dirpath_rela):
+	"""Read a finished ushelf's _irsync_backup_done.ini, return a CatalogItem, or None if invalid."""
+	uesec_str = ReadIniItem(ini_filepath, INISEC_sess_done, INIKEY_utc)
+	size_str = ReadIniItem(ini_filepath, INISEC_sess_done, INIKEY_size)
+	try:
+		uesec = int(uesec_str)
+		size = int(size_str) if size_str else -1
+	except ValueError:
+		return None
+
+	vault, ushelf = os.path.split(dirpath_rela)
+	return CatalogItem(dirpath_rela, vault, ushelf, uesec, size)
+
+def y_walk_finished_ushelfs(local_store_dir):
+	"""Walk local_store_dir to find historical finished ushelf directories, yield CatalogItem for each.
+	This is slow for a big local_store_dir, so it is only used to (re)build the catalog.
+	"""
+	# Existence of a _irsync_backup_done.ini file identifies a historical finished ushelf directory.
+	# And, I will check that ini only in second-depth subdirs from local_store_dir.
+	root_start = local_store_dir
+	for root, dirs, files in os.walk(root_start):
+		if root==root_start and TRASH_NOD in dirs:
+			dirs.remove(TRASH_NOD) # doomed ushelfs are no longer valid backups
+
+		dirnods = root.replace(root_start, '$', 1) # strip root_start prefix, use '$' to denote root
+#		print('dirnods='+dirnods) # debug
+		if(dirnods.count(os.sep)==2):
+			# now we are at the a second-depth subdir
+			if ININAM_sess_done in files:
+				item = read_sess_done_ini(os.path.join(root, ININAM_sess_done),
+				                          os.path.relpath(root, root_start))
+				if item:
+#					print("%d @ %s" % (item.uesec, root)) # debug
+					yield item
+
+			dirs.clear()    # so will not descend any further
+
+def irsync_dedup_cmd(argv):
+	ap = argparse.ArgumentParser(prog="irsync dedup",
+		description="Hardlink identical files across all finished backups in a local_store_dir, "
+			"the same as what --dedup does for each new backup. Use it once before you start using --dedup.")
+	ap.add_argument('local_store_dir', type=str)
+	apargs = ap.parse_args(argv)
+
+	from .dedup import DedupIndex, getmsg_dedup_stats
+	from .space import drop_cache as drop_space_cache
+
+	local_store_dir = os.path.abspath(apargs.local_store_dir)
+	if not os.path.isdir(local_store_dir):
+		print('Error: local_store_dir "%s" does not exist.'%(local_store_dir))
+		return False
+
+	try:
+		store = irsync_store_st(local_store_dir) # so no irsync session is running on it
+		try:
+			catalog = UshelfCatalog(local_store_dir)
+			if not catalog.exists():
+				catalog.rebuild(y_walk_finished_ushelfs(local_store_dir))
+
+			index = DedupIndex(local_store_dir)
+			total_linked = total_reclaimed = 0
+			for item in catalog.list_ushelfs(): # oldest first, so old files are kept as link targets
+				st = index.dedup_tree(os.path.join(local_store_dir, item.dirpath_rela),
+					skip_names=(LOG_NOD, ININAM_sess_done))
+				store.masterlogI("[%s] %s"%(item.dirpath_rela, getmsg_dedup_stats(st)))
+				if st.linked>0:
+					drop_space_cache(local_store_dir, item.dirpath_rela) # its inode list has changed
+				total_linked += st.linked
+				total_reclaimed += st.reclaimed_bytes
+			store.masterlogI("Dedup done. Hardlinked %d files, reclaimed %d bytes (%.1f MB) in total."%(
+				total_linked, total_reclaimed, total_reclaimed/1000000))
+		finally:
+			store.close()
+	except Err_irsync as e:
+		print(e.errmsg)
+		return False
+	except (OSError, sqlite3.Error) as e:
+		print("Error: %s"%(str(e)))
+		return False
+
+	return True
+
+def irsync_catalog_rebuild_cmd(argv):
+	ap = argparse.ArgumentParser(prog="irsync catalog-rebuild",
+		description="Rebuild the backup catalog(%s) of a local_store_dir from its %s files."%(
+			FILENAM_catalog, ININAM_sess_done))
+	ap.add_argument('local_store_dir', type=str)
+	apargs = ap.parse_args(argv)
+
+	local_store_dir = os.path.abspath(apargs.local_store_dir)
+	if not os.path.isdir(local_store_dir):
+		print('Error: local_store_dir "%s" does not exist.'%(local_store_dir))
+		return False
+
+	try:
+		store = irsync_store_st(local_store_dir) # so no irsync session is running on it
+		try:
+			catalog = UshelfCatalog(local_store_dir)
+			count = catalog.rebuild(y_walk_finished_ushelfs(local_store_dir))
+			store.masterlogI("Backup catalog rebuilt with %d finished ushelfs:\n    %s"%(count, catalog.filepath))
+		finally:
+			store.close()
+	except Err_irsync as e:
+		print(e.errmsg)
+		return False
+
+	return True
+
+def irsync_fetch_once(apargs, rsync_extra_params, store=None):
 
 	try:
-		irs = irsync_st(apargs, rsync_extra_params)
+		irs = irsync_st(apargs, rsync_extra_params, store)
 		irs.run_irsync_session_once()
 		return True
 	except Err_irsync as e:
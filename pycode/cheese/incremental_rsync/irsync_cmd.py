@@ -6,19 +6,31 @@ D:\gitw\pyutils> python -m cheese.incremental_rsync.test
 """
 
 import os, sys
-import argparse
-from .share import *
-from .irsync_client import *
-from .irsync_client import _check_rsync_url
+import importlib
+from .fastpath import irsync_quick_done
+
+# Only the fast path above is imported at start. The rest of irsync is imported when really needed,
+# see irsync_cmd().
 
 def non_negative_int(x):
+    import argparse
     i = int(x)
     if i < 0:
         raise argparse.ArgumentTypeError('Negative values are not allowed.')
     return i
 
 def init_irsync_argparser():
-	ap = argparse.ArgumentParser(description="irsync, the incremental rsync wrapper.")
+	import argparse
+	from .share import MsgLevel, ConsoleEcho
+	from .manifest import FILENAM_manifest
+	from .retention import add_retention_arguments
+	from .logrotate import add_log_rotate_arguments, COMPRESS_METHODS
+	from .bandwidth import add_bandwidth_arguments
+
+	ap = argparse.ArgumentParser(description="irsync, the incremental rsync wrapper.",
+		epilog='Sub-commands are also available, run "irsync <subcommand> --help" for detail: %s .'%(
+			', '.join(irsync_subcommands))
+	)
 
 	ap.add_argument('rsync_url', type=str,
 		help='The rsync URL of your backup source, sth like: rsync://server/module/subdir .'
@@ -68,6 +80,50 @@ def init_irsync_argparser():
 		help=argparse.SUPPRESS
 	)
 
+	add_retention_arguments(ap)
+	ap.add_argument('--retention-dry-run', action="store_true", dest='retention_dry_run',
+		help='Only log which old backups the retention options would remove and the bytes each frees, '
+			'remove nothing. The backup itself still runs. `irsync retention` shows the same without a backup.'
+	)
+
+	ap.add_argument('--link-dest-count', type=int, dest='link_dest_count', default=1,
+		help='Use this many recent backups of the same shelf as rsync --link-dest(max 20). '
+			'A file missing in the last backup but present in an older one is then hardlinked '
+			'instead of transferred again. Default is %(default)s.'
+	)
+
+	ap.add_argument('--prune-workers', type=non_negative_int, dest='prune_workers', default=4,
+		help='Old backups are moved into a trash directory at once, then deleted in background by this '
+			'many threads while rsync is running. Default is %(default)s.\n'
+			'If 0, they are left in trash, to be deleted later by `irsync prune-trash`.'
+	)
+
+	ap.add_argument('--shards', type=int, dest='shards', default=1,
+		help='Split top-level entries of the rsync source into this many shards of about equal size, '
+			'and transfer them with as many rsync processes concurrently. Useful when one rsync process '
+			'is CPU-bound and cannot fill a fast link. Default is %(default)s, no sharding.'
+	)
+
+	ap.add_argument('--dedup', action="store_true", dest='dedup',
+		help='After the backup finishes, replace its files with hardlinks to byte-identical files '
+			'in any other backup of this local_store_dir(other shelves included). A content index is kept '
+			'in local_store_dir, so only files new since last time are hashed.'
+	)
+
+	ap.add_argument('--manifest', action="store_true", dest='manifest',
+		help='Write %s into the finished backup, listing path, size, mtime, inode and content hash '
+			'of every file. Files hardlinked to the previous backup take their hash from its manifest, '
+			'so only newly transferred files are read.'%(FILENAM_manifest)
+	)
+
+	ap.add_argument('--console-echo', type=str, dest='console_echo', choices=ConsoleEcho.modes,
+		default='full',
+		help='How rsync output is shown on console(it is always fully recorded in rsync log file). '
+			'"full": every line; "rate": at most some lines per second; "summary": a progress line '
+			'every few seconds. With "rate" and "summary", rsync\'s last lines are shown when it ends. '
+			'Default is "%(default)s".'
+	)
+
 	ap.add_argument('--max-rsync-hours', type=non_negative_int, dest='max_rsync_hours', default=0,
 		help='Assign max hours to run for one rsync subprocess execution.'
 	        'Default value 0 means no time limit, and irsync will wait as long as rsync executes, '
@@ -86,6 +142,12 @@ def init_irsync_argparser():
 	        'Default is 0, meaning irsync will call rsync subprocess only once, no retry.'
 	)
 
+	ap.add_argument('--retry-resume', action="store_true", dest='retry_resume',
+		help='Make retries cheaper. rsync keeps interrupted files in a partial-dir inside the .working dir, '
+			'so that a retry resumes them instead of transferring them from scratch, and retries wait '
+			'with exponential backoff(plus some random jitter) instead of 1 second.'
+	)
+
 	ap.add_argument('--max-irsync-hours', type=non_negative_int, dest='max_irsync_hours', default=0,
 		help='Assign max hours to run for a whole irsync session.\n'
 	        'There is --max-irsync-minutes and --max-irsync-seconds for test purpose.'
@@ -93,6 +155,21 @@ def init_irsync_argparser():
 	ap.add_argument('--max-irsync-minutes', type=int, dest='max_irsync_minutes', default=0, help=argparse.SUPPRESS)
 	ap.add_argument('--max-irsync-seconds', type=int, dest='max_irsync_seconds', default=0, help=argparse.SUPPRESS)
 
+	ap.add_argument('--metrics-dir', type=str, dest='metrics_dir',
+		help='Write time spent in each session phase(retention, rsync, retries, finishing...) and session result '
+			'to irsync-<ushelf>.prom in this directory, in Prometheus text format, for node_exporter\'s '
+			'textfile collector. Phase times are always in the session stats JSON and the logs.'
+	)
+
+	add_log_rotate_arguments(ap)
+	add_bandwidth_arguments(ap)
+	ap.add_argument('--rsync-log-compress', type=str, dest='rsync_log_compress', choices=COMPRESS_METHODS,
+		default='none',
+		help='Compress rsync console output logs(*.rsyncN.log in __logs__ of each backup) while rsync runs, '
+			'they get a .gz or .zst suffix. zstd falls back to gzip if Python has no zstd. '
+			'Read them with `irsync log`. Default is "%(default)s".'
+	)
+
 	ap.add_argument('--finish-dir-write-to', type=str, dest='finish_dir_write_to',
 	    help='This assign a filename. If backup success, the final backup directory(full-path) '
 	        'will be written to this filename, so the caller can know it and do some post actions. '
@@ -121,9 +198,50 @@ def init_irsync_argparser():
 
 	return ap
 
+def split_rsync_extra_params(argv):
+	"""Split "--rsync ..." tail from argv[].
+	Return: tuple ( irsync_argv , rsync_extra_params )
+	"""
+	try:
+		idx_rsync = argv.index('--rsync')
+		return argv[:idx_rsync], argv[idx_rsync+1:] # all eles after the --rsync go to rsync
+	except ValueError:
+		return argv, []
+
+# Sub-commands of irsync. The first word on the command line selects one of them.
+# A real rsync_url never looks like these words, so there is no ambiguity.
+#
+# subcommand-name -> (module-name, function-name)
+# The function receives argv[] after the subcommand word, and returns True on success.
+#
+irsync_subcommands = {
+	'jobs': ('.irsync_jobs', 'irsync_jobs_cmd'),
+	'catalog-rebuild': ('.irsync_client', 'irsync_catalog_rebuild_cmd'),
+	'prune-trash': ('.pruner', 'irsync_prune_trash_cmd'),
+	'dedup': ('.irsync_client', 'irsync_dedup_cmd'),
+	'verify': ('.verify', 'irsync_verify_cmd'),
+	'diff': ('.gendiff', 'irsync_diff_cmd'),
+	'space': ('.space', 'irsync_space_cmd'),
+	'retention': ('.retention', 'irsync_retention_cmd'),
+	'daemon': ('.irsync_daemon', 'irsync_daemon_cmd'),
+	'log': ('.logread', 'irsync_log_cmd'),
+}
+
 def irsync_cmd():
 	"""Irsync command line interface, will use sys.argv[] implicitly. """
 
+	if len(sys.argv)>1 and sys.argv[1] in irsync_subcommands:
+		modname, funcname = irsync_subcommands[sys.argv[1]]
+		module = importlib.import_module(modname, __package__)
+		return getattr(module, funcname)(sys.argv[2:])
+
+	# Most cron invocations end here: the backup has been done already.
+	#
+	if irsync_quick_done(sys.argv[1:]):
+		return True
+
+	from .irsync_client import irsync_fetch_once
+
 	# Warn empty parameter and quit.
 	#
 	ap = init_irsync_argparser()
@@ -135,15 +253,7 @@ def irsync_cmd():
 	# First, scan for "--rsync ..." parameter from command line, and extract it.
 	#
 
-	argv = sys.argv
-	rsync_extra_params = []
-
-	try:
-		idx_rsync = argv.index('--rsync')
-		rsync_extra_params = argv[idx_rsync+1:] # copy all eles after the --rsync
-		argv[idx_rsync:] = [] # trim all eles from after --rsync
-	except ValueError:
-		pass
+	argv, rsync_extra_params = split_rsync_extra_params(sys.argv)
 
 	#
 	# Second, use argparse API to parse remaining parameters
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Daemon mode of irsync: load a job-list once, then keep running, starting each job's irsync session
+when its --datetime-pattern gives a new datetime_vault.
+
+    python3 -m cheese.incremental_rsync.irsync_cmd daemon <job_list_file> <local_store_dir> --workers=4
+
+The job-list file is the same as for `irsync jobs`. Compared with starting `irsync` or `irsync jobs`
+from cron every minute, the daemon holds the local_store_dir lock all the time, and sleeps until
+the next vault boundary of any job(e.g. the next minute for YYYYMMDD-hhmm, the next midnight for
+YYYYMMDD), so no Python interpreter is started, and no INI or catalog is read, only to find that
+a backup has been done already. INI content stays cached in memory between sessions(see IniStore).
+
+A job whose session fails is run again after --retry-failed-minutes, if its vault is still the same.
+A job still running when its next vault comes is started again when it finishes.
+
+State of every job is written to local_store_dir/irsync-daemon.status.json(or --status-file) each
+time something changes. Stop the daemon with SIGTERM or Ctrl+C; it waits for running sessions to end.
+"""
+
+import os, sys, time, datetime
+import json
+import signal
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .share import *
+from .helper import *
+from .irsync_client import *
+from .irsync_jobs import load_job_list, _run_one_job, workers_default
+from .logrotate import add_log_rotate_arguments, make_log_rotate_policy, LOG_ROTATE_DEFAULT
+
+FILENAM_daemon_status = 'irsync-daemon.status.json'
+
+retry_failed_minutes_default = 10
+BOUNDARY_MARGIN_SECONDS = 0.05 # wake up a bit after the boundary, so that now() is surely past it
+
+class _JobState:
+	def __init__(self, job):
+		self.job = job
+		self.datetime_pattern = job.apargs.datetime_pattern or irsync_st.datetime_pattern_default
+		self.future = None
+		self.vault_running = None
+		self.vault_done = None # last vault whose session has succeeded
+		self.vault_failed = None
+		self.uesec_retry = 0 # when vault_failed may be tried again
+		self.last_result = None # IrsyncJobResult
+		self.uesec_last_finish = 0
+		self.runs = 0
+
+	def want_run(self, vault, uesec):
+		if self.future or vault==self.vault_done:
+			return False
+		return vault!=self.vault_failed or uesec >= self.uesec_retry
+
+	def next_wakeup(self, now):
+		"""Return uesec when this job may need to start again, None if never(until its running session ends)."""
+		if self.future:
+			return None
+		uesec = []
+		boundary = next_datetime_boundary(self.datetime_pattern, now)
+		if boundary:
+			uesec.append(boundary.timestamp())
+		if self.vault_failed and self.vault_failed!=self.vault_done:
+			uesec.append(self.uesec_retry)
+		return min(uesec) if uesec else None
+
+	def status(self):
+		r = self.last_result
+		return {
+			'lineno': self.job.lineno,
+			'ushelf': self.job.ushelf_name,
+			'datetime_pattern': self.datetime_pattern,
+			'state': 'running' if self.future else 'idle',
+			'vault_running': self.vault_running if self.future else None,
+			'vault_done': self.vault_done,
+			'last_result': None if not r else ('success' if r.is_succ else 'fail'),
+			'last_seconds': None if not r else round(r.seconds, 1),
+			'uesec_last_finish': int(self.uesec_last_finish) or None,
+			'runs': self.runs,
+		}
+
+
+class IrsyncDaemon:
+
+	def __init__(self, jobs, local_store_dir, workers=workers_default, status_filepath=None,
+			retry_failed_seconds=retry_failed_minutes_default*60, log_rotate=LOG_ROTATE_DEFAULT):
+		self.local_store_dir = os.path.abspath(local_store_dir)
+		self.workers = workers
+		self.status_filepath = status_filepath or os.path.join(self.local_store_dir, FILENAM_daemon_status)
+		self.retry_failed_seconds = retry_failed_seconds
+		self.log_rotate = log_rotate
+		self.states = [_JobState(job) for job in jobs]
+		self.uesec_start = time.time()
+		self._stop = threading.Event()
+		self._wakeup = threading.Event() # set by a finishing session, or by stop()
+
+	def stop(self):
+		self._stop.set()
+		self._wakeup.set()
+
+	def _start_job(self, executor, store, js, vault):
+		js.vault_running = vault
+		js.runs += 1
+		js.future = executor.submit(_run_one_job, store, js.job)
+		js.future.add_done_callback(lambda f: self._wakeup.set())
+
+	def _reap_job(self, store, js):
+		result = js.future.result() # _run_one_job catches everything
+		js.future = None
+		js.last_result = result
+		js.uesec_last_finish = time.time()
+		if result.is_succ:
+			js.vault_done = js.vault_running
+		else:
+			js.vault_failed = js.vault_running
+			js.uesec_retry = time.time() + self.retry_failed_seconds
+		store.masterlogI("<%s> Daemon session for vault %s %s in %d seconds."%(
+			js.job.ushelf_name, js.vault_running, "done" if result.is_succ else "FAILED", result.seconds))
+
+	def write_status(self, next_uesec=None):
+		status = {
+			'pid': os.getpid(),
+			'local_store_dir': self.local_store_dir,
+			'uesec_start': int(self.uesec_start),
+			'uesec_update': int(time.time()),
+			'uesec_next_wakeup': int(next_uesec) if next_uesec else None,
+			'stopping': self._stop.is_set(),
+			'jobs': [js.status() for js in self.states],
+		}
+		tmp_filepath = self.status_filepath + ".tmp"
+		try:
+			with open(tmp_filepath, "w", encoding="utf8") as fh:
+				json.dump(status, fh, indent=1)
+			os.replace(tmp_filepath, self.status_filepath) # a reader never sees a half-written one
+		except OSError:
+			pass # losing status should not stop backups
+
+	def run(self):
+		store = irsync_store_st(self.local_store_dir, self.log_rotate) # raise Err_irsync if lock fails
+		try:
+			store.masterlogI("Irsync daemon start, pid=%d, %d jobs with %d workers. Status file:\n    %s"%(
+				os.getpid(), len(self.states), self.workers, self.status_filepath))
+			with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='irsync_daemon') as executor:
+				self._loop(executor, store)
+				running = sum(1 for js in self.states if js.future)
+				if running:
+					store.masterlogI("Irsync daemon stopping, waiting for %d running sessions."%(running))
+			for js in self.states:
+				if js.future:
+					self._reap_job(store, js)
+			self.write_status()
+			store.masterlogI("Irsync daemon stopped.")
+		finally:
+			store.close()
+
+	def _loop(self, executor, store):
+		while not self._stop.is_set():
+			self._wakeup.clear()
+			for js in self.states:
+				if js.future and js.future.done():
+					self._reap_job(store, js)
+
+			now = datetime.datetime.now()
+			uesec = now.timestamp()
+			for js in self.states:
+				vault = datetime_by_pattern(js.datetime_pattern, now)
+				if js.want_run(vault, uesec):
+					self._start_job(executor, store, js, vault)
+
+			wakeups = [w for w in (js.next_wakeup(now) for js in self.states) if w]
+			next_uesec = min(wakeups) + BOUNDARY_MARGIN_SECONDS if wakeups else None
+			self.write_status(next_uesec)
+
+			# Sleep until a vault boundary, or until a session finishes.
+			self._wakeup.wait(max(0, next_uesec - time.time()) if next_uesec else None)
+
+def irsync_daemon_cmd(argv):
+	ap = argparse.ArgumentParser(prog="irsync daemon",
+		description="Keep running, and run each job of a job-list file whenever its --datetime-pattern "
+			"gives a new backup vault.")
+	ap.add_argument('job_list_file', type=str,
+		help='A text file with one irsync job per line, same as for `irsync jobs`.'
+	)
+	ap.add_argument('local_store_dir', type=str,
+		help='The local directory as backup destination of all jobs.'
+	)
+	ap.add_argument('--workers', type=int, dest='workers', default=workers_default,
+		help='How many irsync sessions run concurrently. Default is %(default)s.'
+	)
+	ap.add_argument('--retry-failed-minutes', type=float, dest='retry_failed_minutes',
+		default=retry_failed_minutes_default,
+		help='Run a failed job again after this many minutes, if its vault has not changed. '
+			'Default is %(default)s.'
+	)
+	ap.add_argument('--status-file', type=str, dest='status_file',
+		help='Where to write daemon status JSON. Default is %s in local_store_dir.'%(FILENAM_daemon_status)
+	)
+	add_log_rotate_arguments(ap)
+	apargs = ap.parse_args(argv)
+
+	if apargs.workers<1:
+		print("Error: --workers must be at least 1.")
+		return False
+
+	try:
+		jobs = load_job_list(apargs.job_list_file, apargs.local_store_dir)
+		status_filepath = os.path.abspath(apargs.status_file) if apargs.status_file else None
+		daemon = IrsyncDaemon(jobs, apargs.local_store_dir, apargs.workers, status_filepath,
+			apargs.retry_failed_minutes*60, make_log_rotate_policy(apargs))
+
+		def on_signal(signum, frame):
+			print("Irsync daemon got signal %d, stopping..."%(signum))
+			daemon.stop()
+		signal.signal(signal.SIGTERM, on_signal)
+		signal.signal(signal.SIGINT, on_signal)
+
+		daemon.run()
+	except Err_irsync as e:
+		print(e.errmsg)
+		return False
+
+	return True
+
+if __name__ == '__main__':
+	succ = irsync_daemon_cmd(sys.argv[1:])
+	exit(0 if succ else 4)
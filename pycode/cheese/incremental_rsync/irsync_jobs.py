@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Job-list mode of irsync: one irsync process backs up many rsync_url into one local_store_dir,
+running several irsync sessions concurrently.
+
+    python3 -m cheese.incremental_rsync.irsync_cmd jobs <job_list_file> <local_store_dir> --workers=4
+
+Job-list file format: one irsync job per line, written just like irsync command line parameters,
+except that local_store_dir is omitted(it is given once for all jobs). The first word must be the
+rsync_url. Empty lines and lines starting with # are ignored. Example:
+
+    rsync://192.168.11.1:1873/mys              --old-days=30
+    rsync://192.168.11.2/build/outputs  build2 --max-retry=2 --rsync --bwlimit=2000
+"""
+
+import os, sys, time
+import shlex
+import argparse
+import traceback
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from .share import *
+from .helper import *
+from .irsync_client import *
+from .irsync_cmd import init_irsync_argparser, split_rsync_extra_params
+from .logrotate import add_log_rotate_arguments, make_log_rotate_policy, LOG_ROTATE_DEFAULT
+
+IrsyncJob = namedtuple('IrsyncJob', "lineno ushelf_name apargs rsync_extra_params")
+IrsyncJobResult = namedtuple('IrsyncJobResult', "job is_succ seconds")
+
+workers_default = 4
+
+def load_job_list(job_list_file, local_store_dir):
+	"""Parse job_list_file and return a list of IrsyncJob.
+	Any error in any line raises Err_irsync, so that we do not start half of the jobs.
+	"""
+	try:
+		lines = open(job_list_file, encoding="utf8").read().splitlines()
+	except OSError as e:
+		raise Err_irsync('Error: Cannot read job-list file "%s". %s'%(job_list_file, e.strerror))
+
+	# irsync_st will chdir into local_store_dir, so a relative path would mean differently
+	# for the jobs starting later.
+	local_store_dir = os.path.abspath(local_store_dir)
+
+	ap = init_irsync_argparser()
+	jobs = []
+	ushelf_lines = {}
+
+	for lineno, line in enumerate(lines, 1):
+		line = line.strip()
+		if not line or line.startswith('#'):
+			continue
+
+		words, rsync_extra_params = split_rsync_extra_params(shlex.split(line))
+		argv = words[0:1] + [local_store_dir] + words[1:]
+		try:
+			apargs = ap.parse_args(argv)
+		except SystemExit: # argparse has printed the reason
+			raise Err_irsync('Error: Bad irsync parameters at line %d of job-list file "%s".'%(
+				lineno, job_list_file))
+
+		check_rsync_params_conflict(rsync_extra_params)
+
+		ushelf_name = make_ushelf_name(apargs.rsync_url, apargs.shelf)
+		if ushelf_name in ushelf_lines:
+			# Two concurrent sessions on the same ushelf would share one .working dir.
+			raise Err_irsync('Error: Job-list file "%s", line %d and line %d result in the same ushelf "%s".'%(
+				job_list_file, ushelf_lines[ushelf_name], lineno, ushelf_name))
+		ushelf_lines[ushelf_name] = lineno
+
+		jobs.append(IrsyncJob(lineno, ushelf_name, apargs, rsync_extra_params))
+
+	return jobs
+
+def _run_one_job(store, job):
+	uesec_start = time.time()
+	try:
+		# The irsync_st object is created here, not in load_job_list(), so that
+		# --max-irsync-hours counts from the time the job really starts.
+		irs = irsync_st(job.apargs, job.rsync_extra_params, store)
+		irs.run_irsync_session_once()
+		is_succ = True
+	except Err_irsync as e:
+		print("<%s> %s"%(job.ushelf_name, e.errmsg))
+		is_succ = False
+	except Exception:
+		# An unexpected exception in one job should not stop the other jobs.
+		# The stacktrace has been logged by irsync_st's LoggerFence, so one line is enough here.
+		store.masterlogE("<%s> Job aborted by unexpected exception: %s"%(
+			job.ushelf_name, traceback.format_exc(limit=0).strip()))
+		is_succ = False
+
+	return IrsyncJobResult(job, is_succ, time.time()-uesec_start)
+
+def run_irsync_jobs(jobs, local_store_dir, workers=workers_default, log_rotate=LOG_ROTATE_DEFAULT):
+	"""Run all jobs concurrently with `workers` threads, all storing into local_store_dir.
+	Return a list of IrsyncJobResult, in the same order as jobs[].
+	"""
+	store = irsync_store_st(local_store_dir, log_rotate) # raise Err_irsync if lock fails
+	try:
+		uesec_start = time.time()
+		store.masterlogI("Irsync job-list start, %d jobs with %d workers."%(len(jobs), workers))
+
+		with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='irsync_job') as executor:
+			results = list(executor.map(lambda job: _run_one_job(store, job), jobs))
+
+		wall_seconds = time.time() - uesec_start
+		store.masterlogI(getmsg_jobs_summary(results, wall_seconds, workers))
+	finally:
+		store.close()
+
+	return results
+
+def getmsg_jobs_summary(results, wall_seconds, workers):
+	succ_count = sum(1 for r in results if r.is_succ)
+	sum_seconds = sum(r.seconds for r in results)
+
+	lines = ["Irsync job-list done. %d success, %d fail. Workers: %d"%(
+		succ_count, len(results)-succ_count, workers)]
+	lines.append("    Wall time: %d seconds. Sum of job time: %d seconds. Speedup: %.1fx"%(
+		wall_seconds, sum_seconds, sum_seconds/wall_seconds if wall_seconds>0 else 1.0))
+	for r in results:
+		lines.append("    [%s] %6d seconds : %s (line %d)"%(
+			" OK " if r.is_succ else "FAIL", r.seconds, r.job.ushelf_name, r.job.lineno))
+	return '\n'.join(lines)
+
+def irsync_jobs_cmd(argv):
+	ap = argparse.ArgumentParser(prog="irsync jobs",
+		description="Run many irsync jobs concurrently, all storing into one local_store_dir.")
+	ap.add_argument('job_list_file', type=str,
+		help='A text file with one irsync job per line. Each line is written like irsync command line '
+			'parameters, but without local_store_dir.'
+	)
+	ap.add_argument('local_store_dir', type=str,
+		help='The local directory as backup destination of all jobs.'
+	)
+	ap.add_argument('--workers', type=int, dest='workers', default=workers_default,
+		help='How many irsync sessions run concurrently. Default is %(default)s.'
+	)
+	add_log_rotate_arguments(ap) # --log-rotate-* in the job lines have no effect, the store is shared
+	apargs = ap.parse_args(argv)
+
+	if apargs.workers<1:
+		print("Error: --workers must be at least 1.")
+		return False
+
+	try:
+		jobs = load_job_list(apargs.job_list_file, apargs.local_store_dir)
+		results = run_irsync_jobs(jobs, apargs.local_store_dir, apargs.workers, make_log_rotate_policy(apargs))
+	except Err_irsync as e:
+		print(e.errmsg)
+		return False
+
+	return all(r.is_succ for r in results)
+
+if __name__ == '__main__':
+	succ = irsync_jobs_cmd(sys.argv[1:])
+	exit(0 if succ else 4)
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Read irsync logs, plain or compressed, without decompressing them to disk:
+
+* irsync.log together with its rotated, compressed segments(see logrotate.py), as one log.
+* Session and rsync logs in __logs__ of a backup, which are .gz/.zst with --rsync-log-compress.
+
+    python3 -m cheese.incremental_rsync.irsync_cmd log <local_store_dir> [--grep=REGEX] [-i] [--since=20261001]
+    python3 -m cheese.incremental_rsync.irsync_cmd log <local_store_dir>/20261018/server.shelf --grep=REGEX
+
+prints the lines, oldest first; with --grep, only the lines matching REGEX. --since=YYYYMMDD[.hhmmss]
+skips whole irsync.log segments rotated before that time without opening them, and lines logged
+before it. Paths can be local_store_dir, a backup dir(its __logs__ is read), any dir of logs, or log files.
+
+A compressed rsync log cut short(irsync killed while rsync runs) is read up to where it ends.
+"""
+
+import os, sys, re
+import argparse
+
+from .logrotate import list_log_segments, segment_stamp, open_log_for_read, LINE_STAMP_RE
+
+FILENAM_master_log = "irsync.log" # see irsync_store_st.master_logfile
+LOG_NOD = '__logs__' # same as share.LOG_NOD, not imported to keep this light
+LOG_FILE_RE = re.compile(r'\.log(\.gz|\.zst)?$')
+
+def log_files_of(logpath, since=None):
+	"""Return log files to read for logpath, in reading order.
+	For irsync.log(or local_store_dir): its rotated segments that may have lines at or after since, then itself.
+	For another dir: log files in it, or in its __logs__ subdir, by name.
+	"""
+	if os.path.isdir(logpath):
+		master_logfile = os.path.join(logpath, FILENAM_master_log)
+		if not os.path.isfile(master_logfile) and not list_log_segments(master_logfile):
+			if os.path.isdir(os.path.join(logpath, LOG_NOD)):
+				logpath = os.path.join(logpath, LOG_NOD)
+			return [os.path.join(logpath, name) for name in sorted(os.listdir(logpath))
+				if LOG_FILE_RE.search(name) and os.path.isfile(os.path.join(logpath, name))]
+		logpath = master_logfile
+
+	filepaths = [fp for fp in list_log_segments(logpath) if not since or segment_stamp(fp) >= since]
+	if os.path.isfile(logpath):
+		filepaths.append(logpath)
+	return filepaths
+
+def y_file_lines(filepaths, since=None, on_truncated=None):
+	"""Yield (filepath, line) of files one after another, lines without trailing newline.
+	since: "YYYYMMDD[.hhmmss]". A line without timestamp(the rest of a multi-line record, or rsync output)
+	goes with the timestamp of the line before it.
+	on_truncated: called with filepath if a compressed file ends abruptly.
+	"""
+	for filepath in filepaths:
+		is_since_passed = not since
+		with open_log_for_read(filepath) as fh:
+			try:
+				for line in fh:
+					if not is_since_passed:
+						m = LINE_STAMP_RE.match(line)
+						if not m or m.group(1) < since:
+							continue
+						is_since_passed = True
+					yield filepath, line.rstrip('\n')
+			except EOFError: # compressed stream without its end
+				if on_truncated:
+					on_truncated(filepath)
+
+def y_log_lines(logpath, since=None, on_truncated=None):
+	"""Yield (filepath, line) of all log files of logpath(see log_files_of()), oldest first."""
+	return y_file_lines(log_files_of(logpath, since), since, on_truncated)
+
+def y_grep_lines(lines, pattern):
+	"""Filter (filepath, line) by the compiled regex pattern."""
+	for filepath, line in lines:
+		if pattern.search(line):
+			yield filepath, line
+
+def irsync_log_cmd(argv):
+	ap = argparse.ArgumentParser(prog="irsync log",
+		description="Show or search irsync logs, compressed or not: irsync.log of a local_store_dir with its "
+			"rotated segments, or session and rsync logs of a backup.")
+	ap.add_argument('logpaths', type=str, nargs='+',
+		help='A local_store_dir, a backup dir, a dir with log files, or log files. Compressed ones are fine.')
+	ap.add_argument('--grep', type=str, dest='grep',
+		help='Show only lines matching this regular expression.')
+	ap.add_argument('-i', action="store_true", dest='ignore_case',
+		help='--grep ignores case.')
+	ap.add_argument('--since', type=str, dest='since',
+		help='Show only lines logged at or after this time, as YYYYMMDD or YYYYMMDD.hhmmss .')
+	ap.add_argument('--with-filename', action="store_true", dest='with_filename',
+		help='Prefix each line with the name of the log file it comes from.')
+	apargs = ap.parse_args(argv)
+
+	if apargs.since and not re.fullmatch(r'\d{8}(\.\d{1,6})?', apargs.since):
+		print("Error: --since must be like YYYYMMDD or YYYYMMDD.hhmmss .")
+		return False
+
+	filepaths = []
+	for logpath in apargs.logpaths:
+		found = log_files_of(logpath, apargs.since)
+		if not found and not os.path.exists(logpath):
+			print('Error: No log file "%s".'%(logpath))
+			return False
+		filepaths += found
+
+	def on_truncated(filepath):
+		sys.stdout.flush()
+		print("Warning: %s ends abruptly, the rest of it is lost."%(filepath), file=sys.stderr)
+
+	try:
+		lines = y_file_lines(filepaths, apargs.since, on_truncated)
+		if apargs.grep:
+			lines = y_grep_lines(lines, re.compile(apargs.grep, re.IGNORECASE if apargs.ignore_case else 0))
+
+		for filepath, line in lines:
+			if apargs.with_filename:
+				print("%s:%s"%(os.path.basename(filepath), line))
+			else:
+				print(line)
+	except re.error as e:
+		print("Error: Bad --grep regular expression. %s"%(str(e)))
+		return False
+	except BrokenPipeError:
+		pass # like `irsync log ... | head`
+	except OSError as e:
+		print("Error: %s"%(str(e)))
+		return False
+	return True
+
+if __name__ == '__main__':
+	succ = irsync_log_cmd(sys.argv[1:])
+	exit(0 if succ else 4)
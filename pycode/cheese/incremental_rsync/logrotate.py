@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Rotation of the master irsync.log, and compression of log files.
+
+irsync.log in local_store_dir gets a few lines on every irsync run, forever. When it grows beyond
+--log-rotate-mb, or its oldest line is older than --log-rotate-days, it is renamed to
+irsync.log.YYYYMMDD-hhmmss(the time of rotation) and a new irsync.log is started. The renamed
+segment is then compressed on a background thread into irsync.log.YYYYMMDD-hhmmss.gz(or .zst).
+
+Rotation is done by irsync_store_st only, which holds the local_store_dir filelock(irsync.log.lck,
+which is not rotated) and writes irsync.log under its mutex, so no other writer can be appending
+to the file being renamed.
+
+zstd is used if Python has it(compression.zstd since Python 3.14, or the `zstandard` package),
+otherwise it falls back to gzip. See logread.py for reading all segments as one log.
+"""
+
+import os, re, time, datetime
+import gzip
+import shutil
+import threading
+from collections import namedtuple
+
+# max_bytes/max_seconds: 0 means no such limit. compress: 'gzip', 'zstd' or 'none'.
+LogRotatePolicy = namedtuple('LogRotatePolicy', "max_bytes max_seconds compress")
+
+LOG_ROTATE_MB_DEFAULT = 64
+LOG_ROTATE_DEFAULT = LogRotatePolicy(LOG_ROTATE_MB_DEFAULT*1024*1024, 0, 'gzip')
+
+COMPRESS_METHODS = ('gzip', 'zstd', 'none')
+COMPRESS_SUFFIX = {'gzip':'.gz', 'zstd':'.zst'}
+STREAM_GZIP_LEVEL = 3 # for compressing while writing(rsync logs): fast enough to keep up with rsync -av
+
+# irsync.log.20261018-024315, or .20261018-024315.1 if two rotations happen in one second
+SEGMENT_RE = re.compile(r'\.(\d{8}-\d{6})(\.\d+)?(\.gz|\.zst)?$')
+# How MTLogger starts a record: [20261018.024315.780]
+LINE_STAMP_RE = re.compile(r'^\[(\d{8}\.\d{6})')
+
+def _zstd_module():
+	try:
+		from compression import zstd # Python 3.14+
+		return zstd
+	except ImportError:
+		pass
+	try:
+		import zstandard
+		return zstandard
+	except ImportError:
+		return None
+
+def resolve_compress_method(method):
+	"""Return the method to really use: None for 'none', 'gzip' for 'zstd' if zstd is not available."""
+	if method=='none' or not method:
+		return None
+	if method=='zstd' and not _zstd_module():
+		return 'gzip'
+	return method
+
+def open_compressed(filepath, mode, method, level=None):
+	"""Open a gzip or zstd file like open(); mode is 'rb', 'wb', 'rt', 'wt'...
+	level: gzip compress level, default 9. zstd always uses its default level, which is fast already.
+	In text mode, f.buffer is the binary compressed stream.
+	"""
+	encoding = dict(encoding="utf8", errors="replace") if 't' in mode else {}
+	if method=='zstd':
+		return _zstd_module().open(filepath, mode, **encoding)
+	return gzip.open(filepath, mode, compresslevel=level or 9, **encoding)
+
+def method_of_filepath(filepath):
+	for method, suffix in COMPRESS_SUFFIX.items():
+		if filepath.endswith(suffix):
+			return method
+	return None
+
+def open_log_for_read(filepath):
+	"""Open a log file, compressed or not(by its suffix), as text."""
+	method = method_of_filepath(filepath)
+	if method:
+		return open_compressed(filepath, "rt", method)
+	return open(filepath, "r", encoding="utf8", errors="replace")
+
+def compress_file(filepath, method):
+	"""Compress filepath into filepath.gz/.zst, then delete filepath. Return the compressed filepath.
+	Data is streamed, so a log of any size takes little memory. A crash leaves at worst a .tmp file
+	and the original intact.
+	"""
+	dst_filepath = filepath + COMPRESS_SUFFIX[method]
+	tmp_filepath = dst_filepath + ".tmp"
+	with open(filepath, "rb") as fh_in, open_compressed(tmp_filepath, "wb", method) as fh_out:
+		shutil.copyfileobj(fh_in, fh_out, 1024*1024)
+	os.replace(tmp_filepath, dst_filepath)
+	os.remove(filepath)
+	return dst_filepath
+
+def segment_stamp(filepath):
+	"""Return rotation time of a segment as "YYYYMMDD.hhmmss"(comparable with LINE_STAMP_RE), None if not a segment."""
+	m = SEGMENT_RE.search(filepath)
+	return m.group(1).replace('-', '.') if m else None
+
+def list_log_segments(logfile):
+	"""Return filepaths of rotated segments of logfile, oldest first. If a segment exists both
+	compressed and not(compression running or interrupted), the uncompressed one is listed.
+	"""
+	dirpath, filename = os.path.split(logfile)
+	try:
+		names = os.listdir(dirpath or '.')
+	except OSError:
+		return []
+
+	segments = {} # name without compress suffix -> filename
+	for name in names:
+		if not name.startswith(filename) or name.endswith('.tmp'):
+			continue
+		m = SEGMENT_RE.fullmatch(name[len(filename):])
+		if not m:
+			continue
+		base = name[:len(name)-len(m.group(3) or '')]
+		if base not in segments or not m.group(3):
+			segments[base] = name
+
+	def sort_key(base):
+		m = SEGMENT_RE.search(base)
+		return (m.group(1), int((m.group(2) or '.0')[1:]))
+	return [os.path.join(dirpath, segments[base]) for base in sorted(segments, key=sort_key)]
+
+def first_line_stamp(logfile):
+	"""Return the "YYYYMMDD.hhmmss" of the first timestamped line of logfile, None if none."""
+	try:
+		with open(logfile, "r", encoding="utf8", errors="replace") as fh:
+			for line in fh.read(65536).splitlines():
+				m = LINE_STAMP_RE.match(line)
+				if m:
+					return m.group(1)
+	except OSError:
+		pass
+	return None
+
+def add_log_rotate_arguments(ap):
+	"""Options for irsync_store_st, shared by irsync main command, `irsync jobs` and `irsync daemon`."""
+	ap.add_argument('--log-rotate-mb', type=int, dest='log_rotate_mb', default=LOG_ROTATE_MB_DEFAULT,
+		help='Rotate irsync.log in local_store_dir when it grows beyond this many MB. 0 means no size limit. '
+			'Default is %(default)s.'
+	)
+	ap.add_argument('--log-rotate-days', type=float, dest='log_rotate_days', default=0,
+		help='Rotate irsync.log when its oldest line is older than this many days. Default 0 means no age limit.'
+	)
+	ap.add_argument('--log-compress', type=str, dest='log_compress', choices=COMPRESS_METHODS, default='gzip',
+		help='How rotated irsync.log segments are compressed. zstd falls back to gzip if Python has no zstd. '
+			'Default is %(default)s.'
+	)
+
+def make_log_rotate_policy(apargs):
+	return LogRotatePolicy(max(0, apargs.log_rotate_mb)*1024*1024, max(0, apargs.log_rotate_days)*86400,
+		apargs.log_compress)
+
+
+class LogRotator:
+	"""Rotation state of one log file. Methods other than join() must be called with the writer's
+	mutex held, bcz rotate() replaces the writer's file handle.
+	"""
+
+	def __init__(self, logfile, policy, warnfunc=None):
+		self.logfile = logfile
+		self.policy = policy
+		self.method = resolve_compress_method(policy.compress)
+		self.warnfunc = warnfunc
+		self._threads = []
+		self._queued = set() # segments given to a compression thread already
+
+		try:
+			self.size = os.path.getsize(logfile)
+		except OSError:
+			self.size = 0
+		stamp = first_line_stamp(logfile) if policy.max_seconds>0 else None
+		self.uesec_segment_start = time.mktime(time.strptime(stamp, "%Y%m%d.%H%M%S")) if stamp else time.time()
+
+	def count(self, text):
+		self.size += len(text) # chars, not bytes, but close enough for a size limit
+
+	def is_due(self):
+		if self.policy.max_bytes>0 and self.size >= self.policy.max_bytes:
+			return True
+		if self.policy.max_seconds>0 and time.time()-self.uesec_segment_start >= self.policy.max_seconds:
+			return self.size>0
+		return False
+
+	def rotate(self, fh):
+		"""Close fh(the log file opened for append), rename log file to a new segment, and return
+		a new file handle for appending. Compression of the segment starts in background.
+		"""
+		fh.close()
+		stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+		segment = "%s.%s"%(self.logfile, stamp)
+		seq = 0
+		while any(os.path.exists(segment + suffix) for suffix in ('', '.gz', '.zst')):
+			seq += 1
+			segment = "%s.%s.%d"%(self.logfile, stamp, seq)
+		os.rename(self.logfile, segment)
+
+		self.size = 0
+		self.uesec_segment_start = time.time()
+		self.compress_background([segment])
+		return open(self.logfile, "a", encoding="utf8")
+
+	def compress_leftovers(self):
+		"""Compress segments left uncompressed, e.g. by a crash during compression."""
+		self.compress_background([fp for fp in list_log_segments(self.logfile) if not method_of_filepath(fp)])
+
+	def compress_background(self, filepaths):
+		filepaths = [fp for fp in filepaths if fp not in self._queued]
+		if not self.method or not filepaths:
+			return
+		self._queued.update(filepaths)
+		# Not a daemon thread, so that Python waits for it at exit instead of leaving half a .gz behind.
+		thread = threading.Thread(target=self._compress, args=(filepaths,), name='irsync_logcompress')
+		self._threads = [t for t in self._threads if t.is_alive()] + [thread]
+		thread.start()
+
+	def _compress(self, filepaths):
+		for filepath in filepaths:
+			try:
+				compress_file(filepath, self.method)
+			except OSError as e:
+				if self.warnfunc:
+					self.warnfunc("Fail to compress rotated log %s. %s"%(filepath, str(e)))
+
+	def join(self):
+		for thread in self._threads:
+			thread.join()
+		self._threads = []
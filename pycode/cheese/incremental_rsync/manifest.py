@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Per-generation file manifest. With `irsync --manifest`, each finished ushelf dir carries
+_irsync_manifest.tsv.gz, one line per regular file:
+
+    <path> TAB <size> TAB <mtime_ns> TAB <inode> TAB <content hash>
+
+path is relative to the ushelf dir, with '/' as separator; backslash, TAB, CR, LF in it are
+escaped as \\\\, \\t, \\r, \\n . Lines are in the order of path components, i.e. a directory's content
+right after the directory name's position, each directory sorted by name. So two manifests can be
+merge-joined line by line, and neither has to be loaded into memory.
+
+Hashing terabytes every night is not viable, so the previous generation's manifest is read alongside:
+a file whose inode is the same as the previous generation's file at the same path(hardlinked by
+--link-dest) gets the hash from there. Only files transferred this time are read, by a pool of threads.
+
+With --dedup, a file may also be hardlinked to a previous generation's file at another path(linked
+across shelves, or renamed since then). For that, write_manifest(by_inode=True) first walks the tree
+without reading files to find linked files the merge-join misses, then looks up their inodes in
+the previous manifest; only those few entries are held in memory.
+"""
+
+import os, sys, time
+import gzip
+import zlib
+import hashlib
+import collections
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, Future
+
+FILENAM_manifest = '_irsync_manifest.tsv.gz'
+MANIFEST_HEADER = "#irsync-manifest\tv1\tblake2b-160\n"
+
+MANIFEST_HASH_WORKERS = 4
+HASH_READ_SIZE = 1024*1024
+WINDOW_PER_WORKER = 64 # entries waiting for their hash, so that output keeps the walking order
+
+# What a truncated or corrupt manifest raises while being read(a bad line gives ValueError).
+MANIFEST_READ_ERRORS = (EOFError, gzip.BadGzipFile, zlib.error, ValueError)
+
+# path: relative path, with '/' as separator.
+ManifestEntry = namedtuple('ManifestEntry', "path size mtime_ns inode hash")
+
+# files: files in manifest. reused: files with hash from the previous manifest.
+# hashed_files/hashed_bytes: files read for hashing.
+ManifestStats = namedtuple('ManifestStats', "files reused hashed_files hashed_bytes seconds")
+
+def getmsg_manifest_stats(st):
+	speed = "%.1f MB/s"%(st.hashed_bytes/st.seconds/1000000) if st.seconds>0 else "-"
+	return "Manifest has %d files, %d hashes reused from previous generation, " \
+		"%d files(%.1f MB) hashed in %.1f seconds (%s)."%(
+		st.files, st.reused, st.hashed_files, st.hashed_bytes/1000000, st.seconds, speed)
+
+def hash_file(filepath, throttle=None):
+	"""The content hash used in manifest, as hex string.
+	throttle: if given, it is called with byte count after each read, to limit reading speed.
+	"""
+	h = hashlib.blake2b(digest_size=20)
+	buf = bytearray(HASH_READ_SIZE)
+	mv = memoryview(buf)
+	with open(filepath, "rb", buffering=0) as fh:
+		while True:
+			n = fh.readinto(buf) # big sequential reads, no new bytes object each time
+			if not n:
+				break
+			h.update(mv[:n])
+			if throttle:
+				throttle(n)
+	return h.hexdigest()
+
+_escapes = {'\\':'\\\\', '\t':'\\t', '\r':'\\r', '\n':'\\n'}
+_unescapes = {v[1]:k for k, v in _escapes.items()}
+
+def _escape_path(path):
+	if not any(c in path for c in _escapes):
+		return path
+	return ''.join(_escapes.get(c, c) for c in path)
+
+def _unescape_path(text):
+	if '\\' not in text:
+		return text
+	out = []
+	it = iter(text)
+	for c in it:
+		out.append(_unescapes.get(next(it, ''), '') if c=='\\' else c)
+	return ''.join(out)
+
+def path_key(path):
+	"""Manifest lines are sorted by this key."""
+	return tuple(path.split('/'))
+
+def _open_text(filepath, mode):
+	# surrogateescape, so that a filename not in UTF-8 survives the round trip.
+	return gzip.open(filepath, mode, encoding="utf8", errors="surrogateescape", newline='\n')
+
+def y_read_manifest(filepath):
+	"""Yield ManifestEntry from a manifest file, in file order."""
+	with _open_text(filepath, "rt") as fh:
+		for line in fh:
+			if line.startswith('#'):
+				continue
+			path, size, mtime_ns, inode, digest = line.rstrip('\n').split('\t')
+			yield ManifestEntry(_unescape_path(path), int(size), int(mtime_ns), int(inode), digest)
+
+def y_walk_sorted(topdir, skip_names=(), _parts=()):
+	"""Yield (path components tuple, os.DirEntry) for regular files under topdir, in manifest order.
+	skip_names: entry names to skip at top level.
+	"""
+	with os.scandir(topdir) as it:
+		entries = sorted(it, key=lambda e: e.name)
+	for entry in entries:
+		if not _parts and entry.name in skip_names:
+			continue
+		if entry.is_dir(follow_symlinks=False):
+			yield from y_walk_sorted(entry.path, (), _parts+(entry.name,))
+		elif entry.is_file(follow_symlinks=False):
+			yield _parts+(entry.name,), entry
+
+
+class _PrevManifest:
+	"""Walk the previous manifest forward, in step with the new generation's sorted walk."""
+
+	def __init__(self, filepath, by_inode=None):
+		self.by_inode = by_inode or {} # inode -> ManifestEntry, for files not at the same path any more
+		self._it = iter(())
+		if filepath and os.path.isfile(filepath):
+			self._it = y_read_manifest(filepath)
+		self._cur = None
+		self._cur_key = None
+		self._advance()
+
+	def _advance(self):
+		self._cur = next(self._it, None)
+		self._cur_key = path_key(self._cur.path) if self._cur else None
+
+	def lookup(self, parts, st):
+		"""Return the recorded hash if the file at parts is still the very same inode, else None."""
+		while self._cur and self._cur_key < parts:
+			self._advance()
+		cur = self._cur
+		if not (cur and self._cur_key==parts and cur.inode==st.st_ino):
+			cur = self.by_inode.get(st.st_ino)
+		if cur and cur.inode==st.st_ino and cur.size==st.st_size and cur.mtime_ns==st.st_mtime_ns:
+			return cur.hash
+		return None
+
+def _prev_entries_by_inode(ushelf_dirpath, prev_manifest_filepath, skip_names):
+	"""Return {inode: ManifestEntry} of previous manifest entries whose inode is linked from another
+	path in ushelf_dirpath. Walks the tree(stat only) and reads the previous manifest twice.
+	"""
+	prev = _PrevManifest(prev_manifest_filepath)
+	wanted = set()
+	for parts, entry in y_walk_sorted(ushelf_dirpath, skip_names):
+		st = entry.stat(follow_symlinks=False)
+		if st.st_nlink>1 and prev.lookup(parts, st) is None:
+			wanted.add(st.st_ino)
+	if not wanted:
+		return {}
+	return {e.inode:e for e in y_read_manifest(prev_manifest_filepath) if e.inode in wanted}
+
+
+def write_manifest(ushelf_dirpath, prev_manifest_filepath=None, skip_names=(), workers=MANIFEST_HASH_WORKERS,
+		by_inode=False):
+	"""Write ushelf_dirpath/_irsync_manifest.tsv.gz . Return ManifestStats.
+	prev_manifest_filepath: manifest of the previous generation, for hash reuse. May not exist.
+	by_inode: also reuse hashes of files hardlinked to a previous file at another path, at the cost
+	of an extra walk; worth it after dedup. Without it, reuse is for the same path only.
+	"""
+	uesec_start = time.time()
+	manifest_filepath = os.path.join(ushelf_dirpath, FILENAM_manifest)
+	tmp_filepath = manifest_filepath + ".tmp"
+	skip_names = tuple(skip_names) + (FILENAM_manifest, os.path.basename(tmp_filepath))
+
+	by_inode_entries = None
+	if by_inode and prev_manifest_filepath and os.path.isfile(prev_manifest_filepath):
+		by_inode_entries = _prev_entries_by_inode(ushelf_dirpath, prev_manifest_filepath, skip_names)
+	prev = _PrevManifest(prev_manifest_filepath, by_inode_entries)
+	files = reused = hashed_files = hashed_bytes = 0
+	linked = {} # (dev,ino) -> hash or Future, for an inode new in this generation with several links
+	window = collections.deque() # (path, stat, hash or Future), in walking order
+	window_max = max(1, workers) * WINDOW_PER_WORKER
+
+	def write_one(fh, path, st, digest):
+		if isinstance(digest, Future):
+			digest = digest.result()
+		fh.write("%s\t%d\t%d\t%d\t%s\n"%(_escape_path(path), st.st_size, st.st_mtime_ns, st.st_ino, digest))
+
+	with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='irsync_manifest') as executor:
+		with _open_text(tmp_filepath, "wt") as fh:
+			fh.write(MANIFEST_HEADER)
+			for parts, entry in y_walk_sorted(ushelf_dirpath, skip_names):
+				st = entry.stat(follow_symlinks=False)
+				files += 1
+
+				digest = prev.lookup(parts, st)
+				if digest is not None:
+					reused += 1
+				else:
+					key = (st.st_dev, st.st_ino)
+					digest = linked.get(key)
+					if digest is None:
+						digest = executor.submit(hash_file, entry.path)
+						hashed_files += 1
+						hashed_bytes += st.st_size
+						if st.st_nlink>1:
+							linked[key] = digest
+
+				window.append(('/'.join(parts), st, digest))
+				while len(window) > window_max:
+					write_one(fh, *window.popleft())
+
+			while window:
+				write_one(fh, *window.popleft())
+
+	os.replace(tmp_filepath, manifest_filepath)
+	return ManifestStats(files, reused, hashed_files, hashed_bytes, time.time()-uesec_start)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Phase timing of an irsync session, and its export as Prometheus metrics.
+
+irsync_st times each phase of a session with a PhaseTimer:
+
+    retention      remove_old_ushelfs()
+    preflight      reading last-success, choosing --link-dest, and for --shards, listing the source
+    rsync          the first rsync run
+    rsync_retry    later rsync runs
+    retry_wait     sleeping before a retry
+    finish_record  writing _irsync_backup_done.ini
+    finish_rename  renaming .working dir to finish-dir
+    finish_index   catalog, irsync.ini and --finish-dir-write-to
+    dedup, manifest
+
+Phase seconds go to the session stats JSON(and irsync-stats.jsonl), to the master log, and with
+--metrics-dir=<dir>, to <dir>/irsync-<ushelf>.prom for node_exporter's textfile collector
+(--collector.textfile.directory=<dir>), so that per-phase latency can be graphed and alerted on.
+"""
+
+import os, time
+import contextlib
+
+PROM_FILENAME_PREFIX = 'irsync-'
+PROM_FILENAME_SUFFIX = '.prom'
+
+class PhaseTimer:
+	"""Accumulate wall seconds of named phases. A phase can be entered more than once(e.g. rsync_retry).
+	Spans may nest; time in an inner span counts for the inner phase only, so phases add up to
+	the session time.
+	"""
+
+	def __init__(self):
+		self.spans = [] # (name, uesec_start, seconds), seconds excluding inner spans
+		self._inner_seconds = [] # a stack, time taken by inner spans of each open span
+
+	@contextlib.contextmanager
+	def span(self, name):
+		uesec_start = time.time()
+		tick_start = time.monotonic()
+		self._inner_seconds.append(0)
+		try:
+			yield
+		finally:
+			seconds = time.monotonic()-tick_start
+			inner = self._inner_seconds.pop()
+			if self._inner_seconds:
+				self._inner_seconds[-1] += seconds
+			self.spans.append((name, uesec_start, seconds-inner))
+
+	def totals(self):
+		"""Return dict of phase name -> total seconds, in order of first start."""
+		totals = {}
+		for name, _, seconds in sorted(self.spans, key=lambda s: s[1]):
+			totals[name] = totals.get(name, 0) + seconds
+		return totals
+
+	def counts(self):
+		counts = {}
+		for name, _, _ in self.spans:
+			counts[name] = counts.get(name, 0) + 1
+		return counts
+
+def getmsg_phase_seconds(totals):
+	if not totals:
+		return "Phase time: none."
+	return "Phase time: %s"%(", ".join("%s %.2fs"%(name, seconds) for name, seconds in totals.items()))
+
+def _prom_label(value):
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def prom_filepath(metrics_dir, ushelf_name):
+	return os.path.join(metrics_dir, PROM_FILENAME_PREFIX + ushelf_name + PROM_FILENAME_SUFFIX)
+
+def write_prometheus_textfile(metrics_dir, record, timer):
+	"""Write a session's metrics in Prometheus text format, replacing the ushelf's file atomically,
+	bcz node_exporter may read it any time. record is the session stats record(see save_session_stats).
+	"""
+	labels = 'ushelf="%s"'%(_prom_label(record['ushelf']))
+	counts = timer.counts()
+	lines = [
+		"# HELP irsync_phase_seconds Wall seconds spent in each phase of the last irsync session.",
+		"# TYPE irsync_phase_seconds gauge",
+	]
+	for name, seconds in timer.totals().items():
+		lines.append('irsync_phase_seconds{%s,phase="%s"} %.6f'%(labels, name, seconds))
+	lines += [
+		"# HELP irsync_phase_count Times each phase was entered in the last irsync session.",
+		"# TYPE irsync_phase_count gauge",
+	]
+	for name, count in counts.items():
+		lines.append('irsync_phase_count{%s,phase="%s"} %d'%(labels, name, count))
+	lines += [
+		"# HELP irsync_session_seconds Wall seconds of the last irsync session.",
+		"# TYPE irsync_session_seconds gauge",
+		'irsync_session_seconds{%s} %.3f'%(labels, record['elapsed_seconds']),
+		"# HELP irsync_session_success Whether the last irsync session succeeded.",
+		"# TYPE irsync_session_success gauge",
+		'irsync_session_success{%s} %d'%(labels, 1 if record['success'] else 0),
+		"# HELP irsync_session_end_timestamp_seconds When the last irsync session ended.",
+		"# TYPE irsync_session_end_timestamp_seconds gauge",
+		'irsync_session_end_timestamp_seconds{%s} %d'%(labels, record['uesec_end']),
+		"# HELP irsync_rsync_attempts rsync runs in the last irsync session.",
+		"# TYPE irsync_rsync_attempts gauge",
+		'irsync_rsync_attempts{%s} %d'%(labels, len(record.get('rsync_attempts', []))),
+	]
+
+	filepath = prom_filepath(metrics_dir, record['ushelf'])
+	tmp_filepath = "%s.%d.tmp"%(filepath, os.getpid()) # textfile collector ignores names not ending with .prom
+	os.makedirs(metrics_dir, exist_ok=True)
+	with open(tmp_filepath, "w", encoding="utf8") as fh:
+		fh.write('\n'.join(lines) + '\n')
+	os.replace(tmp_filepath, filepath)
+	return filepath
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Remove old backups(ushelf directories) quickly.
+
+Deleting a ushelf with millions of (hardlinked) files takes a long time, so instead of
+shutil.rmtree() it in the critical path, irsync first renames it into local_store_dir/__trash__
+(atomic and instant), then the TrashPruner deletes __trash__ content with a pool of threads,
+in the background while rsync is running.
+
+The trash can also be emptied as a detached step, e.g. from cron at a quiet time:
+
+    python3 -m cheese.incremental_rsync.irsync_cmd prune-trash <local_store_dir>
+"""
+
+import os, sys, time
+import stat
+import threading
+import argparse
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from cheese.filelock.assistive_filelock import AsFilelock, Err_asfilelock
+
+from .share import *
+from .helper import *
+
+TRASH_NOD = '__trash__' # as directory node name in local_store_dir for doomed ushelfs.
+
+prune_workers_default = 4
+
+# files: count of non-directory entries deleted.
+# bytes: bytes really reclaimed. A file whose inode is still hardlinked from other backups
+#        does not free any disk space, so it is not counted.
+PruneStats = namedtuple('PruneStats', "files bytes seconds")
+
+_is_dir_fd_ok = (os.unlink in os.supports_dir_fd) and (os.scandir in os.supports_fd)
+
+def trash_dirpath(local_store_dir):
+	return os.path.join(local_store_dir, TRASH_NOD)
+
+def move_to_trash(local_store_dir, dirpath):
+	"""Rename dirpath into local_store_dir/__trash__ . Return the new dirpath.
+	dirpath must be on the same filesystem as local_store_dir, so this is atomic.
+	"""
+	trashdir = trash_dirpath(local_store_dir)
+	os.makedirs(trashdir, exist_ok=True)
+
+	# "20200411/server.shelf" -> "20200411~server.shelf.<uesec>", unique enough in the trash.
+	rela = os.path.relpath(dirpath, local_store_dir)
+	trashname = "%s.%d"%(rela.replace(os.sep, '~'), uesec_now())
+	trashpath = os.path.join(trashdir, trashname)
+	os.rename(dirpath, trashpath)
+	return trashpath
+
+def trash_pending_bytes(local_store_dir):
+	"""Bytes that emptying the trash will reclaim but are not free yet: regular files in __trash__
+	that have no other hardlink, counted the way TrashPruner counts reclaimed bytes.
+	A pruner deleting the trash at the same time only makes this a bit less, never more, than true.
+	"""
+	total = 0
+	dirs_todo = [trash_dirpath(local_store_dir)]
+	while dirs_todo:
+		try:
+			it = os.scandir(dirs_todo.pop())
+		except OSError:
+			continue # not there, or removed by the pruner just now
+		with it:
+			for entry in it:
+				try:
+					if entry.is_dir(follow_symlinks=False):
+						dirs_todo.append(entry.path)
+						continue
+					st = entry.stat(follow_symlinks=False)
+				except OSError:
+					continue
+				if st.st_nlink==1 and stat.S_ISREG(st.st_mode):
+					total += st.st_size
+	return total
+
+def getmsg_prune_stats(st):
+	speed = "%d files/s, %.1f MB/s"%(st.files/st.seconds, st.bytes/st.seconds/1000000) if st.seconds>0 else "-"
+	return "Deleted %d files, reclaimed %d bytes (%.1f MB) in %.1f seconds (%s)."%(
+		st.files, st.bytes, st.bytes/1000000, st.seconds, speed)
+
+
+class TrashPruner:
+	"""Delete all content in local_store_dir/__trash__ using a pool of worker threads.
+
+	The work is split by directory: each worker deletes the files of one directory(using unlink
+	relative to the directory's fd, so that the kernel does not resolve the full path again and again)
+	and hands the sub-directories over to the next round. Empty directories are removed at the end.
+	"""
+
+	def __init__(self, local_store_dir, workers=prune_workers_default):
+		self.local_store_dir = local_store_dir
+		self.workers = max(1, workers)
+		self._mutex = threading.Lock()
+		self._files = 0
+		self._bytes = 0
+		#
+		self._thread = None
+		self._is_more = False
+		self.trash_filelock = AsFilelock(self.trash_dirpath + ".lck")
+
+	@property
+	def trash_dirpath(self):
+		return trash_dirpath(self.local_store_dir)
+
+	def empty_trash(self):
+		"""Delete everything in the trash, return PruneStats.
+		Caller should have acquired self.trash_filelock.
+		"""
+		uesec_start = time.time()
+		with self._mutex:
+			self._files = self._bytes = 0
+
+		try:
+			dirs_todo = [entry.path for entry in os.scandir(self.trash_dirpath)]
+		except FileNotFoundError:
+			dirs_todo = []
+
+		# Stray files in trash are treated as a directory with no sub-directory.
+		dirs_done = []
+		with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='irsync_prune') as executor:
+			while dirs_todo:
+				dirs_done.extend(dirs_todo)
+				dirs_next = []
+				for subdirs in executor.map(self._delete_dir_files, dirs_todo):
+					dirs_next.extend(subdirs)
+				dirs_todo = dirs_next
+
+		# All files are gone, remove the directory skeleton, deepest first.
+		for dirpath in reversed(dirs_done):
+			try:
+				os.rmdir(dirpath)
+			except NotADirectoryError:
+				self._unlink_one(None, dirpath)
+			except FileNotFoundError:
+				pass
+
+		return PruneStats(self._files, self._bytes, time.time()-uesec_start)
+
+	def _unlink_one(self, dir_fd, name):
+		try:
+			st = os.stat(name, dir_fd=dir_fd, follow_symlinks=False)
+			os.unlink(name, dir_fd=dir_fd)
+		except FileNotFoundError:
+			return
+		with self._mutex:
+			self._files += 1
+			if st.st_nlink==1 and stat.S_ISREG(st.st_mode):
+				self._bytes += st.st_size
+
+	def _delete_dir_files(self, dirpath):
+		"""Delete non-directory entries in dirpath, return a list of its sub-directories."""
+		if not os.path.isdir(dirpath) or os.path.islink(dirpath):
+			return [] # a stray file in trash, rmdir phase will take care of it
+
+		# rsync may have created read-only directories(mirroring the source side),
+		# we need write permission to delete its entries.
+		st = os.lstat(dirpath)
+		if not st.st_mode & stat.S_IWUSR:
+			os.chmod(dirpath, st.st_mode | stat.S_IRWXU)
+
+		subdirs = []
+		if _is_dir_fd_ok:
+			dir_fd = os.open(dirpath, os.O_RDONLY)
+			try:
+				with os.scandir(dir_fd) as it:
+					entries = list(it)
+				for entry in entries:
+					if entry.is_dir(follow_symlinks=False):
+						subdirs.append(os.path.join(dirpath, entry.name))
+					else:
+						self._unlink_one(dir_fd, entry.name)
+			finally:
+				os.close(dir_fd)
+		else: # e.g. Windows
+			with os.scandir(dirpath) as it:
+				entries = list(it)
+			for entry in entries:
+				if entry.is_dir(follow_symlinks=False):
+					subdirs.append(entry.path)
+				else:
+					if not entry.stat(follow_symlinks=False).st_mode & stat.S_IWUSR:
+						os.chmod(entry.path, stat.S_IWUSR|stat.S_IRUSR) # Windows refuses to delete read-only files
+					self._unlink_one(None, entry.path)
+
+		return subdirs
+
+	def start_background(self, logcall):
+		"""Empty the trash in a background thread. logcall(msg) reports result.
+		If the background thread is already running, it will do one more round for newly trashed ones.
+		"""
+		with self._mutex:
+			if self._thread and self._thread.is_alive():
+				self._is_more = True
+				return
+			self._is_more = True
+			self._thread = threading.Thread(target=self._thread_run, args=(logcall,),
+				name='TrashPruner for "%s"'%(self.local_store_dir))
+			self._thread.start()
+
+	def _thread_run(self, logcall):
+		try:
+			self.trash_filelock.lock()
+		except Err_asfilelock as e:
+			logcall("Not deleting old backups in %s now, since another process is doing it.\n    Detail: %s"%(
+				TRASH_NOD, e.errmsg))
+			return
+
+		try:
+			while True:
+				with self._mutex:
+					if not self._is_more:
+						break
+					self._is_more = False
+				st = self.empty_trash()
+				if st.files:
+					logcall("Old backups deleted in background. %s"%(getmsg_prune_stats(st)))
+		except OSError as e:
+			logcall("Deleting old backups in %s fails. %s"%(self.trash_dirpath, str(e)))
+		finally:
+			self.trash_filelock.unlock()
+
+	def join(self):
+		if self._thread:
+			self._thread.join()
+
+
+def irsync_prune_trash_cmd(argv):
+	ap = argparse.ArgumentParser(prog="irsync prune-trash",
+		description="Delete old backups that irsync has moved into <local_store_dir>/%s ."%(TRASH_NOD))
+	ap.add_argument('local_store_dir', type=str)
+	ap.add_argument('--workers', type=int, dest='workers', default=prune_workers_default,
+		help='Count of threads deleting files. Default is %(default)s.'
+	)
+	apargs = ap.parse_args(argv)
+
+	pruner = TrashPruner(os.path.abspath(apargs.local_store_dir), apargs.workers)
+	try:
+		pruner.trash_filelock.lock()
+	except Err_asfilelock as e:
+		print(e.errmsg)
+		return False
+
+	try:
+		st = pruner.empty_trash()
+	except OSError as e:
+		print("Error: %s"%(str(e)))
+		return False
+	finally:
+		pruner.trash_filelock.unlock()
+
+	print(getmsg_prune_stats(st))
+	return True
+
+if __name__ == '__main__':
+	succ = irsync_prune_trash_cmd(sys.argv[1:])
+	exit(0 if succ else 4)
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Retention policy: which old backups(finished ushelf dirs) to remove.
+
+Three kinds of rules, all optional:
+
+* Age: remove backups older than --old-days/--old-hours/--old-minutes. This is the only rule
+  irsync had in the past, and it alone still works exactly as before.
+
+* Grandfather-father-son(GFS): --keep-hourly/--keep-daily/--keep-weekly/--keep-monthly N keep
+  the newest backup of each of the last N hours/days/ISO weeks/months that have a backup, per shelf.
+  When any of them is given, a backup not kept by them is removed, unless it is younger than the
+  age rule above(so age becomes "keep everything within this period").
+
+* Free space: --min-free-percent X. If the filesystem of local_store_dir has less than X% free after
+  the above, more backups are removed, oldest first, until it would have. Bytes freed by removing a
+  backup are worked out from hardlink sharing(see space.py), not from `du`.
+
+Backups recorded in irsync.ini as last-success are never removed, bcz later incremental backups
+--link-dest to them.
+
+    python3 -m cheese.incremental_rsync.irsync_cmd retention <local_store_dir> [--keep-daily=7 ...]
+
+shows what would be removed, with the bytes each removal frees, but removes nothing.
+"""
+
+import os, sys, time, datetime
+import shutil
+import argparse
+from collections import namedtuple
+
+from .share import *
+from .helper import *
+from .catalog import *
+from .space import compute_removal_gains
+from .pruner import trash_pending_bytes
+from .irsync_cmd import non_negative_int
+
+RetentionPolicy = namedtuple('RetentionPolicy',
+	"old_seconds keep_hourly keep_daily keep_weekly keep_monthly min_free_percent")
+
+# reason: 'age', 'gfs' or 'space'. reclaim_bytes: bytes freed when removing it(after removing
+# candidates before it), -1 if not computed.
+RetentionCandidate = namedtuple('RetentionCandidate', "dirpath_rela uesec reason reclaim_bytes")
+
+# candidates: to remove, in this order. spared: CatalogItem that rules would remove, but are last-success.
+# free_bytes/total_bytes: of the filesystem now. need_bytes: to free for min_free_percent, 0 if no need.
+# trash_bytes: what backups already in __trash__ will free once pruned, taken off need_bytes.
+RetentionPlan = namedtuple('RetentionPlan', "candidates spared free_bytes total_bytes need_bytes trash_bytes")
+
+def make_retention_policy(apargs):
+	return RetentionPolicy(DHMS_to_Seconds(apargs.old_days, apargs.old_hours, apargs.old_minutes),
+		apargs.keep_hourly, apargs.keep_daily, apargs.keep_weekly, apargs.keep_monthly, apargs.min_free_percent)
+
+def is_gfs_policy(policy):
+	# >0, not just non-zero: a GFS policy that keeps nothing would remove every backup.
+	return any(count>0 for count in (policy.keep_hourly, policy.keep_daily, policy.keep_weekly, policy.keep_monthly))
+
+def is_retention_wanted(policy):
+	return policy.old_seconds>0 or is_gfs_policy(policy) or policy.min_free_percent>0
+
+def _gfs_buckets(policy):
+	# (count to keep, function: datetime -> bucket key)
+	return [
+		(policy.keep_hourly, lambda dt: dt.strftime('%Y%m%d%H')),
+		(policy.keep_daily, lambda dt: dt.strftime('%Y%m%d')),
+		(policy.keep_weekly, lambda dt: dt.isocalendar()[0:2]),
+		(policy.keep_monthly, lambda dt: dt.strftime('%Y%m')),
+	]
+
+def gfs_keep(items, policy):
+	"""Return set of dirpath_rela kept by GFS rules. items: CatalogItem of any shelves.
+	For each shelf and each rule, walking from the newest backup, the first backup seen in a
+	new hour/day/week/month is kept, until that rule has kept its count.
+	"""
+	by_ushelf = {}
+	for item in items:
+		by_ushelf.setdefault(item.ushelf, []).append(item)
+
+	kept = set()
+	for count, bucket_of in _gfs_buckets(policy):
+		if count<=0:
+			continue
+		for ushelf_items in by_ushelf.values():
+			seen = set()
+			for item in sorted(ushelf_items, key=lambda it: it.uesec, reverse=True):
+				if len(seen) >= count:
+					break
+				bucket = bucket_of(datetime.datetime.fromtimestamp(item.uesec))
+				if bucket not in seen:
+					seen.add(bucket)
+					kept.add(item.dirpath_rela)
+	return kept
+
+def _rule_victims(items, policy, uesec_now):
+	"""Return [(CatalogItem, reason)] removed by age or GFS rules, oldest first."""
+	if is_gfs_policy(policy):
+		kept = gfs_keep(items, policy)
+		victims = [(item, 'gfs') for item in items
+			if item.dirpath_rela not in kept and uesec_now - item.uesec > policy.old_seconds]
+	elif policy.old_seconds>0:
+		victims = [(item, 'age') for item in items if uesec_now - item.uesec > policy.old_seconds]
+	else:
+		victims = []
+	return sorted(victims, key=lambda t: t[0].uesec)
+
+def plan_retention(local_store_dir, items, protected, policy, uesec_now=None, need_gains=False):
+	"""Work out which backups to remove. Nothing is removed here.
+
+	items: CatalogItem of existing backups in local_store_dir.
+	protected: set of dirpath_rela that must be kept(last-success).
+	need_gains: compute reclaim_bytes even if min_free_percent does not need them.
+
+	Return RetentionPlan.
+	"""
+	if uesec_now is None:
+		uesec_now = int(time.time())
+
+	spared = []
+	victims = []
+	for item, reason in _rule_victims(items, policy, uesec_now):
+		if item.dirpath_rela in protected:
+			spared.append(item)
+		else:
+			victims.append((item, reason))
+
+	du = shutil.disk_usage(local_store_dir)
+	need_bytes = 0
+	trash_bytes = 0
+	extras = []
+	if policy.min_free_percent>0:
+		need_bytes = max(0, int(du.total*policy.min_free_percent/100) - du.free)
+		if need_bytes>0:
+			# Backups removed earlier(--prune-workers=0, or a pruner of another session still running)
+			# are not free space yet, but will be. Without this, each run would remove more backups
+			# for the same shortage.
+			trash_bytes = trash_pending_bytes(local_store_dir)
+			need_bytes = max(0, need_bytes - trash_bytes)
+		if need_bytes>0:
+			victim_dirs = {item.dirpath_rela for item, _ in victims}
+			extras = [(item, 'space') for item in sorted(items, key=lambda it: it.uesec)
+				if item.dirpath_rela not in victim_dirs and item.dirpath_rela not in protected]
+
+	sequence = victims + extras
+	if need_bytes>0 or (need_gains and sequence):
+		gains = compute_removal_gains(local_store_dir, [item.dirpath_rela for item in items],
+			[item.dirpath_rela for item, _ in sequence])
+	else:
+		gains = [-1]*len(sequence)
+
+	if need_bytes>0:
+		# Rule victims go anyway; take extras only as far as the free space target needs.
+		freed = sum(gains[:len(victims)])
+		count = len(victims)
+		while count < len(sequence) and freed < need_bytes:
+			freed += gains[count]
+			count += 1
+		sequence = sequence[:count]
+
+	candidates = [RetentionCandidate(item.dirpath_rela, item.uesec, reason, gains[i])
+		for i, (item, reason) in enumerate(sequence)]
+	return RetentionPlan(candidates, spared, du.free, du.total, need_bytes, trash_bytes)
+
+def getmsg_retention_candidate(cand, uesec_now):
+	seconds_old = uesec_now - cand.uesec
+	str_DHM = "{} days, {} hours, {} minutes".format(*Seconds_to_DHMS(seconds_old)[0:3])
+	str_bytes = ", %d bytes reclaimable"%(cand.reclaim_bytes) if cand.reclaim_bytes>=0 else ""
+	return "%s (by %s rule, created %s ago%s)"%(cand.dirpath_rela, cand.reason, str_DHM, str_bytes)
+
+def add_retention_arguments(ap):
+	"""Retention options, shared by irsync main command and `irsync retention`."""
+	ap.add_argument('--keep-hourly', type=non_negative_int, dest='keep_hourly', default=0,
+		help='GFS retention: keep the newest backup of each of the last N hours that have one, per shelf.'
+	)
+	ap.add_argument('--keep-daily', type=non_negative_int, dest='keep_daily', default=0,
+		help='GFS retention: keep the newest backup of each of the last N days, per shelf. '
+			'When any --keep-* is given, other backups are removed unless younger than --old-days etc.'
+	)
+	ap.add_argument('--keep-weekly', type=non_negative_int, dest='keep_weekly', default=0,
+		help='GFS retention: keep the newest backup of each of the last N ISO weeks, per shelf.'
+	)
+	ap.add_argument('--keep-monthly', type=non_negative_int, dest='keep_monthly', default=0,
+		help='GFS retention: keep the newest backup of each of the last N months, per shelf.'
+	)
+	ap.add_argument('--min-free-percent', type=float, dest='min_free_percent', default=0,
+		help='If the filesystem of local_store_dir has less free space than this, remove more old backups, '
+			'oldest first, until it would have. Default 0 means no free space target.'
+	)
+
+def irsync_retention_cmd(argv):
+	ap = argparse.ArgumentParser(prog="irsync retention",
+		description="Show which old backups a retention policy would remove, and the bytes each removal frees. "
+			"Nothing is removed; removal happens when irsync runs a backup with the same options.")
+	ap.add_argument('local_store_dir', type=str)
+	ap.add_argument('--old-days', type=non_negative_int, dest='old_days', default=0)
+	ap.add_argument('--old-hours', type=non_negative_int, dest='old_hours', default=0)
+	ap.add_argument('--old-minutes', type=non_negative_int, dest='old_minutes', default=0)
+	add_retention_arguments(ap)
+	apargs = ap.parse_args(argv)
+
+	local_store_dir = os.path.abspath(apargs.local_store_dir)
+	catalog = UshelfCatalog(local_store_dir)
+	if not catalog.exists():
+		print('Error: No backup catalog in "%s". Run `irsync catalog-rebuild` first.'%(local_store_dir))
+		return False
+
+	from .irsync_client import get_last_success_dirpaths
+	policy = make_retention_policy(apargs)
+	items = [item for item in catalog.list_ushelfs() if os.path.isdir(os.path.join(local_store_dir, item.dirpath_rela))]
+	try:
+		plan = plan_retention(local_store_dir, items, get_last_success_dirpaths(local_store_dir), policy,
+			need_gains=True)
+	except OSError as e:
+		print("Error: %s"%(str(e)))
+		return False
+
+	uesec_now = int(time.time())
+	print("Filesystem has %.1f GB free of %.1f GB."%(plan.free_bytes/1e9, plan.total_bytes/1e9))
+	if plan.trash_bytes>0:
+		print("Trash has %d bytes to be freed by prune-trash."%(plan.trash_bytes))
+	for item in plan.spared:
+		print("Keep (last-success) %s"%(item.dirpath_rela))
+	for cand in plan.candidates:
+		print("Would remove %s"%(getmsg_retention_candidate(cand, uesec_now)))
+	print("%d of %d backups would be removed, freeing %d bytes."%(
+		len(plan.candidates), len(items), sum(c.reclaim_bytes for c in plan.candidates)))
+	return True
+
+if __name__ == '__main__':
+	succ = irsync_retention_cmd(sys.argv[1:])
+	exit(0 if succ else 4)
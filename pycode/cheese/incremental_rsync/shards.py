@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Split one rsync source into N shards, for `irsync --shards=N`.
+
+A single rsync process is bound by one CPU(checksumming, building the file list), so one big rsync module
+may not fill a fast link. With --shards, the top-level entries of the source are distributed into
+N shards of about equal size, and N rsync processes transfer them into the same .working dir concurrently,
+each one given its part with --files-from.
+
+Entry sizes come from the previous backup generation when it has the entry, otherwise from
+`rsync --list-only`(which tells the size of a top-level file, but not of a top-level directory).
+"""
+
+import os, sys, time
+import heapq
+import itertools
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from .share import *
+from .helper import *
+
+# name: top-level entry name, relative to the rsync source dir.
+# size: estimated bytes, -1 if unknown.
+ShardEntry = namedtuple('ShardEntry', "name is_dir size")
+
+# names: list of top-level entry names. size: sum of estimated entry sizes.
+Shard = namedtuple('Shard', "index names size")
+
+RSYNC_LIST_TOPLEVEL_SECONDS = 600
+
+# User's rsync params that matter for listing: what is listed, and how to connect. Others, like -r or -a,
+# are not for `rsync --list-only`, with -r it would list the whole tree instead of the top level.
+LISTING_OPTIONS = ('--exclude', '--exclude-from', '--include', '--include-from', '--filter', '-f',
+	'--password-file', '--port', '-e', '--rsh')
+
+def listing_params(rsync_extra_params):
+	"""Pick from rsync_extra_params those in LISTING_OPTIONS, in "--opt=value", "--opt value",
+	or "-evalue" form.
+	"""
+	params = []
+	it = iter(rsync_extra_params)
+	for param in it:
+		name = param.split('=', 1)[0]
+		if name in LISTING_OPTIONS:
+			params.append(param)
+			if '=' not in param: # its value is the next param
+				params += list(itertools.islice(it, 1))
+		elif param[:2] in ('-e', '-f') and len(param)>2 and not param.startswith('--'):
+			params.append(param) # like -essh
+	return params
+
+def list_toplevel_entries(rsync_url, rsync_extra_params=[]):
+	"""Ask the rsync server for top-level entries of rsync_url(which ends with '/').
+	Return a list of ShardEntry. Raise Err_irsync on error.
+	"""
+	# Without -r, --list-only shows the directory content one level deep.
+	# Some of user's rsync params are passed as well, so that --exclude or --password-file etc take effect.
+	argv = ["rsync", "--list-only"] + listing_params(rsync_extra_params) + [rsync_url]
+	exitcode, output, kill_at_uesec = run_exe_grab_output_with_timeout(argv, RSYNC_LIST_TOPLEVEL_SECONDS,
+		{"shell":False, "env":rsync_child_env()})
+	if exitcode!=0:
+		raise Err_irsync("Listing top-level entries with `%s` fails, exitcode=%d. rsync says:\n%s"%(
+			glueup_shell_cmd(argv), exitcode, output.rstrip()[-2000:]), exitcode)
+
+	entries = []
+	for line in output.splitlines():
+		# "drwxr-xr-x          4,096 2020/04/11 20:31:01 some dir"
+		# "lrwxrwxrwx             11 2020/04/11 20:31:01 link -> target"
+		fields = line.split(None, 4)
+		if len(fields)<5 or len(fields[0])!=10:
+			continue # not a file entry line, e.g. the MOTD of rsync daemon
+		perms, sizetext, _, _, name = fields
+		if perms.startswith('l'):
+			name = name.rsplit(' -> ', 1)[0]
+		if name=='.':
+			continue
+
+		is_dir = perms.startswith('d')
+		try:
+			size = -1 if is_dir else int(sizetext.replace(',', ''))
+		except ValueError:
+			size = -1 # never drop the entry, it would be in no shard and not backed up at all
+		entries.append(ShardEntry(name, is_dir, size))
+
+	return entries
+
+def tree_size(dirpath):
+	"""Sum of regular file sizes under dirpath, not following symlinks. 0 if dirpath does not exist."""
+	total = 0
+	dirs_todo = [dirpath]
+	while dirs_todo:
+		try:
+			it = os.scandir(dirs_todo.pop())
+		except OSError:
+			continue
+		with it:
+			for entry in it:
+				if entry.is_dir(follow_symlinks=False):
+					dirs_todo.append(entry.path)
+				elif entry.is_file(follow_symlinks=False):
+					total += entry.stat(follow_symlinks=False).st_size
+	return total
+
+def estimate_entry_sizes(entries, prev_ushelf_dirpath, workers=4):
+	"""Fill in sizes of top-level directories from the previous generation(a finished ushelf dir).
+	A directory not seen before gets the median size of the known ones, a guess that at least
+	keeps new directories from piling up in one shard.
+	"""
+	if prev_ushelf_dirpath and os.path.isdir(prev_ushelf_dirpath):
+		def one(entry):
+			if entry.size>=0:
+				return entry
+			prev_path = os.path.join(prev_ushelf_dirpath, entry.name)
+			if not os.path.isdir(prev_path) or os.path.islink(prev_path):
+				return entry
+			return entry._replace(size=tree_size(prev_path))
+
+		with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='irsync_shard_size') as executor:
+			entries = list(executor.map(one, entries))
+
+	known = sorted(e.size for e in entries if e.size>=0)
+	guess = known[len(known)//2] if known else 1
+	return [e if e.size>=0 else e._replace(size=guess) for e in entries]
+
+def balance_shards(entries, nshards):
+	"""Distribute entries into nshards by greedy LPT(longest processing time first): take the entries
+	from the biggest down, each goes to the currently smallest shard.
+	Return a list of Shard, empty shards omitted.
+	"""
+	heap = [(0, i) for i in range(nshards)] # (size, shard index)
+	names = [[] for i in range(nshards)]
+	for entry in sorted(entries, key=lambda e: e.size, reverse=True):
+		size, i = heapq.heappop(heap)
+		names[i].append(entry.name)
+		heapq.heappush(heap, (size+max(entry.size, 0), i))
+
+	sizes = {i:size for size, i in heap}
+	shards = [Shard(i, sorted(names[i]), sizes[i]) for i in range(nshards) if names[i]]
+	return [shard._replace(index=k) for k, shard in enumerate(shards)]
+
+def write_files_from(filepath, names):
+	"""Write names as rsync --files-from content, NUL separated(use with --from0),
+	so that any character in a filename is OK.
+	"""
+	with open(filepath, "wb") as fh:
+		for name in names:
+			fh.write(os.fsencode(name) + b'\0')
@@ -9,9 +9,16 @@ import re
 import datetime
 import shlex
 import glob
+import collections
+import threading
+import asyncio
 from enum import Enum,IntEnum # since Python 3.4
 from .helper import *
-from cheese.subprocess_tools import pipe_process_with_timeout
+from .fastpath import datetime_by_pattern, next_datetime_boundary
+from cheese.subprocess_tools import pipe_process_with_timeout, async_pipe_process_with_timeout
+
+LOG_NOD = '__logs__' # as directory node name for storing log files.
+ININAM_sess_done = '_irsync_backup_done.ini' # in a ushelf dir, tells the backup is complete
 
 class MsgLevel(IntEnum):
 	err = 1
@@ -68,21 +75,6 @@ def datetime_str_now___set_aside():
 		now.hour, now.minute, now.second, now.microsecond/1000)
 	return timestr
 
-def datetime_by_pattern(pattern):
-	# Example: pattern="YYYYMMDD.hhmmss"
-	# Return: "20200411.153300"
-	
-	now = datetime.datetime.now()
-	
-	dt = pattern
-	dt = dt.replace("YYYY", "%04d"%(now.year))
-	dt = dt.replace("MM", "%02d"%(now.month))
-	dt = dt.replace("DD", "%02d"%(now.day))
-	dt = dt.replace("hh", "%02d"%(now.hour))
-	dt = dt.replace("mm", "%02d"%(now.minute)) # use lower-case mm so not to conflict with Month
-	dt = dt.replace("ss", "%02d"%(now.second))
-	return dt
-
 def _create_logfile_with_seq_once(filepath_pattern):
 	
 	# Example: filepath_pattern = "/rootdir/run*.log"
@@ -201,28 +193,394 @@ def y_run_exe_with_time_limit(cmd_args, max_run_secs=0, dict_Popen_args={}):
 
 	return (subproc.returncode, watchdog.uesec_timeout_fired) # return a tuple: subprocess exitcode and force-kill uesec
 
-def run_exe_log_output_and_print(cmd_args, max_run_secs, dict_Popen_args={}, logfile_handle=None):
+def rsync_child_env():
+	"""Environment for rsync child processes, with LC_NUMERIC=C, so that rsync prints numbers as
+	"1,234,567" and "0.001" whatever the user's locale; other locales would give "1.234.567" or "0,001".
+	LC_CTYPE is kept(from LC_ALL if that was set), so non-ASCII filenames are still printed as is.
+	"""
+	env = dict(os.environ)
+	lc_all = env.pop('LC_ALL', None) # it would override LC_NUMERIC
+	if lc_all:
+		env['LC_CTYPE'] = lc_all
+	env['LC_NUMERIC'] = 'C'
+	return env
+
+class RsyncOutputWatcher:
+	"""Watch rsync's console output as it streams by, and pick up interesting facts from it.
+
+	This way we learn things about the server side from the very rsync run that does the
+	transfer, instead of spawning an extra rsync(e.g. `rsync --list-only`) that costs
+	another connect/auth/handshake.
+
+	Numbers come from `rsync --stats` summary, and from `--info=progress2` lines if the user
+	has asked for them. A number that has not been seen stays -1, so does one that cannot be
+	parsed(rsync not run with rsync_child_env()); such lines are kept in .unparsed_lines .
+	"""
+
+	# `rsync --stats` line heading -> attribute name
+	stats_items = {
+		# "Number of files: 1,234 (reg: 1,000, dir: 234)", the count includes the "." entry.
+		"Number of files": 'num_files',
+		"Number of created files": 'num_created_files',
+		"Number of deleted files": 'num_deleted_files',
+		"Number of regular files transferred": 'num_reg_transferred',
+		"Total file size": 'total_file_size',
+		"Total transferred file size": 'total_transferred_size',
+		"Literal data": 'literal_data',
+		"Matched data": 'matched_data',
+		"File list size": 'file_list_size',
+		"File list generation time": 'file_list_gen_seconds',
+		"File list transfer time": 'file_list_xfer_seconds',
+		"Total bytes sent": 'total_bytes_sent',
+		"Total bytes received": 'total_bytes_received',
+	}
+	_re_stats = re.compile(r"([A-Z][a-z ]+): ([0-9,.]+)")
+	# "total size is 5,678  speedup is 12.34"
+	_re_speedup = re.compile(r"total size is [0-9,]+  speedup is ([0-9.]+)")
+	# "    123,456,789  45%   10.50MB/s    0:00:12 (xfr#3, to-chk=10/100)"
+	_re_progress2 = re.compile(r"\s*([0-9,]+)\s+([0-9]+)%\s+(\S+/s)\s+([0-9:]+)")
+
+	def __init__(self):
+		for attrname in __class__.stats_items.values():
+			setattr(self, attrname, -1)
+		self.num_reg_files = -1 # from the "(reg: 1,000" part of "Number of files:", rsync 3.1+ only
+		self.speedup = -1
+		#
+		self.progress2_bytes = -1
+		self.progress2_percent = -1
+		self.progress2_rate = "" # rsync's human readable text, like "10.50MB/s"
+		self.progress2_elapsed = "" # like "0:00:12"
+		self.unparsed_lines = []
+
+	@staticmethod
+	def _parse_number(attrname, numtext):
+		# In C locale, counts and bytes are like "1,234,567", seconds like "0.001". Raise ValueError
+		# on anything else, e.g. "1.234.567" or "0,001" from another locale, instead of guessing.
+		if attrname.endswith('_seconds'):
+			return float(numtext)
+		return int(numtext.replace(',', ''))
+
+	def feed_line(self, textline):
+		r = __class__._re_stats.match(textline)
+		if r:
+			attrname = __class__.stats_items.get(r.group(1))
+			if attrname:
+				try:
+					setattr(self, attrname, __class__._parse_number(attrname, r.group(2)))
+					if attrname=='num_files':
+						r = re.search(r"\(reg: ([0-9,.]+)", textline)
+						if r:
+							self.num_reg_files = __class__._parse_number('num_reg_files', r.group(1))
+				except ValueError:
+					self.unparsed_lines.append(textline.rstrip())
+			return
+
+		if textline.startswith("total size is"):
+			r = __class__._re_speedup.match(textline)
+			if r:
+				try:
+					self.speedup = float(r.group(1))
+				except ValueError: # like "1.2.3"
+					self.unparsed_lines.append(textline.rstrip())
+		elif '%' in textline:
+			# progress2 refreshes itself with '\r', so one "line" carries many updates, the last one counts.
+			r = __class__._re_progress2.match(textline.rstrip().rsplit('\r', 1)[-1])
+			if r:
+				self.progress2_bytes = int(r.group(1).replace(',', ''))
+				self.progress2_percent = int(r.group(2))
+				self.progress2_rate = r.group(3)
+				self.progress2_elapsed = r.group(4)
+
+	def feed_tail(self, tailbytes):
+		"""Feed the last part of rsync output, for the chunked pump(run_exe_pump_output), which does not
+		split output into lines. All what we want, --stats summary and final progress2 update,
+		is at the very end of rsync output.
+		"""
+		lines = tailbytes.decode("utf8", errors="replace").split('\n')
+		for textline in lines[1:]: # lines[0] is probably cut in the middle
+			self.feed_line(textline+'\n')
+
+	@property
+	def is_source_empty(self):
+		# Only the "." entry, i.e. "this directory", is seen.
+		return 0 <= self.num_files <= 1
+
+	@classmethod
+	def merged(cls, watchers):
+		"""Combine the watchers of rsync processes that ran concurrently(sharded transfer) into one.
+		Counts and bytes are summed, times take the longest one.
+		"""
+		result = cls()
+		for attrname in list(cls.stats_items.values()) + ['num_reg_files']:
+			values = [getattr(w, attrname) for w in watchers if getattr(w, attrname)>=0]
+			if not values:
+				continue
+			if attrname.endswith('_seconds'):
+				setattr(result, attrname, max(values))
+			else:
+				setattr(result, attrname, sum(values))
+
+		wire_bytes = result.total_bytes_sent + result.total_bytes_received
+		if result.total_file_size>=0 and result.total_bytes_sent>=0 and wire_bytes>0:
+			result.speedup = round(result.total_file_size / wire_bytes, 2) # as rsync calculates it
+		return result
+
+	def to_dict(self):
+		attrnames = list(__class__.stats_items.values()) + ['num_reg_files', 'speedup',
+			'progress2_bytes', 'progress2_percent', 'progress2_rate', 'progress2_elapsed']
+		return {attrname:getattr(self, attrname) for attrname in attrnames}
+
+def run_exe_log_output_and_print(cmd_args, max_run_secs, dict_Popen_args={}, logfile_handle=None,
+		line_watcher=None):
 	
 	gen_childoutput = Generator(y_run_exe_with_time_limit(cmd_args, max_run_secs, dict_Popen_args))
 	for line in gen_childoutput:
 		textline = line.decode("utf8")
 		if logfile_handle:
 			logfile_handle.write(textline)
+		if line_watcher:
+			line_watcher(textline)
 		print(textline, end='')
 
 	(child_exitcode, kill_at_uesec) = gen_childoutput.retvalue
 	return (child_exitcode, kill_at_uesec)
 
 
+PUMP_CHUNK_SIZE = 256*1024 # max bytes read from child's pipe at once
+PUMP_TAIL_SIZE = 64*1024 # keep this many bytes at output tail, for RsyncOutputWatcher and ConsoleEcho
+PUMP_FEED_DOG_SECONDS = 1.0
+# When the child outputs fast, each os.read() only gets the little it has written so far, so we do
+# many tiny reads. If a read gets less than PUMP_SMALL_CHUNK, pause a bit to let the pipe fill up.
+PUMP_SMALL_CHUNK = 16*1024
+PUMP_COALESCE_SECONDS = 0.002
+PUMP_TICK_SECONDS = 1.0 # how often on_tick of run_exe_pump_output() is called
+
+class ConsoleEcho:
+	"""Echo a child process's output to console, in one of these modes:
+
+	* 'full': everything, as is.
+	* 'rate': at most rate_lines lines per second, the excess is counted but not shown.
+	* 'summary': a line telling the progress every summary_seconds.
+
+	With 'rate' and 'summary', when the child ends, its last few lines are shown as well, so that
+	rsync's final statistics and error messages are not missed.
+	"""
+	modes = ('full', 'rate', 'summary')
+
+	def __init__(self, mode='full', rate_lines=20, summary_seconds=5.0, tail_lines=30, name='rsync'):
+		if mode not in __class__.modes:
+			raise ValueError("ConsoleEcho mode must be one of: %s"%(', '.join(__class__.modes)))
+		self.mode = mode
+		self.rate_lines = rate_lines
+		self.summary_seconds = summary_seconds
+		self.tail_lines = tail_lines
+		self.name = name
+		#
+		self._out = sys.stdout.buffer if hasattr(sys.stdout, 'buffer') else None
+		self._lines = 0
+		self._bytes = 0
+		self._hidden_lines = 0 # in current rate window
+		self._hidden_total = 0
+		self._budget = rate_lines
+		self._tick_window = self._tick_summary = time.monotonic()
+
+	def _write(self, data):
+		if self._out:
+			self._out.write(data)
+			self._out.flush()
+		else:
+			print(data.decode("utf8", errors="replace"), end='')
+
+	def feed(self, chunk):
+		if self.mode=='full':
+			self._write(chunk)
+			return
+
+		nlines = chunk.count(b'\n')
+		self._lines += nlines
+		self._bytes += len(chunk)
+		now = time.monotonic()
+
+		if self.mode=='rate':
+			if now - self._tick_window >= 1.0:
+				if self._hidden_lines:
+					self._write(b"    [... %d lines not shown ...]\n"%(self._hidden_lines))
+				self._tick_window = now
+				self._budget = self.rate_lines
+				self._hidden_lines = 0
+
+			if nlines <= self._budget:
+				self._write(chunk)
+				self._budget -= nlines
+			else:
+				cut = -1
+				for i in range(self._budget): # find the budget-th '\n'
+					cut = chunk.find(b'\n', cut+1)
+				self._write(chunk[:cut+1])
+				self._hidden_lines += nlines - self._budget
+				self._hidden_total += nlines - self._budget
+				self._budget = 0
+
+		else: # 'summary'
+			if now - self._tick_summary >= self.summary_seconds:
+				self._tick_summary = now
+				lastline = chunk.rstrip(b'\r\n').rsplit(b'\n', 1)[-1].rsplit(b'\r', 1)[-1]
+				self._write(b"[%s] %d lines, %d bytes of output so far. Latest: %s\n"%(
+					self.name.encode(), self._lines, self._bytes, lastline[-120:]))
+			self._hidden_total += nlines
+
+	def finish(self, tailbytes):
+		if self.mode=='full' or self._hidden_total==0:
+			return
+		lines = tailbytes.split(b'\n')[1:][-self.tail_lines-1:] # last one is normally empty
+		self._write(b"[%s] Output ends with %d lines, %d bytes. Last lines are:\n"%(
+			self.name.encode(), self._lines, self._bytes))
+		self._write(b'\n'.join(lines))
+
+class _PumpSink:
+	"""Where run_exe_pump_output() and run_exe_pump_output_async() deliver child output chunks:
+	the logfile, the console, and a window of output tail for RsyncOutputWatcher.
+	"""
+	def __init__(self, logfile_handle, watcher, echo):
+		self.logfile_handle = logfile_handle
+		self.watcher = watcher
+		self.echo = echo if echo else ConsoleEcho('full')
+		self.tail_chunks = collections.deque()
+		self.tail_len = 0
+		sys.stdout.flush() # since we will write to sys.stdout.buffer directly
+
+	def feed(self, chunk):
+		if self.logfile_handle:
+			self.logfile_handle.write(chunk)
+		self.echo.feed(chunk)
+
+		self.tail_chunks.append(chunk)
+		self.tail_len += len(chunk)
+		while self.tail_len - len(self.tail_chunks[0]) >= PUMP_TAIL_SIZE:
+			self.tail_len -= len(self.tail_chunks.popleft())
+
+	def finish(self):
+		tail = b''.join(self.tail_chunks)
+		if self.watcher:
+			self.watcher.feed_tail(tail)
+		self.echo.finish(tail)
+
+class _PumpTicker(threading.Thread):
+	"""Calls on_tick every PUMP_TICK_SECONDS while the child runs, whether or not it outputs anything.
+	If on_tick returns True, the child is terminated.
+	"""
+	def __init__(self, on_tick, terminate):
+		super().__init__(name='pump_ticker', daemon=True)
+		self.on_tick = on_tick
+		self.terminate = terminate
+		self._evt_done = threading.Event()
+
+	def run(self):
+		while not self._evt_done.wait(PUMP_TICK_SECONDS):
+			if self.on_tick():
+				self.terminate()
+				return
+
+	def done(self):
+		self._evt_done.set()
+		self.join()
+
+async def _pump_tick_async(on_tick, proc):
+	loop = asyncio.get_running_loop()
+	while True:
+		await asyncio.sleep(PUMP_TICK_SECONDS)
+		# In a worker thread, bcz on_tick may block(BandwidthShare takes a filelock), which would stall
+		# all pumps of this event loop.
+		if await loop.run_in_executor(None, on_tick):
+			try:
+				proc.terminate()
+			except ProcessLookupError:
+				pass # it has just ended
+			return
+
+def run_exe_pump_output(cmd_args, max_run_secs, dict_Popen_args={}, logfile_handle=None,
+		watcher=None, echo=None, on_tick=None):
+	"""Like run_exe_log_output_and_print(), but much lighter on CPU for child processes that output
+	millions of lines(rsync -av): output is pumped in big chunks, written to logfile as raw bytes,
+	never decoded or split into lines.
+
+	logfile_handle: a file object opened in binary mode.
+	watcher: a RsyncOutputWatcher, it is fed with output tail when child ends.
+	echo: a ConsoleEcho, tells how output is shown on console. None means 'full'.
+	on_tick: a function called about every PUMP_TICK_SECONDS(from another thread) while child runs.
+	    If it returns True, the child is terminated(SIGTERM), and we return as the child ends.
+	"""
+	sink = _PumpSink(logfile_handle, watcher, echo)
+	with subprocess.Popen(cmd_args,
+			stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=0,
+	 		**dict_Popen_args) as subproc:
+
+		ticker = None
+		if on_tick:
+			ticker = _PumpTicker(on_tick, subproc.terminate)
+			ticker.start()
+
+		with pipe_process_with_timeout(subproc, 0, max_run_secs) as watchdog:
+			fd = subproc.stdout.fileno()
+			tick_fed = time.monotonic()
+			while True:
+				chunk = os.read(fd, PUMP_CHUNK_SIZE) # returns as soon as some bytes are available
+				if not chunk:
+					break # sub-process has ended
+
+				sink.feed(chunk)
+
+				now = time.monotonic()
+				if now - tick_fed >= PUMP_FEED_DOG_SECONDS:
+					watchdog.feed_dog()
+					tick_fed = now
+
+				if len(chunk) < PUMP_SMALL_CHUNK:
+					time.sleep(PUMP_COALESCE_SECONDS)
+
+		if ticker:
+			ticker.done()
+
+	sink.finish()
+	return (subproc.returncode, watchdog.uesec_timeout_fired)
+
+async def run_exe_pump_output_async(cmd_args, max_run_secs, dict_Popen_args={}, logfile_handle=None,
+		watcher=None, echo=None, on_tick=None):
+	"""The asyncio version of run_exe_pump_output(), same parameters and same return value.
+	No thread is created for the child, so one event loop can drive many rsync processes at once:
+
+	    results = await asyncio.gather(*[run_exe_pump_output_async(argv, 3600, ...) for argv in argvs])
+
+	Note: logfile_handle is written synchronously, which is fine for local files.
+	on_tick is called in a worker thread of the event loop's default executor, so it may block.
+	"""
+	sink = _PumpSink(logfile_handle, watcher, echo)
+	async with async_pipe_process_with_timeout(cmd_args, 0, max_run_secs, **dict_Popen_args) as watchdog:
+		ticker = asyncio.ensure_future(_pump_tick_async(on_tick, watchdog.proc)) if on_tick else None
+		while True:
+			chunk = await watchdog.proc.stdout.read(PUMP_CHUNK_SIZE)
+			if not chunk:
+				break # sub-process has ended
+
+			sink.feed(chunk)
+
+			if len(chunk) < PUMP_SMALL_CHUNK:
+				await asyncio.sleep(PUMP_COALESCE_SECONDS)
+		if ticker:
+			ticker.cancel()
+
+	sink.finish()
+	return watchdog.result
+
+
 def run_exe_grab_output_with_timeout(cmd_args, max_run_secs, dict_Popen_args={}):
 	gen_childoutput = Generator(y_run_exe_with_time_limit(cmd_args, max_run_secs, dict_Popen_args))
-	output = ""
+	lines = [] # not `output += textline`, which is quadratic for long output
 	for line in gen_childoutput:
-		textline = line.decode("utf8")
-		output += textline
+		lines.append(line.decode("utf8"))
 
 	(child_exitcode, kill_at_uesec) = gen_childoutput.retvalue
-	return (child_exitcode, output, kill_at_uesec)
+	return (child_exitcode, ''.join(lines), kill_at_uesec)
 
 
 if __name__=='__main__':
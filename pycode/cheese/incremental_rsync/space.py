@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Disk space accounting of backup generations(finished ushelf dirs) in a local_store_dir.
+
+Generations share files through hardlinks, so `du` of one generation does not tell how much
+space deleting it would free. For each generation, we report:
+
+* total bytes: all files in it, each inode counted once.
+* unique bytes: held by inodes that no other generation references, i.e. freed by deleting it.
+* shared bytes: total - unique.
+
+Each generation is scanned once into a sorted array of (inode, size) pairs, cached in
+local_store_dir/irsync-space-cache/ . A finished generation does not change(except by
+`irsync dedup` over old backups, which drops the cache of each generation it changes), so after
+a backup, only the new generation is scanned. The cached arrays are then merged(like merge sort) to count references of each inode,
+streaming from the cache files, so memory use does not grow with the count of generations.
+
+    python3 -m cheese.incremental_rsync.irsync_cmd space <local_store_dir> [--rescan]
+"""
+
+import os, sys, time
+import heapq
+import argparse
+import itertools
+from array import array
+from collections import namedtuple
+
+from .share import *
+from .helper import *
+from .catalog import *
+
+DIRNAM_space_cache = 'irsync-space-cache'
+CACHE_SUFFIX = '.v1.inodes'
+CACHE_READ_PAIRS = 65536
+SCAN_SORT_PAIRS = 256*1024 # pairs sorted as Python objects at once, see scan_generation()
+
+# dirpath_rela: generation dir relative to local_store_dir.
+SpaceUsage = namedtuple('SpaceUsage', "dirpath_rela files total_bytes unique_bytes shared_bytes")
+
+def _cache_filepath(local_store_dir, dirpath_rela):
+	# "20200411/server.shelf" -> "20200411~server.shelf.v1.inodes"
+	return os.path.join(local_store_dir, DIRNAM_space_cache, dirpath_rela.replace(os.sep, '~') + CACHE_SUFFIX)
+
+def _y_array_pairs(arr):
+	return zip(arr[0::2], arr[1::2])
+
+def scan_generation(dirpath):
+	"""Return array('Q') of interleaved inode,size pairs of regular files under dirpath, sorted by inode,
+	each inode once.
+	Pairs are collected in an array(16 bytes a file), sorted in runs of SCAN_SORT_PAIRS, then the runs
+	are merged, so a generation of millions of files does not need a dict or list of that size.
+	"""
+	walked = array('Q') # interleaved inode,size in walking order, an inode hardlinked within dirpath repeats
+	dirs_todo = [dirpath]
+	while dirs_todo:
+		with os.scandir(dirs_todo.pop()) as it:
+			for entry in it:
+				if entry.is_dir(follow_symlinks=False):
+					dirs_todo.append(entry.path)
+				elif entry.is_file(follow_symlinks=False):
+					st = entry.stat(follow_symlinks=False)
+					walked.append(st.st_ino)
+					walked.append(st.st_size)
+
+	runs = []
+	for start in range(0, len(walked), SCAN_SORT_PAIRS*2):
+		run = array('Q')
+		for ino, size in sorted(_y_array_pairs(walked[start:start+SCAN_SORT_PAIRS*2])):
+			run.append(ino)
+			run.append(size)
+		runs.append(run)
+	del walked
+
+	pairs = array('Q')
+	last_ino = None
+	for ino, size in heapq.merge(*[_y_array_pairs(run) for run in runs]):
+		if ino!=last_ino:
+			pairs.append(ino)
+			pairs.append(size)
+			last_ino = ino
+	return pairs
+
+def drop_cache(local_store_dir, dirpath_rela):
+	"""Forget the cached scan of a generation whose files have changed(relinked by dedup)."""
+	try:
+		os.remove(_cache_filepath(local_store_dir, dirpath_rela))
+	except FileNotFoundError:
+		pass
+
+def load_or_scan(local_store_dir, dirpath_rela, is_rescan=False):
+	"""Make sure the generation's cache file exists. Return True if it has been scanned just now."""
+	cache_filepath = _cache_filepath(local_store_dir, dirpath_rela)
+	if not is_rescan and os.path.isfile(cache_filepath):
+		return False
+
+	pairs = scan_generation(os.path.join(local_store_dir, dirpath_rela))
+	os.makedirs(os.path.dirname(cache_filepath), exist_ok=True)
+	tmp_filepath = cache_filepath + ".tmp"
+	with open(tmp_filepath, "wb") as fh:
+		pairs.tofile(fh)
+	os.replace(tmp_filepath, cache_filepath)
+	return True
+
+def _y_cached_pairs(cache_filepath, gen_index):
+	"""Yield (inode, gen_index, size) from a cache file, reading it block by block."""
+	with open(cache_filepath, "rb") as fh:
+		while True:
+			block = array('Q')
+			try:
+				block.fromfile(fh, CACHE_READ_PAIRS*2)
+			except EOFError: # the last block is shorter, fromfile() has read what is there
+				pass
+			if not block:
+				return
+			for i in range(0, len(block), 2):
+				yield block[i], gen_index, block[i+1]
+
+def compute_space_usage(local_store_dir, dirpaths_rela, is_rescan=False, logcall=None):
+	"""Return (list of SpaceUsage in the order of dirpaths_rela, physical bytes of all generations).
+	Generation dirs are relative to local_store_dir, like what irsync_st.y_find_existing_ushelf() finds.
+	"""
+	for dirpath_rela in dirpaths_rela:
+		uesec_start = time.time()
+		if load_or_scan(local_store_dir, dirpath_rela, is_rescan) and logcall:
+			logcall("Scanned %s in %.1f seconds."%(dirpath_rela, time.time()-uesec_start))
+
+	ngen = len(dirpaths_rela)
+	files = [0]*ngen
+	total = [0]*ngen
+	unique = [0]*ngen
+	physical = 0
+
+	streams = [_y_cached_pairs(_cache_filepath(local_store_dir, d), i) for i, d in enumerate(dirpaths_rela)]
+	for ino, group in itertools.groupby(heapq.merge(*streams), key=lambda t: t[0]):
+		refs = list(group)
+		size = refs[0][2]
+		physical += size
+		for _, gen_index, _ in refs:
+			files[gen_index] += 1
+			total[gen_index] += size
+		if len(refs)==1:
+			unique[refs[0][1]] += size
+
+	usages = [SpaceUsage(d, files[i], total[i], unique[i], total[i]-unique[i]) for i, d in enumerate(dirpaths_rela)]
+	return usages, physical
+
+def compute_removal_gains(local_store_dir, dirpaths_rela, removal_sequence, is_rescan=False):
+	"""If generations in removal_sequence(a subset of dirpaths_rela) are deleted one by one in that order,
+	how many bytes does each deletion free? Return a list of bytes, one for each removal_sequence item.
+
+	A deletion frees the inodes whose every referencing generation has been deleted by then, so a later
+	deletion may free more than its unique bytes(an inode shared only with an earlier deleted one).
+	"""
+	for dirpath_rela in dirpaths_rela:
+		load_or_scan(local_store_dir, dirpath_rela, is_rescan)
+
+	position = {d:i for i, d in enumerate(removal_sequence)}
+	gen_position = [position.get(d, -1) for d in dirpaths_rela] # -1: not to be deleted
+	gains = [0]*len(removal_sequence)
+
+	streams = [_y_cached_pairs(_cache_filepath(local_store_dir, d), i) for i, d in enumerate(dirpaths_rela)]
+	for ino, group in itertools.groupby(heapq.merge(*streams), key=lambda t: t[0]):
+		refs = list(group)
+		positions = [gen_position[gen_index] for _, gen_index, _ in refs]
+		if -1 in positions:
+			continue # a kept generation still references it
+		gains[max(positions)] += refs[0][2]
+
+	return gains
+
+def drop_stale_caches(local_store_dir, dirpaths_rela):
+	"""Delete cache files of generations that no longer exist."""
+	cache_dir = os.path.join(local_store_dir, DIRNAM_space_cache)
+	if not os.path.isdir(cache_dir):
+		return
+	keep = {os.path.basename(_cache_filepath(local_store_dir, d)) for d in dirpaths_rela}
+	for filename in os.listdir(cache_dir):
+		if filename not in keep:
+			os.remove(os.path.join(cache_dir, filename))
+
+def irsync_space_cmd(argv):
+	ap = argparse.ArgumentParser(prog="irsync space",
+		description="Show total, unique and shared bytes of each backup in a local_store_dir. "
+			"Unique bytes are what deleting that backup would free.")
+	ap.add_argument('local_store_dir', type=str)
+	ap.add_argument('--rescan', action="store_true", dest='rescan',
+		help='Scan all backups again, instead of using cached scan results.'
+	)
+	apargs = ap.parse_args(argv)
+
+	local_store_dir = os.path.abspath(apargs.local_store_dir)
+	catalog = UshelfCatalog(local_store_dir)
+	if not catalog.exists():
+		print('Error: No backup catalog in "%s". Run `irsync catalog-rebuild` first.'%(local_store_dir))
+		return False
+
+	dirpaths_rela = [item.dirpath_rela for item in catalog.list_ushelfs()
+		if os.path.isdir(os.path.join(local_store_dir, item.dirpath_rela))]
+	try:
+		drop_stale_caches(local_store_dir, dirpaths_rela)
+		usages, physical = compute_space_usage(local_store_dir, dirpaths_rela, apargs.rescan, print)
+	except OSError as e:
+		print("Error: %s"%(str(e)))
+		return False
+
+	print("%-40s %10s %16s %16s %16s"%("Backup", "Files", "Total bytes", "Unique bytes", "Shared bytes"))
+	for u in usages:
+		print("%-40s %10d %16d %16d %16d"%(u.dirpath_rela, u.files, u.total_bytes, u.unique_bytes, u.shared_bytes))
+	print("%d backups use %d bytes (%.1f GB) on disk, %d bytes (%.1f GB) if they did not share files."%(
+		len(usages), physical, physical/1e9, sum(u.total_bytes for u in usages),
+		sum(u.total_bytes for u in usages)/1e9))
+	return True
+
+if __name__ == '__main__':
+	succ = irsync_space_cmd(sys.argv[1:])
+	exit(0 if succ else 4)
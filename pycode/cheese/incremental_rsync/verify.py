@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Verify that backups in a local_store_dir are still intact(bit rot, a botched manual cleanup),
+by re-hashing files and comparing with the manifests written by `irsync --manifest`.
+
+    python3 -m cheese.incremental_rsync.irsync_cmd verify <local_store_dir> [<datetime_vault>/<ushelf> ...]
+        [--sample=0.1] [--workers=4] [--max-mbps=50]
+
+Without explicit ushelf dirs, all finished backups in the catalog are verified.
+
+Backups share most of their files through hardlinks, so each unique inode is read only once,
+however many generations it appears in. --max-mbps caps reading speed so that verification can
+run beside production. Progress is saved in local_store_dir/irsync-verify.progress; if verification
+is interrupted, running it again continues where it stopped(use --restart to start over).
+"""
+
+import os, sys, time
+import argparse
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from .share import *
+from .helper import *
+from .catalog import *
+from .manifest import hash_file, y_read_manifest, FILENAM_manifest
+from .irsync_client import y_walk_finished_ushelfs
+
+FILENAM_verify_progress = 'irsync-verify.progress'
+
+verify_workers_default = 4
+WINDOW_PER_WORKER = 16 # inodes submitted but not yet verified, per worker
+PROGRESS_FLUSH_SECONDS = 5
+
+class TokenBucket:
+	"""Limit the total reading speed of all threads to `rate` bytes per second.
+	A reader calls consume(n) after reading n bytes, and sleeps there if it is going too fast.
+	"""
+
+	def __init__(self, rate, burst_seconds=1.0):
+		self.rate = rate
+		self.capacity = rate * burst_seconds
+		self._tokens = self.capacity
+		self._tick = time.monotonic()
+		self._mutex = threading.Lock()
+
+	def consume(self, n):
+		with self._mutex:
+			now = time.monotonic()
+			self._tokens = min(self.capacity, self._tokens + (now-self._tick)*self.rate)
+			self._tick = now
+			self._tokens -= n
+			wait_seconds = -self._tokens/self.rate if self._tokens<0 else 0
+		if wait_seconds>0:
+			time.sleep(wait_seconds)
+
+
+class VerifyProgress:
+	"""The resumable progress file. Each verified inode appends a line:
+
+	    OK <dev> <ino>
+	    BAD <dev> <ino> <reason> TAB <filepath>
+	"""
+
+	def __init__(self, filepath, is_restart):
+		self.filepath = filepath
+		self.done = set() # (dev, ino)
+		self.bad = [] # (reason, filepath)
+		if is_restart and os.path.exists(filepath):
+			os.remove(filepath)
+		if os.path.exists(filepath):
+			self._load()
+		self._fh = open(filepath, "a", encoding="utf8", errors="surrogateescape")
+		self._tick_flush = time.monotonic()
+
+	def _load(self):
+		with open(self.filepath, encoding="utf8", errors="surrogateescape") as fh:
+			for line in fh:
+				words = line.rstrip('\n').split(' ', 3)
+				if len(words)<3 or not line.endswith('\n'):
+					continue # the last line may be cut by the interruption
+				self.done.add((int(words[1]), int(words[2])))
+				if words[0]=='BAD':
+					reason, filepath = words[3].split('\t', 1)
+					self.bad.append((reason, filepath))
+
+	def record(self, key, bad=None):
+		if bad:
+			self._fh.write("BAD %d %d %s\t%s\n"%(key[0], key[1], bad[0], bad[1]))
+			self.bad.append(bad)
+		else:
+			self._fh.write("OK %d %d\n"%key)
+		now = time.monotonic()
+		if now - self._tick_flush >= PROGRESS_FLUSH_SECONDS:
+			self._fh.flush()
+			self._tick_flush = now
+
+	def close(self, is_complete):
+		self._fh.close()
+		if is_complete:
+			os.remove(self.filepath) # next verification starts over
+
+def _is_sampled(key, sample):
+	# Decided by the inode, not by random(), so that a resumed run samples the same inodes.
+	return sample>=1 or (key[1]*2654435761 % 2**32) < sample * 2**32
+
+def _verify_one(filepath, expect_hash, throttle):
+	"""Return None if OK, or a reason string."""
+	try:
+		actual = hash_file(filepath, throttle)
+	except OSError as e:
+		return "unreadable(%s)"%(e.strerror)
+	return None if actual==expect_hash else "hash-mismatch"
+
+def y_verify_tasks(local_store_dir, dirpaths_rela, progress, sample, stats):
+	"""Yield (key, filepath, expect_hash, size) for inodes to verify, each unique inode once.
+	Problems found without reading(missing file, size changed) are recorded into progress directly.
+	"""
+	for dirpath_rela in dirpaths_rela:
+		ushelf_dirpath = os.path.join(local_store_dir, dirpath_rela)
+		manifest_filepath = os.path.join(ushelf_dirpath, FILENAM_manifest)
+		if not os.path.isfile(manifest_filepath):
+			print("[%s] No %s, skipped."%(dirpath_rela, FILENAM_manifest))
+			stats['no_manifest'] += 1
+			continue
+
+		print("[%s] Verifying..."%(dirpath_rela))
+		for entry in y_read_manifest(manifest_filepath):
+			filepath = os.path.join(ushelf_dirpath, *entry.path.split('/'))
+			try:
+				st = os.lstat(filepath)
+			except FileNotFoundError:
+				# A missing file has no inode, key it by manifest's record.
+				key = (-1, entry.inode)
+				if key not in progress.done:
+					progress.done.add(key)
+					progress.record(key, ("missing", filepath))
+				continue
+
+			key = (st.st_dev, st.st_ino)
+			if key in progress.done:
+				stats['skipped'] += 1
+				continue
+			if not _is_sampled(key, sample):
+				continue
+			progress.done.add(key)
+
+			if st.st_size != entry.size:
+				progress.record(key, ("size-changed", filepath))
+				continue
+
+			yield key, filepath, entry.hash, st.st_size
+
+def verify_store(local_store_dir, dirpaths_rela, workers=verify_workers_default, sample=1.0, max_mbps=0,
+		is_restart=False):
+	"""Verify the ushelf dirs(relative to local_store_dir). Return VerifyProgress, whose .bad lists problems."""
+	throttle = TokenBucket(max_mbps*1000000).consume if max_mbps>0 else None
+	progress = VerifyProgress(os.path.join(local_store_dir, FILENAM_verify_progress), is_restart)
+	stats = collections.Counter()
+	uesec_start = time.time()
+	is_complete = False
+
+	try:
+		window = collections.deque()
+		with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='irsync_verify') as executor:
+			def drain_one():
+				key, filepath, size, future = window.popleft()
+				reason = future.result()
+				progress.record(key, (reason, filepath) if reason else None)
+				stats['files'] += 1
+				stats['bytes'] += size
+
+			for key, filepath, expect_hash, size in y_verify_tasks(local_store_dir, dirpaths_rela, progress, sample, stats):
+				window.append((key, filepath, size, executor.submit(_verify_one, filepath, expect_hash, throttle)))
+				while len(window) > workers*WINDOW_PER_WORKER:
+					drain_one()
+			while window:
+				drain_one()
+		is_complete = True
+	finally:
+		progress.close(is_complete)
+
+	seconds = time.time() - uesec_start
+	print("Verified %d unique inodes, %.1f MB in %.1f seconds, %.1f MB/s. %d already verified(hardlinks or resumed)."%(
+		stats['files'], stats['bytes']/1000000, seconds, stats['bytes']/1000000/seconds if seconds>0 else 0,
+		stats['skipped']))
+	return progress
+
+def irsync_verify_cmd(argv):
+	ap = argparse.ArgumentParser(prog="irsync verify",
+		description="Re-hash backup files and compare them with their %s."%(FILENAM_manifest))
+	ap.add_argument('local_store_dir', type=str)
+	ap.add_argument('ushelf_dirs', type=str, nargs='*',
+		help='Backups to verify, as <datetime_vault>/<ushelf> relative to local_store_dir. Default is all.'
+	)
+	ap.add_argument('--workers', type=int, dest='workers', default=verify_workers_default,
+		help='Count of reader threads. Default is %(default)s.'
+	)
+	ap.add_argument('--sample', type=float, dest='sample', default=1.0,
+		help='Verify only this fraction(0 to 1) of the inodes. Default is %(default)s.'
+	)
+	ap.add_argument('--max-mbps', type=float, dest='max_mbps', default=0,
+		help='Max reading speed in MB/s, so as not to starve other disk users. Default 0 means no limit.'
+	)
+	ap.add_argument('--restart', action="store_true", dest='restart',
+		help='Discard saved progress of an interrupted verification, start over.'
+	)
+	apargs = ap.parse_args(argv)
+
+	local_store_dir = os.path.abspath(apargs.local_store_dir)
+	if not os.path.isdir(local_store_dir):
+		print('Error: local_store_dir "%s" does not exist.'%(local_store_dir))
+		return False
+	if apargs.workers<1 or not 0 < apargs.sample <= 1:
+		print("Error: --workers must be at least 1, --sample must be in (0, 1].")
+		return False
+
+	dirpaths_rela = [os.path.normpath(d) for d in apargs.ushelf_dirs]
+	if not dirpaths_rela:
+		catalog = UshelfCatalog(local_store_dir)
+		items = catalog.list_ushelfs() if catalog.exists() else sorted(y_walk_finished_ushelfs(local_store_dir),
+			key=lambda item: item.uesec)
+		dirpaths_rela = [item.dirpath_rela for item in items]
+
+	try:
+		progress = verify_store(local_store_dir, dirpaths_rela, apargs.workers, apargs.sample, apargs.max_mbps,
+			apargs.restart)
+	except OSError as e:
+		print("Error: %s"%(str(e)))
+		return False
+
+	if progress.bad:
+		print("%d problems found:"%(len(progress.bad)))
+		for reason, filepath in progress.bad:
+			print("    %-14s %s"%(reason, filepath))
+		return False
+
+	print("No problem found.")
+	return True
+
+if __name__ == '__main__':
+	succ = irsync_verify_cmd(sys.argv[1:])
+	exit(0 if succ else 4)
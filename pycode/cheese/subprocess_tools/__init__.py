@@ -1,2 +1,3 @@
 
 from .watchdog import *
+from .async_watchdog import *
@@ -0,0 +1,102 @@
+import os, sys, time
+import asyncio
+import subprocess
+
+
+class async_pipe_process_with_timeout:
+	"""The asyncio counterpart of pipe_process_with_timeout().
+
+	It is an async context manager that spawns cmd_args with asyncio.create_subprocess_exec()
+	(stdout and stderr merged into one pipe), and supervises it with a watchdog task instead of
+	a WatchdogThread. So one event loop can supervise hundreds of child processes without
+	hundreds of OS threads.
+
+	If the context code fails to feed the dog every once_timeout_sec, or max_run_seconds elapsed,
+	the child is killed.
+
+	async with async_pipe_process_with_timeout(cmd_args, 0, 3600) as watchdog:
+		while True:
+			chunk = await watchdog.proc.stdout.read(65536)
+			if not chunk:
+				break
+			# do something with chunk...
+			watchdog.feed_dog()
+
+	(returncode, uesec_timeout_fired) = watchdog.result
+
+	If the context code raises an exception, the child is killed as well.
+	"""
+
+	def __init__(self, cmd_args, once_timeout_sec, max_run_seconds, is_print_dbginfo=False,
+	             **subprocess_kwargs):
+		self.cmd_args = cmd_args
+		self._once_timeout_sec = once_timeout_sec
+		self._max_run_seconds = max_run_seconds
+		self._is_print_dbginfo = is_print_dbginfo
+		self._subprocess_kwargs = subprocess_kwargs
+		#
+		self.proc = None
+		self.returncode = None
+		self.uesec_timeout_fired = 0 # if timeout action is taken, this timestamp is updated.
+
+	@property
+	def result(self):
+		"""Same contract as y_run_exe_with_time_limit(): (subprocess exitcode, force-kill uesec)."""
+		return (self.returncode, self.uesec_timeout_fired)
+
+	def feed_dog(self):
+		if self._once_timeout_sec > 0:
+			self._moving_deadline = self._loop.time() + self._once_timeout_sec
+
+	async def __aenter__(self):
+		self._loop = asyncio.get_event_loop()
+		self._evt_done = asyncio.Event()
+
+		self.proc = await asyncio.create_subprocess_exec(*self.cmd_args,
+			stdout=subprocess.PIPE, stderr=subprocess.STDOUT, # these two are important
+			**self._subprocess_kwargs)
+
+		now = self._loop.time()
+		self._final_deadline = now + self._max_run_seconds if self._max_run_seconds > 0 else None
+		self._moving_deadline = None
+		self.feed_dog()
+
+		self._dogtask = self._loop.create_task(self._watch())
+		return self
+
+	async def __aexit__(self, exc_type, exc_value, tb):
+		if exc_type is not None and self.proc.returncode is None:
+			self._kill()
+
+		self.returncode = await self.proc.wait()
+
+		self._evt_done.set()
+		await self._dogtask
+		return False # let the exception propagate
+
+	def _kill(self):
+		try:
+			self.proc.kill()
+		except ProcessLookupError:
+			pass # it has just ended
+
+	async def _watch(self):
+		while True:
+			deadlines = [d for d in (self._moving_deadline, self._final_deadline) if d is not None]
+			if not deadlines:
+				await self._evt_done.wait()
+				return
+
+			wait_secs = min(deadlines) - self._loop.time()
+			if wait_secs <= 0: # the context code has timed-out
+				if self._is_print_dbginfo:
+					print("async_pipe_process_with_timeout: killing pid=%d"%(self.proc.pid))
+				self.uesec_timeout_fired = time.time()
+				self._kill()
+				return
+
+			try:
+				await asyncio.wait_for(self._evt_done.wait(), wait_secs)
+				return # work done
+			except asyncio.TimeoutError:
+				pass # go back to check whether we have further seconds to wait(the dog may have been fed)
@@ -0,0 +1,55 @@
+import sys
+import time
+import asyncio
+
+from subprocess_tools import async_pipe_process_with_timeout
+
+import pytest
+
+def run_child(code, once_timeout_sec, max_run_seconds):
+	async def pump():
+		output = b''
+		async with async_pipe_process_with_timeout([sys.executable, "-c", code],
+				once_timeout_sec, max_run_seconds) as watchdog:
+			while True:
+				chunk = await watchdog.proc.stdout.read(4096)
+				if not chunk:
+					break
+				output += chunk
+				watchdog.feed_dog()
+		return output, watchdog.result
+
+	return asyncio.run(pump())
+
+def test_normal_exit():
+	output, (exitcode, uesec_timeout_fired) = run_child("print('hello'); exit(3)", 5, 10)
+	assert output.strip()==b'hello'
+	assert exitcode==3
+	assert uesec_timeout_fired==0
+
+def test_max_run_seconds():
+	uesec_start = time.time()
+	output, (exitcode, uesec_timeout_fired) = run_child("import time; time.sleep(30)", 0, 1)
+	assert exitcode!=0
+	assert uesec_timeout_fired>0
+	assert time.time()-uesec_start < 10
+
+def test_once_timeout():
+	# The child keeps talking for a while, then falls silent.
+	code = "import time\nfor i in range(6):\n\tprint(i, flush=True); time.sleep(0.3)\ntime.sleep(30)"
+	output, (exitcode, uesec_timeout_fired) = run_child(code, 1, 0)
+	assert output.split()==[b'0', b'1', b'2', b'3', b'4', b'5']
+	assert uesec_timeout_fired>0
+
+def test_many_children_one_loop():
+	async def one(i):
+		async with async_pipe_process_with_timeout([sys.executable, "-c", "print(%d)"%(i)], 0, 20) as watchdog:
+			output = await watchdog.proc.stdout.read()
+		return int(output), watchdog.result
+
+	async def gather_all():
+		return await asyncio.gather(*[one(i) for i in range(20)])
+
+	results = asyncio.run(gather_all())
+	assert [r[0] for r in results]==list(range(20))
+	assert [r[1] for r in results]==[(0, 0)]*20
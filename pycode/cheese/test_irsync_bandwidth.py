@@ -0,0 +1,35 @@
+import json, time
+
+from incremental_rsync import bandwidth
+from incremental_rsync.bandwidth import BandwidthShare
+
+def test_budget_split_and_rebalance(tmp_path, monkeypatch):
+	monkeypatch.setattr(bandwidth, 'BW_HEARTBEAT_SECONDS', 0)
+	monkeypatch.setattr(bandwidth, 'BW_RESTART_MIN_SECONDS', 0)
+	state_filepath = str(tmp_path/'bw.json')
+
+	first = BandwidthShare(1000, state_filepath, 'first')
+	assert first.register()==1000
+	second = BandwidthShare(1000, state_filepath, 'second')
+	assert second.register()==500
+
+	assert first.on_tick() # 1000 -> 500, rsync should restart
+	assert first.on_tick() # still pending until taken
+	assert first.take_restart() and first.bwlimit_kbps==500
+	assert not first.take_restart()
+
+	second.unregister()
+	assert first.on_tick() and first.take_restart() and first.bwlimit_kbps==1000
+	first.unregister()
+	assert json.load(open(state_filepath))=={'sessions':{}}
+
+def test_stale_session_dropped(tmp_path, monkeypatch):
+	state_filepath = str(tmp_path/'bw.json')
+	stale = {'pid':1, 'name':'gone', 'uesec_heartbeat':time.time()-bandwidth.BW_STALE_SECONDS-1, 'bwlimit_kbps':500}
+	with open(state_filepath, "w") as fh:
+		json.dump({'sessions':{'1.1.gone':stale}}, fh)
+
+	share = BandwidthShare(1000, state_filepath, 'me')
+	assert share.register()==1000
+	assert list(json.load(open(state_filepath))['sessions'])==[share.session_id]
+	share.unregister()
@@ -0,0 +1,37 @@
+import os
+
+from incremental_rsync.churn import ChurnProfile, apply_churn, parse_profile
+
+def make_tree(topdir):
+	for i in range(40):
+		dirpath = os.path.join(topdir, "d%d"%(i%4))
+		os.makedirs(dirpath, exist_ok=True)
+		with open(os.path.join(dirpath, "f%02d"%(i)), "wb") as fh:
+			fh.write(bytes([i])*10000)
+
+def snapshot(topdir):
+	snap = {}
+	for root, dirs, files in os.walk(topdir):
+		for filename in files:
+			filepath = os.path.join(root, filename)
+			with open(filepath, "rb") as fh:
+				snap[os.path.relpath(filepath, topdir)] = fh.read()
+	return snap
+
+def test_churn_is_reproducible(tmp_path):
+	profile = parse_profile("overwrite=0.2,append=0.1,truncate=0.1,rename=0.1,delete=0.1,sparse=0.1,create=0.1")
+	for name in ("a", "b"):
+		make_tree(str(tmp_path/name))
+		st = apply_churn(str(tmp_path/name), profile, seed="7")
+		assert st.files==40
+		assert st.changes==dict(overwrite=8, append=4, truncate=4, rename=4, delete=4, sparse=4, create=4)
+	assert snapshot(str(tmp_path/"a"))==snapshot(str(tmp_path/"b"))
+
+def test_churn_overwrite_keeps_size(tmp_path):
+	make_tree(str(tmp_path))
+	before = snapshot(str(tmp_path))
+	apply_churn(str(tmp_path), ChurnProfile(overwrite=1, overwrite_bytes=100), seed=1)
+	after = snapshot(str(tmp_path))
+	assert before.keys()==after.keys()
+	for k in before:
+		assert len(before[k])==len(after[k]) and before[k]!=after[k]
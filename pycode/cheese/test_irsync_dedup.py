@@ -0,0 +1,38 @@
+import os
+from contextlib import closing
+
+from incremental_rsync.dedup import DedupIndex
+
+def make_file(filepath, content, mtime=1600000000):
+	os.makedirs(os.path.dirname(filepath), exist_ok=True)
+	with open(filepath, "wb") as fh:
+		fh.write(content)
+	os.utime(filepath, (mtime, mtime))
+
+def test_dedup_across_shelves_and_forget(tmp_path):
+	store = str(tmp_path)
+	make_file(os.path.join(store, 'd1', 'a.s', 'f'), b'x'*5000)
+	make_file(os.path.join(store, 'd1', 'b.s', 'f'), b'x'*5000)
+	index = DedupIndex(store)
+	index.dedup_tree(os.path.join(store, 'd1', 'a.s'))
+	st = index.dedup_tree(os.path.join(store, 'd1', 'b.s'))
+	assert st.linked==1
+	assert os.stat(os.path.join(store, 'd1', 'b.s', 'f')).st_nlink==2
+
+	assert index.forget_tree(os.path.join('d1', 'a.s'))==1
+	assert index.forget_tree(os.path.join('d1', 'a'))==0 # a prefix of a name is not its parent
+
+def test_reused_inode_number(tmp_path):
+	store = str(tmp_path)
+	filepath = os.path.join(store, 'd2', 'a.s', 'new')
+	make_file(filepath, b'y'*3000)
+	st = os.stat(filepath)
+	index = DedupIndex(store)
+	with closing(index._connect()) as conn, conn:
+		# A row left by a removed file that had the same inode number.
+		conn.execute("INSERT INTO inode VALUES (?,?,?,?,?,?,?,?,NULL,NULL)",
+			(st.st_dev, st.st_ino, 9999, 1, 0o644, st.st_uid, st.st_gid, 'd1/a.s/old'))
+
+	assert index.dedup_tree(os.path.join(store, 'd2')).new_inodes==1
+	with closing(index._connect()) as conn:
+		assert conn.execute("SELECT size, path FROM inode").fetchall()==[(3000, os.path.join('d2', 'a.s', 'new'))]
@@ -0,0 +1,55 @@
+import os
+
+import sys
+
+from incremental_rsync.logrotate import LogRotator, LogRotatePolicy, list_log_segments, open_compressed
+from incremental_rsync.logread import y_log_lines, y_file_lines
+from incremental_rsync.share import run_exe_pump_output
+
+def write_lines(fh, rotator, lines):
+	for line in lines:
+		text = line + "\n"
+		if rotator.is_due():
+			fh = rotator.rotate(fh)
+		fh.write(text)
+		rotator.count(text)
+	return fh
+
+def test_rotate_compress_and_read_back(tmp_path):
+	logfile = str(tmp_path/"irsync.log")
+	rotator = LogRotator(logfile, LogRotatePolicy(200, 0, 'gzip'))
+	lines = ["[20261018.0100%02d.000][INFO]line %d"%(i, i) for i in range(40)]
+	fh = write_lines(open(logfile, "a", encoding="utf8"), rotator, lines)
+	fh.close()
+	rotator.join()
+
+	segments = list_log_segments(logfile)
+	assert len(segments)>=5
+	assert all(fp.endswith('.gz') for fp in segments) # all compressed, originals removed
+	assert sorted(os.listdir(str(tmp_path)))==sorted([os.path.basename(fp) for fp in segments] + ["irsync.log"])
+
+	assert [line for fp, line in y_log_lines(logfile)]==lines
+	assert [line for fp, line in y_log_lines(logfile, since="20261018.010035")]==lines[35:]
+
+def test_pump_into_compressed_log(tmp_path):
+	filepath = str(tmp_path/"run0.rsync0.log.gz")
+	fh = open_compressed(filepath, "wt", "gzip", 3)
+	fh.write("[20261018.010000.000] banner\n")
+	fh.flush()
+	exitcode, _ = run_exe_pump_output([sys.executable, "-c", "for i in range(50000): print('file%d' % i)"],
+		0, logfile_handle=fh.buffer)
+	fh.close()
+	assert exitcode==0
+
+	lines = [line for fp, line in y_file_lines([filepath])]
+	assert lines[0]=="[20261018.010000.000] banner" and lines[-1]=="file49999" and len(lines)==50001
+
+	# Cut short, as if irsync were killed: lines up to the cut are still read.
+	with open(filepath, "rb") as fh:
+		data = fh.read()
+	with open(filepath, "wb") as fh:
+		fh.write(data[:len(data)//2])
+	truncated = []
+	lines = [line for fp, line in y_file_lines([filepath], on_truncated=truncated.append)]
+	assert truncated==[filepath]
+	assert 1000 < len(lines) < 50001
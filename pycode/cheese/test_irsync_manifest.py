@@ -0,0 +1,73 @@
+import os
+import shutil
+
+from incremental_rsync.manifest import (write_manifest, y_read_manifest, FILENAM_manifest, MANIFEST_READ_ERRORS)
+
+import pytest
+
+def make_tree(topdir, files):
+	for path, content in files.items():
+		filepath = os.path.join(topdir, *path.split('/'))
+		os.makedirs(os.path.dirname(filepath), exist_ok=True)
+		with open(filepath, "wb") as fh:
+			fh.write(content)
+
+def test_manifest_order_and_escape(tmp_path):
+	files = {'b.txt': b'bb', 'a/z': b'z'*5000, 'a.txt': b'a', 'odd\tname\n': b'odd', 'skipme/x': b'x'}
+	make_tree(str(tmp_path), files)
+
+	st = write_manifest(str(tmp_path), None, skip_names=('skipme',), workers=2)
+	assert st.files==4 and st.hashed_files==4 and st.reused==0
+
+	entries = list(y_read_manifest(str(tmp_path/FILENAM_manifest)))
+	# Ordered by path components: "a/z" comes before "a.txt".
+	assert [e.path for e in entries]==['a/z', 'a.txt', 'b.txt', 'odd\tname\n']
+	assert entries[0].size==5000
+
+def test_manifest_reuse_by_inode(tmp_path):
+	gen1 = tmp_path/"gen1"
+	gen2 = tmp_path/"gen2"
+	make_tree(str(gen1), {'keep': b'k'*100, 'changed': b'old'})
+	write_manifest(str(gen1))
+
+	# gen2: 'keep' hardlinked like --link-dest does, 'changed' is a new file.
+	make_tree(str(gen2), {'changed': b'new'})
+	os.link(str(gen1/"keep"), str(gen2/"keep"))
+
+	st = write_manifest(str(gen2), str(gen1/FILENAM_manifest))
+	assert st.reused==1 and st.hashed_files==1
+
+	hashes1 = {e.path:e.hash for e in y_read_manifest(str(gen1/FILENAM_manifest))}
+	hashes2 = {e.path:e.hash for e in y_read_manifest(str(gen2/FILENAM_manifest))}
+	assert hashes1['keep']==hashes2['keep']
+	assert hashes1['changed']!=hashes2['changed']
+
+def test_manifest_reuse_across_paths(tmp_path):
+	gen1 = tmp_path/"gen1"
+	gen2 = tmp_path/"gen2"
+	make_tree(str(gen1), {'old/name': b'r'*100, 'other': b'o'})
+	write_manifest(str(gen1))
+
+	# gen2: gen1's file linked at another path, like dedup or a rename does.
+	make_tree(str(gen2), {'other': b'o'})
+	os.makedirs(str(gen2/"new"))
+	os.link(str(gen1/"old"/"name"), str(gen2/"new"/"renamed"))
+
+	assert write_manifest(str(gen2), str(gen1/FILENAM_manifest)).reused==0 # same path only
+	st = write_manifest(str(gen2), str(gen1/FILENAM_manifest), by_inode=True)
+	assert st.reused==1 and st.hashed_files==1
+
+@pytest.mark.parametrize('damage', ['truncate', 'garbage'])
+def test_manifest_read_errors(tmp_path, damage):
+	gen1 = tmp_path/"gen1"
+	make_tree(str(gen1), {'f%03d'%(i): os.urandom(64) for i in range(200)})
+	write_manifest(str(gen1))
+	prev = gen1/FILENAM_manifest
+	data = prev.read_bytes()
+	prev.write_bytes(data[:len(data)//2] if damage=='truncate' else b'not a gzip file')
+
+	# The caller(irsync_st.ushelf_write_manifest) catches these and writes without hash reuse.
+	with pytest.raises(MANIFEST_READ_ERRORS):
+		write_manifest(str(gen1), str(prev))
+	st = write_manifest(str(gen1), None)
+	assert st.files==200 and st.reused==0
@@ -0,0 +1,31 @@
+import time
+
+from incremental_rsync.metrics import PhaseTimer, write_prometheus_textfile
+
+def test_phase_timer_nested_spans():
+	timer = PhaseTimer()
+	with timer.span('rsync'):
+		time.sleep(0.05)
+		with timer.span('preflight'):
+			time.sleep(0.1)
+	with timer.span('rsync'):
+		time.sleep(0.05)
+
+	totals = timer.totals()
+	assert list(totals)==['rsync', 'preflight']
+	assert 0.09 <= totals['rsync'] < 0.14 # the inner span is not counted twice
+	assert 0.09 <= totals['preflight'] < 0.14
+	assert timer.counts()=={'rsync':2, 'preflight':1}
+
+def test_prometheus_textfile(tmp_path):
+	timer = PhaseTimer()
+	with timer.span('retention'):
+		pass
+	record = {'ushelf':'host."x"', 'success':True, 'elapsed_seconds':1.5, 'uesec_end':1700000000,
+		'rsync_attempts':[{}, {}]}
+	filepath = write_prometheus_textfile(str(tmp_path), record, timer)
+	assert filepath.endswith('irsync-host."x".prom')
+	lines = open(filepath).read().splitlines()
+	assert 'irsync_phase_count{ushelf="host.\\"x\\"",phase="retention"} 1' in lines
+	assert 'irsync_rsync_attempts{ushelf="host.\\"x\\""} 2' in lines
+	assert [p.name for p in tmp_path.iterdir()]==['irsync-host."x".prom']
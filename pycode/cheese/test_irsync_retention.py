@@ -0,0 +1,61 @@
+import os, datetime
+import collections
+
+import pytest
+
+from incremental_rsync import retention
+from incremental_rsync.catalog import CatalogItem
+from incremental_rsync.retention import RetentionPolicy, gfs_keep, plan_retention, is_gfs_policy, is_retention_wanted
+from incremental_rsync.retention import irsync_retention_cmd
+from incremental_rsync.irsync_cmd import init_irsync_argparser
+from incremental_rsync.pruner import trash_pending_bytes
+
+def make_items(ushelf, datetimes):
+	items = []
+	for dt in datetimes:
+		dirpath_rela = "%s/%s"%(dt.strftime('%Y%m%d-%H%M'), ushelf)
+		items.append(CatalogItem(dirpath_rela, dt.strftime('%Y%m%d-%H%M'), ushelf, int(dt.timestamp()), -1))
+	return items
+
+def test_gfs_keep_daily_and_monthly():
+	# Two backups a day, from 2020-01-25 to 2020-02-04.
+	start = datetime.datetime(2020, 1, 25, 1, 0)
+	dts = [start + datetime.timedelta(hours=12*i) for i in range(22)]
+	items = make_items('host.s', dts)
+
+	kept = gfs_keep(items, RetentionPolicy(0, 0, 3, 0, 2, 0))
+	# The newest of each of the last 3 days, and the newest of each of the last 2 months.
+	assert kept=={'20200204-1300/host.s', '20200203-1300/host.s', '20200202-1300/host.s',
+		'20200131-1300/host.s'}
+
+def test_gfs_keep_per_shelf():
+	dt = datetime.datetime(2020, 3, 1, 8, 0)
+	items = make_items('a.s', [dt, dt+datetime.timedelta(hours=1)]) + make_items('b.s', [dt])
+
+	kept = gfs_keep(items, RetentionPolicy(0, 0, 1, 0, 0, 0))
+	assert kept=={'20200301-0900/a.s', '20200301-0800/b.s'}
+
+def test_negative_keep_is_rejected(tmp_path):
+	policy = RetentionPolicy(0, 0, -1, 0, 0, 0)
+	assert not is_gfs_policy(policy) and not is_retention_wanted(policy)
+
+	with pytest.raises(SystemExit):
+		init_irsync_argparser().parse_args(['rsync://srv/mod', str(tmp_path), '--keep-daily=-1'])
+	with pytest.raises(SystemExit):
+		irsync_retention_cmd([str(tmp_path), '--keep-monthly=-1'])
+
+def test_trash_counts_as_free_space(tmp_path, monkeypatch):
+	trashed = tmp_path/'__trash__'/'20200301~a.s.1583020800'
+	trashed.mkdir(parents=True)
+	(trashed/'f1').write_bytes(b'x'*600)
+	(trashed/'f2').write_bytes(b'x'*400)
+	os.link(trashed/'f2', tmp_path/'linked') # still hardlinked from elsewhere, frees nothing
+	assert trash_pending_bytes(str(tmp_path))==600
+
+	DiskUsage = collections.namedtuple('DiskUsage', "total used free")
+	monkeypatch.setattr(retention.shutil, 'disk_usage', lambda path: DiskUsage(100000, 99000, 1000))
+	items = make_items('a.s', [datetime.datetime(2020, 3, 2, 8, 0), datetime.datetime(2020, 3, 3, 8, 0)])
+	policy = RetentionPolicy(0, 0, 0, 0, 0, 1.5) # 1500 bytes free wanted, 500 more than now
+
+	plan = plan_retention(str(tmp_path), items, set(), policy)
+	assert (plan.need_bytes, plan.trash_bytes, plan.candidates)==(0, 600, [])
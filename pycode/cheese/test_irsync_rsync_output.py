@@ -0,0 +1,24 @@
+from incremental_rsync.share import RsyncOutputWatcher, rsync_child_env
+
+def test_stats_in_c_locale():
+	watcher = RsyncOutputWatcher()
+	watcher.feed_line("Number of files: 1,234 (reg: 1,000, dir: 234)\n")
+	watcher.feed_line("Total file size: 1,234,567 bytes\n")
+	watcher.feed_line("File list generation time: 0.001 seconds\n")
+	assert (watcher.num_files, watcher.num_reg_files, watcher.total_file_size) == (1234, 1000, 1234567)
+	assert watcher.file_list_gen_seconds == 0.001
+	assert watcher.unparsed_lines == []
+
+def test_stats_in_other_locale_are_not_guessed():
+	watcher = RsyncOutputWatcher()
+	watcher.feed_line("Total file size: 1.234.567 bytes\n")
+	watcher.feed_line("Literal data: 1.234 bytes\n")
+	watcher.feed_line("File list generation time: 0,001 seconds\n")
+	assert (watcher.total_file_size, watcher.literal_data, watcher.file_list_gen_seconds) == (-1, -1, -1)
+	assert len(watcher.unparsed_lines) == 3
+
+def test_rsync_child_env(monkeypatch):
+	monkeypatch.setenv('LC_ALL', 'de_DE.UTF-8')
+	env = rsync_child_env()
+	assert 'LC_ALL' not in env
+	assert (env['LC_CTYPE'], env['LC_NUMERIC']) == ('de_DE.UTF-8', 'C')
@@ -0,0 +1,17 @@
+from incremental_rsync import shards
+from incremental_rsync.shards import listing_params, list_toplevel_entries, ShardEntry
+
+def test_listing_params():
+	extra = ['-a', '--exclude', '*.tmp', '--include=x/', '-r', '--recursive', '-e', 'ssh -p 22',
+		'--password-file', '/etc/pw', '--delete']
+	assert listing_params(extra) == ['--exclude', '*.tmp', '--include=x/', '-e', 'ssh -p 22',
+		'--password-file', '/etc/pw']
+
+def test_unparsable_size_keeps_entry(monkeypatch):
+	output = ("drwxr-xr-x          4,096 2020/04/11 20:31:01 .\n"
+		"drwxr-xr-x          4,096 2020/04/11 20:31:01 some dir\n"
+		"-rw-r--r--      1.234.567 2020/04/11 20:31:01 big.bin\n"
+		"-rw-r--r--          1,234 2020/04/11 20:31:01 small.txt\n")
+	monkeypatch.setattr(shards, 'run_exe_grab_output_with_timeout', lambda *args: (0, output, 0))
+	assert list_toplevel_entries("rsync://host/mod/", ['-r']) == [
+		ShardEntry('some dir', True, -1), ShardEntry('big.bin', False, -1), ShardEntry('small.txt', False, 1234)]
@@ -0,0 +1,35 @@
+import os
+
+from incremental_rsync import space
+from incremental_rsync.space import scan_generation, compute_space_usage, _cache_filepath
+
+def make_file(filepath, size):
+	os.makedirs(os.path.dirname(filepath), exist_ok=True)
+	with open(filepath, "wb") as fh:
+		fh.write(b'x'*size)
+
+def test_scan_generation_sorted_runs(tmp_path, monkeypatch):
+	monkeypatch.setattr(space, 'SCAN_SORT_PAIRS', 3) # several runs to merge
+	gen = tmp_path/'gen'
+	for i in range(10):
+		make_file(str(gen/('d%d'%(i%3))/('f%d'%(i))), i+1)
+	os.link(str(gen/'d0'/'f0'), str(gen/'link_to_f0')) # counted once
+
+	pairs = scan_generation(str(gen))
+	expected = sorted((os.stat(str(p)).st_ino, os.stat(str(p)).st_size) for p in gen.rglob('f*'))
+	assert list(zip(pairs[0::2], pairs[1::2]))==expected
+
+def test_unique_and_shared(tmp_path):
+	store = str(tmp_path)
+	make_file(os.path.join(store, 'g1', 'a'), 100)
+	make_file(os.path.join(store, 'g1', 'b'), 10)
+	os.makedirs(os.path.join(store, 'g2'))
+	os.link(os.path.join(store, 'g1', 'a'), os.path.join(store, 'g2', 'a'))
+
+	usages, physical = compute_space_usage(store, ['g1', 'g2'])
+	assert physical==110
+	assert [(u.total_bytes, u.unique_bytes) for u in usages]==[(110, 10), (100, 0)]
+	assert os.path.isfile(_cache_filepath(store, 'g2'))
+
+	space.drop_cache(store, 'g2')
+	assert not os.path.isfile(_cache_filepath(store, 'g2'))
@@ -0,0 +1,55 @@
+import os
+import sys
+import subprocess
+
+from incremental_rsync.fastpath import VALUE_OPTIONS, FLAG_OPTIONS, parse_argv_quick, irsync_quick_done, datetime_by_pattern
+from incremental_rsync.irsync_cmd import init_irsync_argparser
+
+import pytest
+
+# Modules that the already-done fast path must not import.
+HEAVY_MODULES = ('argparse', 'asyncio', 'subprocess', 'sqlite3', 'configparser',
+	'cheese.incremental_rsync.share', 'cheese.incremental_rsync.irsync_client')
+
+def test_fastpath_options_match_argparser():
+	value_options = set()
+	flag_options = set()
+	for action in init_irsync_argparser()._actions:
+		for option in action.option_strings:
+			if option in ('-h', '--help', '--rsync'):
+				continue
+			(flag_options if action.nargs==0 else value_options).add(option)
+	assert value_options==VALUE_OPTIONS
+	assert flag_options==FLAG_OPTIONS
+
+def test_parse_argv_quick():
+	assert parse_argv_quick(['rsync://srv/mod', 'store', '--datetime-pattern', 'YYYYMMDD-hh', '--dedup',
+		'--rsync', '--bwlimit=100']) == (['rsync://srv/mod', 'store'], {'--datetime-pattern':'YYYYMMDD-hh', '--dedup':True})
+	assert parse_argv_quick(['rsync://srv/mod', 'store', '--datetime-pat=YYYYMMDD']) is None # abbreviation
+	assert parse_argv_quick(['rsync://srv/mod']) is None
+
+def test_quick_done_hint_relative_to_store(tmp_path, monkeypatch):
+	store = tmp_path/'store'
+	(store/datetime_by_pattern("YYYYMMDD")/'srv.mod').mkdir(parents=True)
+	monkeypatch.chdir(tmp_path)
+	assert irsync_quick_done(['rsync://srv/mod', str(store), '--finish-dir-write-to', 'hint.txt'])
+	assert (store/'hint.txt').is_file() # where the normal path writes it, after chdir to local_store_dir
+	assert not (tmp_path/'hint.txt').exists()
+
+def test_fastpath_imports_light():
+	pycode_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+	cp = subprocess.run([sys.executable, "-X", "importtime", "-c", "import cheese.incremental_rsync.irsync_cmd"],
+		cwd=pycode_dir, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+
+	cumulative = {}
+	for line in cp.stderr.splitlines():
+		# import time: self [us] | cumulative | imported package
+		if line.startswith("import time:") and '|' in line:
+			_, cumul, name = line[len("import time:"):].split('|')
+			if cumul.strip().isdigit():
+				cumulative[name.strip()] = int(cumul)
+
+	# Which modules are imported, not how long it takes, which varies with machine load.
+	assert 'cheese.incremental_rsync.irsync_cmd' in cumulative
+	for modname in HEAVY_MODULES:
+		assert modname not in cumulative, "%s is imported at startup"%(modname)
@@ -9,8 +9,8 @@ import pytest
 Prefix = 'kiss-'
 Suffix = '.tmp'
 
-def test_simple1():
-	sctf = SelfclearTempfile('.', Prefix, Suffix)
+def test_simple1(tmp_path):
+	sctf = SelfclearTempfile(str(tmp_path), Prefix, Suffix)
 	
 	fh = sctf.create_new()
 	print("[[[Created filepath is: %s]]]"%fh.name)